@@ -1,15 +1,29 @@
 import datetime
 import flask
 from flask import Response
+from flask_babel import lazy_gettext as _
+import json
+from lxml import etree
 
 import base64
+import hashlib
 import re
 import requests
+import time
+from xml.sax.saxutils import escape as xml_escape
 
 from model import (
+    Admin,
     ShortClientTokenDecoder,
+    get_one,
 )
 
+from problem_details import (
+    INVALID_CREDENTIALS,
+    INVALID_INPUT,
+)
+from util.circuit_breaker import CircuitBreaker
+from util.lru import LRUCache
 from util.string_helpers import base64
 from util.xmlparser import XMLParser
 
@@ -50,11 +64,75 @@ class AdobeVendorIDController(object):
     def status_handler(self):
         return Response("UP", 200, {"Content-Type": "text/plain"})
 
+    # The most Adobe Account IDs that can be looked up in one request.
+    MAX_BATCH_SIZE = 1000
+
+    def batch_userinfo_handler(self):
+        """Look up a number of Adobe Account IDs at once.
+
+        This isn't part of the Vendor ID protocol. It's a JSON
+        alternative to the AccountInfo request for tools that need to
+        check a lot of accounts, which would otherwise have to send
+        one AccountInfo request per account. It's only open to
+        registry admins, who authenticate with HTTP Basic Auth.
+
+        Each account ID gets the same label the AccountInfo request
+        would give it.
+        """
+        if not self.authenticated_admin():
+            return INVALID_CREDENTIALS
+        document = flask.request.get_json(silent=True, force=True)
+        urns = None
+        if isinstance(document, dict):
+            urns = document.get('users')
+        if (not isinstance(urns, list)
+            or not all(isinstance(urn, str) for urn in urns)):
+            return INVALID_INPUT.detailed(
+                _("Expected a JSON object with a list of account IDs under 'users'.")
+            )
+        if len(urns) > self.MAX_BATCH_SIZE:
+            return INVALID_INPUT.detailed(
+                _("Cannot look up more than %(max)s accounts at once.",
+                  max=self.MAX_BATCH_SIZE)
+            )
+        labels = dict((urn, self.model.urn_to_label(urn)) for urn in urns)
+        return Response(
+            json.dumps(dict(users=labels)), 200,
+            {"Content-Type": "application/json"}
+        )
+
+    def authenticated_admin(self):
+        """Find the Admin whose credentials came with the current request.
+
+        Unlike Admin.authenticate, this never creates an Admin.
+
+        :return: An Admin, or None.
+        """
+        authorization = flask.request.authorization
+        if not authorization or not authorization.username:
+            return None
+        admin = get_one(self._db, Admin, username=authorization.username)
+        if (admin and admin.password
+            and admin.check_password(authorization.password or "")):
+            return admin
+        return None
+
 
 class AdobeRequestParser(XMLParser):
 
     NAMESPACES = { "adept" : "http://ns.adobe.com/adept" }
 
+    @classmethod
+    def compile(cls, expression):
+        """Compile an XPath expression once, so it doesn't have to be
+        compiled again for every request.
+        """
+        return etree.XPath(expression, namespaces=cls.NAMESPACES)
+
+    @classmethod
+    def compile_fields(cls, *keys):
+        return dict((key, cls.compile('adept:' + key)) for key in keys)
+
     def process(self, data):
         requests = list(self.process_all(
             data, self.REQUEST_XPATH, self.NAMESPACES))
@@ -65,7 +143,8 @@ class AdobeRequestParser(XMLParser):
         return requests[0]
 
     def _add(self, d, tag, key, namespaces, transform=None):
-        v = self._xpath1(tag, 'adept:' + key, namespaces)
+        values = self.FIELDS[key](tag)
+        v = values[0] if values else None
         if v is not None:
             v = v.text
             if v is not None:
@@ -77,11 +156,15 @@ class AdobeRequestParser(XMLParser):
 
 class AdobeSignInRequestParser(AdobeRequestParser):
 
-    REQUEST_XPATH = "/adept:signInRequest"
+    REQUEST_XPATH = AdobeRequestParser.compile("/adept:signInRequest")
 
     STANDARD = 'standard'
     AUTH_DATA = 'authData'
 
+    FIELDS = AdobeRequestParser.compile_fields(
+        'username', 'password', AUTH_DATA
+    )
+
     def process_one(self, tag, namespaces):
         method = tag.attrib.get('method')
 
@@ -100,7 +183,9 @@ class AdobeSignInRequestParser(AdobeRequestParser):
 
 class AdobeAccountInfoRequestParser(AdobeRequestParser):
 
-    REQUEST_XPATH = "/adept:accountInfoRequest"
+    REQUEST_XPATH = AdobeRequestParser.compile("/adept:accountInfoRequest")
+
+    FIELDS = AdobeRequestParser.compile_fields('user')
 
     def process_one(self, tag, namespaces):
         method = tag.attrib.get('method')
@@ -135,9 +220,11 @@ class AdobeVendorIDRequestHandler(object):
 
     def __init__(self, vendor_id):
         self.vendor_id = vendor_id
+        self.signin_parser = AdobeSignInRequestParser()
+        self.accountinfo_parser = AdobeAccountInfoRequestParser()
 
     def handle_signin_request(self, data, standard_lookup, authdata_lookup):
-        parser = AdobeSignInRequestParser()
+        parser = self.signin_parser
         try:
             data = parser.process(data)
         except Exception as e:
@@ -159,11 +246,12 @@ class AdobeVendorIDRequestHandler(object):
         if user_id is None:
             return self.error_document(self.AUTH_ERROR_TYPE, failure)
         else:
-            return self.SIGN_IN_RESPONSE_TEMPLATE % dict(
-                user=user_id, label=label)
+            return self._render(
+                self.SIGN_IN_RESPONSE_TEMPLATE, user=user_id, label=label
+            )
 
     def handle_accountinfo_request(self, data, urn_to_label):
-        parser = AdobeAccountInfoRequestParser()
+        parser = self.accountinfo_parser
         label = None
         try:
             data = parser.process(data)
@@ -181,7 +269,9 @@ class AdobeVendorIDRequestHandler(object):
                 self.ACCOUNT_INFO_ERROR_TYPE, str(e))
 
         if label:
-            return self.ACCOUNT_INFO_RESPONSE_TEMPLATE % dict(label=label)
+            return self._render(
+                self.ACCOUNT_INFO_RESPONSE_TEMPLATE, label=label
+            )
         else:
             return self.error_document(
                 self.ACCOUNT_INFO_ERROR_TYPE,
@@ -189,8 +279,26 @@ class AdobeVendorIDRequestHandler(object):
             )
 
     def error_document(self, type, message):
-        return self.ERROR_RESPONSE_TEMPLATE % dict(
-            vendor_id=self.vendor_id, type=type, message=message)
+        return self._render(
+            self.ERROR_RESPONSE_TEMPLATE, vendor_id=self.vendor_id,
+            type=type, message=message
+        )
+
+    # Characters that need escaping inside a double-quoted attribute,
+    # in addition to &, < and >.
+    ATTRIBUTE_ENTITIES = {'"': '&quot;'}
+
+    def _render(self, template, **values):
+        """Fill in one of the response templates.
+
+        The templates are ready-made documents, which is a lot cheaper
+        than building and serializing a tree for every response. The
+        values are escaped so the result is always well-formed XML.
+        """
+        return template % dict(
+            (key, xml_escape(str(value), self.ATTRIBUTE_ENTITIES))
+            for key, value in values.items()
+        )
 
 class AdobeVendorIDModel(object):
 
@@ -219,24 +327,28 @@ class AdobeVendorIDModel(object):
         """
         username = authorization_data.get('username')
         password = authorization_data.get('password')
+        decoder = self.short_client_token_decoder
         try:
-            delegated_patron_identifier = self.short_client_token_decoder.decode_two_part(
+            account_id = decoder.decode_two_part_to_account_id(
                 self._db, username, password
             )
+        except ShortClientTokenDecoder.TokenRejected as e:
+            # This is a short client token, but it's no good, and the
+            # delegates have already been asked about it.
+            return None, None
         except ValueError as e:
-            delegated_patron_identifier = None
-        if delegated_patron_identifier:
-            return self.account_id_and_label(delegated_patron_identifier)
-        else:
-            for delegate in self.short_client_token_decoder.delegates:
-                try:
-                    account_id, label, content = delegate.sign_in_standard(
-                        username, password
-                    )
-                    return account_id, label
-                except Exception as e:
-                    # This delegate couldn't help us.
-                    pass
+            account_id = None
+        if account_id:
+            return account_id, self.urn_to_label(account_id)
+
+        # This isn't a short client token. Maybe a delegate knows
+        # what it is.
+        answer = decoder.ask_delegates(
+            lambda delegate: delegate.sign_in_standard(username, password)
+        )
+        if answer:
+            account_id, label, content = answer
+            return account_id, label
 
         # Neither this server nor the delegates were able to do anything.
         return None, None
@@ -248,24 +360,24 @@ class AdobeVendorIDModel(object):
         necessary.
         """
         try:
-            delegated_patron_identifier = self.short_client_token_decoder.decode(
+            account_id = self.short_client_token_decoder.decode_to_account_id(
                 self._db, authdata
             )
+        except ShortClientTokenDecoder.TokenRejected as e:
+            # The delegates have already had a look at this one.
+            return None, None
         except ValueError as e:
-            delegated_patron_identifier = None
+            account_id = None
 
-        if delegated_patron_identifier:
-            return self.account_id_and_label(delegated_patron_identifier)
-        else:
-            for delegate in self.short_client_token_decoder.delegates:
-                try:
-                    account_id, label, content = delegate.sign_in_authdata(
-                        authdata
-                    )
-                    return account_id, label
-                except Exception as e:
-                    # This delegate couldn't help us.
-                    pass
+        if account_id:
+            return account_id, self.urn_to_label(account_id)
+
+        answer = self.short_client_token_decoder.ask_delegates(
+            lambda delegate: delegate.sign_in_authdata(authdata)
+        )
+        if answer:
+            account_id, label, content = answer
+            return account_id, label
 
         # Neither this server nor the delegates were able to do anything.
         # We couldn't find anything.
@@ -321,16 +433,30 @@ class AdobeVendorIDClient(object):
     LABEL_RE = re.compile("<label>([^<]+)</label>")
     ERROR_RE = re.compile('<error [^<]+ data="([^<]+)"')
 
+    # A delegate that takes longer than this to answer is treated as
+    # unable to help.
+    TIMEOUT = 10
+
+    # Successful answers are remembered for this many seconds, so that
+    # a device that signs in repeatedly doesn't hit the delegate every
+    # time.
+    ANSWER_CACHE_TIME = 60
+    ANSWER_CACHE_SIZE = 1000
+
     def __init__(self, base_url):
         self.base_url = base_url
         self.signin_url = base_url + "SignIn"
         self.accountinfo_url = base_url + "AccountInfo"
         self.status_url = base_url + "Status"
+        self.health = CircuitBreaker(
+            "Vendor ID delegate %s" % base_url, probe=self.status
+        )
+        self._answers = LRUCache(self.ANSWER_CACHE_SIZE)
 
     def status(self):
         """Is the server up and running?"""
-        response = requests.get(self.status_url)
-        content = response.content
+        response = self._get(self.status_url)
+        content = response.text
         self.handle_error(response.status_code, content)
         if content == 'UP':
             return True
@@ -342,20 +468,61 @@ class AdobeVendorIDClient(object):
         :param: If signin is successful, a 2-tuple (account identifier, label).
         """
         body = self.SIGNIN_AUTHDATA_BODY % base64.encodestring(authdata)
-        response = requests.post(self.signin_url, data=body)
-        return self._process_sign_in_result(response)
+        return self._ask(
+            self._process_sign_in_result, self.signin_url, body
+        )
 
     def sign_in_standard(self, username, password):
         """Attempt to sign in using username and password."""
         body = self.SIGNIN_STANDARD_BODY % (username, password)
-        response = requests.post(self.signin_url, data=body)
-        return self._process_sign_in_result(response)
+        return self._ask(
+            self._process_sign_in_result, self.signin_url, body
+        )
 
     def user_info(self, urn):
         """Turn a user identifier into a label."""
         body = self.USER_INFO_BODY % urn
-        response = requests.post(self.accountinfo_url, data=body)
-        content = response.content
+        return self._ask(
+            self._process_user_info_result, self.accountinfo_url, body
+        )
+
+    def _ask(self, process_result, url, body):
+        """Send a document to the delegate, unless it's known to be
+        down, or we've recently gotten an answer to the same question.
+        """
+        key = hashlib.sha256((url + body).encode("utf8")).hexdigest()
+        now = time.monotonic()
+        cached = self._answers.get(key)
+        if cached:
+            expires, answer = cached
+            if expires > now:
+                return answer
+
+        if not self.health.allow():
+            raise VendorIDServerException(
+                "%s is not responding; not asking it." % self.base_url
+            )
+        try:
+            answer = process_result(self._post(url, body))
+        except VendorIDAuthenticationError as e:
+            # The delegate is working fine; it just said no.
+            self.health.record_success()
+            raise
+        except Exception as e:
+            self.health.record_failure()
+            raise
+        self.health.record_success()
+        self._answers.set(key, (now + self.ANSWER_CACHE_TIME, answer))
+        return answer
+
+    def _get(self, url):
+        return requests.get(url, timeout=self.TIMEOUT)
+
+    def _post(self, url, body):
+        return requests.post(url, data=body, timeout=self.TIMEOUT)
+
+    def _process_user_info_result(self, response):
+        content = response.text
         self.handle_error(response.status_code, content)
         label = self.extract_label(content)
         if not label:
@@ -384,7 +551,7 @@ class AdobeVendorIDClient(object):
         return match.groups()[0]
 
     def _process_sign_in_result(self, response):
-        content = response.content
+        content = response.text
         self.handle_error(response.status_code, content)
         identifier = self.extract_user_identifier(content)
         label = self.extract_label(content)
@@ -11,6 +11,7 @@ from config import Configuration
 from controller import LibraryRegistry
 from log import LogConfiguration
 from model import SessionManager, ConfigurationSetting
+from util import GeometryUtility
 
 from util.app_server import returns_problem_detail, returns_json_or_response_or_problem_detail
 from app_helpers import (
@@ -29,24 +30,60 @@ uses_location = uses_location_factory(app)
 
 testing = 'TESTING' in os.environ
 db_url = Configuration.database_url(testing)
-SessionManager.initialize(db_url)
+
+# gunicorn may import this module once, in its master process, and fork
+# the workers afterwards (see preload_app in gunicorn.conf.py). Startup
+# is therefore split in two. What's done at import time is safe to share
+# between processes: the routes, the session factory, and read-only data
+# that the workers can share one copy of. initialize_worker() builds
+# everything that belongs to a single process -- logging handlers, the
+# LibraryRegistry and its controllers, with their caches, HTTP clients
+# and thread pools -- and must run in each worker after it's forked.
+
+# If this environment variable is set, the process importing this
+# module will fork workers and call initialize_worker() in each one,
+# so there's no point in calling it here.
+DEFER_WORKER_INITIALIZATION = 'LIBRARY_REGISTRY_DEFER_WORKER_INITIALIZATION'
+
+# The schema is normally set up by bin/initialize_database before the
+# web server starts, so we only need to check its version.
+engine, connection = SessionManager.initialize(
+    db_url, initialize_schema=False
+)
+connection.close()
 session_factory = SessionManager.sessionmaker(db_url)
 _db = flask_scoped_session(session_factory, app)
-
-log_level = LogConfiguration.initialize(_db, testing=testing)
-debug = log_level == 'DEBUG'
-app.config['DEBUG'] = debug
-app.debug = debug
 app._db = _db
 
-if os.environ.get('AUTOINITIALIZE') == 'False':
-    pass
-    # It's the responsibility of the importing code to set app.library_registry
-    # appropriately.
-else:
-    if getattr(app, 'library_registry', None) is None:
+GeometryUtility.ip_database()
+
+def initialize_logging():
+    log_level = LogConfiguration.initialize(_db, testing=testing)
+    debug = log_level == 'DEBUG'
+    app.config['DEBUG'] = debug
+    app.debug = debug
+
+def initialize_worker():
+    """Set up the state that belongs to a single process.
+
+    This is called at import time, unless a preloading server will
+    call it in each worker right after it's forked.
+    """
+    initialize_logging()
+    if os.environ.get('AUTOINITIALIZE') == 'False':
+        pass
+        # It's the responsibility of the importing code to set
+        # app.library_registry appropriately.
+    else:
         app.library_registry = LibraryRegistry(_db)
 
+    # Give the connection back to the pool and forget the objects
+    # loaded through it.
+    _db.remove()
+
+if not os.environ.get(DEFER_WORKER_INITIALIZATION):
+    initialize_worker()
+
 @app.before_first_request
 def set_secret_key(_db=None):
     _db = _db or app._db
@@ -67,12 +104,14 @@ def shutdown_session(exception):
             app.library_registry._db.commit()
 
 @app.route('/')
+@compressible
 @uses_location
 @returns_problem_detail
 def nearby(_location):
     return app.library_registry.registry_controller.nearby(_location)
 
 @app.route('/qa')
+@compressible
 @uses_location
 @returns_problem_detail
 def nearby_qa(_location):
@@ -85,13 +124,20 @@ def nearby_qa(_location):
 def register():
     return app.library_registry.registry_controller.register()
 
+@app.route("/register/status/<key>")
+@returns_problem_detail
+def registration_status(key):
+    return app.library_registry.registry_controller.registration_status(key)
+
 @app.route('/search')
+@compressible
 @uses_location
 @returns_problem_detail
 def search(_location):
     return app.library_registry.registry_controller.search(_location)
 
 @app.route('/qa/search')
+@compressible
 @uses_location
 @returns_problem_detail
 def search_qa(_location):
@@ -166,6 +212,7 @@ def pls_id():
     return app.library_registry.registry_controller.add_or_edit_pls_id()
 
 @app.route('/library/<uuid>')
+@compressible
 @has_library
 @returns_json_or_response_or_problem_detail
 def library():
@@ -188,6 +235,11 @@ def library_focus():
 def coverage():
     return app.library_registry.coverage_controller.lookup()
 
+@app.route('/tiles/<int:z>/<int:x>/<int:y>.mvt')
+@returns_problem_detail
+def tile(z, x, y):
+    return app.library_registry.coverage_controller.tile(z, x, y)
+
 
 @app.route('/heartbeat')
 @returns_problem_detail
@@ -198,24 +250,36 @@ def hearbeat():
 @app.route('/AdobeAuth/SignIn', methods=['POST'])
 @returns_problem_detail
 def adobe_vendor_id_signin():
-    if app.library_registry.adobe_vendor_id:
-        return app.library_registry.adobe_vendor_id.signin_handler()
+    controller = app.library_registry.adobe_vendor_id
+    if controller:
+        return controller.signin_handler()
     else:
         return Response("", 404)
 
 @app.route('/AdobeAuth/AccountInfo', methods=['POST'])
 @returns_problem_detail
 def adobe_vendor_id_accountinfo():
-    if app.library_registry.adobe_vendor_id:
-        return app.library_registry.adobe_vendor_id.userinfo_handler()
+    controller = app.library_registry.adobe_vendor_id
+    if controller:
+        return controller.userinfo_handler()
+    else:
+        return Response("", 404)
+
+@app.route('/AdobeAuth/AccountInfo/batch', methods=['POST'])
+@returns_problem_detail
+def adobe_vendor_id_accountinfo_batch():
+    controller = app.library_registry.adobe_vendor_id
+    if controller:
+        return controller.batch_userinfo_handler()
     else:
         return Response("", 404)
 
 @app.route('/AdobeAuth/Status')
 @returns_problem_detail
 def adobe_vendor_id_status():
-    if app.library_registry.adobe_vendor_id:
-        return app.library_registry.adobe_vendor_id.status_handler()
+    controller = app.library_registry.adobe_vendor_id
+    if controller:
+        return controller.status_handler()
     else:
         return Response("", 404)
 
@@ -1,9 +1,14 @@
 import flask
-import gzip
-from io import BytesIO
+import hashlib
 from functools import wraps
 
+from config import Configuration
 from util import GeometryUtility
+from util.compression import (
+    encodings,
+    negotiate,
+)
+from util.lru import LRUCache
 from util.problem_detail import ProblemDetail
 from util.flask_util import originating_ip
 
@@ -48,18 +53,26 @@ def uses_location_factory(app):
     return factory
 
 
+# Keep this many bytes of compressed response bodies in memory.
+COMPRESSED_RESPONSE_CACHE_SIZE = 32 * 1024 * 1024
+
+compressed_responses = LRUCache(COMPRESSED_RESPONSE_CACHE_SIZE, sizeof=len)
+
 def compressible(f):
     """Decorate a function to make it transparently handle whatever
     compression the client has announced it supports.
 
-    Currently the only form of compression supported is
-    representation-level gzip compression requested through the
-    Accept-Encoding header.
+    Representation-level compression is requested through the
+    Accept-Encoding header. gzip is always available, and brotli and
+    zstd are available if the libraries that implement them are
+    installed. Configuration.compression_levels() controls how hard
+    each one works.
 
-    This code was modified from
-    http://kb.sites.apiit.edu.my/knowledge-base/how-to-gzip-response-in-flask/,
-    though I don't know if that's the original source; it shows up in
-    a lot of places.
+    A complete response body is compressed once and the result is
+    kept, keyed by the response's ETag (or a hash of its body) and the
+    encoding, so asking for the same feed again doesn't mean
+    compressing it again. A streaming body is compressed as it's
+    generated.
     """
     @wraps(f)
     def compressor(*args, **kwargs):
@@ -73,30 +86,46 @@ def compressible(f):
                 # already been encoded.
                 return response
 
-            accept_encoding = flask.request.headers.get('Accept-Encoding', '')
-            if not 'gzip' in accept_encoding.lower():
+            # Whether or not this response is compressed, a client
+            # that sends a different Accept-Encoding might get a
+            # different response.
+            response.vary.add('Accept-Encoding')
+
+            encoding = negotiate(
+                flask.request.headers.get('Accept-Encoding'),
+                encodings(Configuration.compression_levels())
+            )
+            if not encoding:
                 return response
 
             # At this point we know we're going to be changing the
-            # outgoing response.
-
-            # TODO: I understand what direct_passthrough does, but am
-            # not sure what it has to do with this, and commenting it
-            # out doesn't change the results or cause tests to
-            # fail. This is pure copy-and-paste magic.
+            # outgoing response, so it can't be passed straight
+            # through to the WSGI server.
             response.direct_passthrough = False
 
-            buffer = BytesIO()
-            gzipped = gzip.GzipFile(mode='wb', fileobj=buffer)
-            gzipped.write(response.data)
-            gzipped.close()
-            response.data = buffer.getvalue()
-
-            response.headers['Content-Encoding'] = 'gzip'
-            # TODO: This is bad if Vary is already set.
-            response.headers['Vary'] = 'Accept-Encoding'
-            response.headers['Content-Length'] = len(response.data)
+            etag, weak = response.get_etag()
+            if response.is_streamed:
+                response.response = encoding.stream(response.response)
+                response.headers.pop('Content-Length', None)
+            else:
+                data = response.get_data()
+                if etag and not weak:
+                    version = etag
+                else:
+                    version = hashlib.sha1(data).hexdigest()
+                key = (flask.request.endpoint, version, encoding.name,
+                       encoding.level)
+                compressed = compressed_responses.get(key)
+                if compressed is None:
+                    compressed = encoding.compress(data)
+                    compressed_responses.set(key, compressed)
+                response.set_data(compressed)
 
+            response.headers['Content-Encoding'] = encoding.name
+            if etag:
+                # The compressed bytes aren't the bytes the ETag was
+                # calculated from.
+                response.set_etag(etag, weak=True)
             return response
 
         return f(*args, **kwargs)
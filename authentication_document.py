@@ -400,6 +400,13 @@ class AuthenticationDocument(object):
         # which are not mentioned in the list we just gathered.
         library.service_areas = service_areas
 
+        def areas(service_areas):
+            return set((x.place_id, x.type) for x in service_areas)
+        if areas(service_areas) != areas(old_service_areas):
+            # Any vector tiles showing the old service areas are out
+            # of date.
+            ServiceArea.bump_generation(Session.object_session(library))
+
     @classmethod
     def _update_service_areas(cls, library, areas, type, service_areas):
         """Update a Library's ServiceAreas with a new set based on
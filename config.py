@@ -29,6 +29,39 @@ class Configuration(object):
     DATABASE_TEST_ENVIRONMENT_VARIABLE = 'SIMPLIFIED_TEST_DATABASE'
     DATABASE_PRODUCTION_ENVIRONMENT_VARIABLE = 'SIMPLIFIED_PRODUCTION_DATABASE'
 
+    # Environment variables that control each process's pool of
+    # database connections. A process may hold up to (pool size + max
+    # overflow) connections at once, so with several web server
+    # workers these need to be kept fairly small.
+    DATABASE_POOL_SIZE_ENVIRONMENT_VARIABLE = 'SIMPLIFIED_DATABASE_POOL_SIZE'
+    DATABASE_MAX_OVERFLOW_ENVIRONMENT_VARIABLE = 'SIMPLIFIED_DATABASE_MAX_OVERFLOW'
+
+    # Connections older than this many seconds are replaced.
+    DATABASE_POOL_RECYCLE_ENVIRONMENT_VARIABLE = 'SIMPLIFIED_DATABASE_POOL_RECYCLE'
+
+    # If this is true, a connection is tested before it's used, so a
+    # database restart or failover doesn't cause errors.
+    DATABASE_POOL_PRE_PING_ENVIRONMENT_VARIABLE = 'SIMPLIFIED_DATABASE_POOL_PRE_PING'
+
+    # If this is set, the database cancels any statement that runs
+    # longer than this many milliseconds.
+    DATABASE_STATEMENT_TIMEOUT_ENVIRONMENT_VARIABLE = 'SIMPLIFIED_DATABASE_STATEMENT_TIMEOUT'
+
+    DEFAULT_DATABASE_POOL_SIZE = 5
+    DEFAULT_DATABASE_MAX_OVERFLOW = 5
+    DEFAULT_DATABASE_POOL_RECYCLE = 3600
+
+    # Environment variables that control how hard responses are
+    # compressed with each encoding. A higher level makes a smaller
+    # response but takes more CPU time.
+    GZIP_LEVEL_ENVIRONMENT_VARIABLE = 'SIMPLIFIED_GZIP_LEVEL'
+    BROTLI_LEVEL_ENVIRONMENT_VARIABLE = 'SIMPLIFIED_BROTLI_LEVEL'
+    ZSTD_LEVEL_ENVIRONMENT_VARIABLE = 'SIMPLIFIED_ZSTD_LEVEL'
+
+    DEFAULT_GZIP_LEVEL = 6
+    DEFAULT_BROTLI_LEVEL = 5
+    DEFAULT_ZSTD_LEVEL = 3
+
     log = logging.getLogger("Configuration file loader")
 
     INTEGRATIONS = 'integrations'
@@ -68,9 +101,28 @@ class Configuration(object):
     # controls how big a feed must be to be considered 'large'.
     LARGE_FEED_SIZE = "large_feed_size"
 
+    # If this sitewide setting is true, a client that sends
+    # "Prefer: respond-async" when registering a library gets a 202
+    # response right away, and the registration itself is carried out
+    # later by a worker process (bin/registration_worker).
+    ASYNCHRONOUS_REGISTRATION = "asynchronous_registration"
+
     # The name of the sitewide secret used for admin login.
     SECRET_KEY = "secret_key"
 
+    # This sitewide setting is incremented whenever the site's
+    # configuration changes, so that long-running processes know to
+    # reload any configuration they've cached.
+    CONFIGURATION_GENERATION = "configuration_generation"
+
+    # A database session that has changed the configuration, but not
+    # yet committed, has this flag set in Session.info.
+    CONFIGURATION_CHANGED = "configuration_changed"
+
+    # Configuration cached by this process, along with the
+    # configuration generation it was loaded under.
+    _generation_cache = {}
+
     @classmethod
     def database_url(cls, test=False):
         """Find the URL to the database so that other configuration
@@ -88,12 +140,150 @@ class Configuration(object):
             )
         return url
 
+    @classmethod
+    def integer_from_environment(cls, variable, default):
+        """Look up an integer in an environment variable.
+
+        :return: The integer, or `default` if the variable isn't set.
+        :raise CannotLoadConfiguration: If the variable is set to
+            something that isn't an integer.
+        """
+        value = os.environ.get(variable)
+        if not value:
+            return default
+        try:
+            return int(value)
+        except ValueError as e:
+            raise CannotLoadConfiguration(
+                "Value of %s must be an integer, not %r." % (
+                    variable, value
+                )
+            )
+
+    @classmethod
+    def database_engine_arguments(cls):
+        """Find the keyword arguments to use when creating a database
+        engine.
+        """
+        integer = cls.integer_from_environment
+        pre_ping = os.environ.get(
+            cls.DATABASE_POOL_PRE_PING_ENVIRONMENT_VARIABLE, 'true'
+        )
+        arguments = dict(
+            pool_size=integer(
+                cls.DATABASE_POOL_SIZE_ENVIRONMENT_VARIABLE,
+                cls.DEFAULT_DATABASE_POOL_SIZE
+            ),
+            max_overflow=integer(
+                cls.DATABASE_MAX_OVERFLOW_ENVIRONMENT_VARIABLE,
+                cls.DEFAULT_DATABASE_MAX_OVERFLOW
+            ),
+            pool_recycle=integer(
+                cls.DATABASE_POOL_RECYCLE_ENVIRONMENT_VARIABLE,
+                cls.DEFAULT_DATABASE_POOL_RECYCLE
+            ),
+            pool_pre_ping=pre_ping.lower() in ('true', 't', 'yes', 'y', '1'),
+        )
+        statement_timeout = integer(
+            cls.DATABASE_STATEMENT_TIMEOUT_ENVIRONMENT_VARIABLE, None
+        )
+        if statement_timeout:
+            arguments['connect_args'] = dict(
+                options='-c statement_timeout=%d' % statement_timeout
+            )
+        return arguments
+
+    @classmethod
+    def compression_levels(cls):
+        """Find the level to use with each compression encoding.
+
+        :return: A dictionary mapping Content-Encoding names to levels.
+        """
+        integer = cls.integer_from_environment
+        return {
+            'gzip': integer(
+                cls.GZIP_LEVEL_ENVIRONMENT_VARIABLE, cls.DEFAULT_GZIP_LEVEL
+            ),
+            'br': integer(
+                cls.BROTLI_LEVEL_ENVIRONMENT_VARIABLE, cls.DEFAULT_BROTLI_LEVEL
+            ),
+            'zstd': integer(
+                cls.ZSTD_LEVEL_ENVIRONMENT_VARIABLE, cls.DEFAULT_ZSTD_LEVEL
+            ),
+        }
+
+    @classmethod
+    def configuration_generation(cls, _db):
+        from model import ConfigurationSetting
+        return ConfigurationSetting.sitewide(
+            _db, cls.CONFIGURATION_GENERATION
+        ).int_value or 0
+
+    @classmethod
+    def bump_configuration_generation(cls, _db):
+        """Let every process know that the configuration has changed,
+        once this session commits.
+        """
+        from model import ConfigurationSetting
+        ConfigurationSetting.sitewide(
+            _db, cls.CONFIGURATION_GENERATION
+        ).increment()
+        _db.flush()
+
+    @classmethod
+    def cached(cls, _db, name, load):
+        """Call `load(_db)`, or reuse the answer from an earlier call if
+        the configuration hasn't changed since then.
+
+        :param name: The answer is cached under this name.
+        """
+        from model import changes_configuration
+        if (_db.info.get(cls.CONFIGURATION_CHANGED)
+            or changes_configuration(_db)):
+            # This session has uncommitted changes to the
+            # configuration, which no other session can see yet.
+            return load(_db)
+
+        generation = cls.configuration_generation(_db)
+        cached = cls._generation_cache.get(name)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        value = load(_db)
+        cls._generation_cache[name] = (generation, value)
+        return value
+
+    @classmethod
+    def forget_cached(cls):
+        cls._generation_cache.clear()
+
+    @classmethod
+    def large_feed_size(cls, _db):
+        """Find out how many libraries make an OPDS feed 'large'.
+
+        :return: An integer, or None if no feed is too large.
+        """
+        return cls.cached(_db, cls.LARGE_FEED_SIZE, cls._large_feed_size)
+
+    @classmethod
+    def _large_feed_size(cls, _db):
+        from model import ConfigurationSetting
+        return ConfigurationSetting.sitewide(
+            _db, cls.LARGE_FEED_SIZE
+        ).int_value
+
     @classmethod
     def vendor_id(cls, _db):
         """Look up the Adobe Vendor ID configuration for this registry.
 
         :return: a 3-tuple (vendor ID, node value, [delegates])
         """
+        vendor_id, node, delegates = cls.cached(
+            _db, "vendor_id", cls._vendor_id
+        )
+        return vendor_id, node, list(delegates)
+
+    @classmethod
+    def _vendor_id(cls, _db):
         from model import ExternalIntegration
 
         integration = ExternalIntegration.lookup(
@@ -1,4 +1,5 @@
 import datetime
+import hashlib
 import logging
 import flask
 from flask_babel import lazy_gettext as _
@@ -30,9 +31,11 @@ from model import (
     Hyperlink,
     Library,
     Place,
+    RegistrationJob,
     Resource,
     ServiceArea,
     Validation,
+    create,
     get_one,
     get_one_or_create,
     production_session,
@@ -51,7 +54,9 @@ from util import GeometryUtility
 from util.app_server import (
     HeartbeatController,
     catalog_response,
+    not_modified_response,
 )
+from util.lru import LRUCache
 from util.http import (
     HTTP,
 )
@@ -89,13 +94,31 @@ class LibraryRegistry(object):
         self.coverage_controller = CoverageController(self)
 
         self.heartbeat = HeartbeatController()
-        vendor_id, node_value, delegates = Configuration.vendor_id(self._db)
-        if vendor_id:
-            self.adobe_vendor_id = AdobeVendorIDController(
-                self._db, vendor_id, node_value, delegates
+        self._adobe_vendor_id = None
+
+    @property
+    def adobe_vendor_id(self):
+        """An AdobeVendorIDController for the current Vendor ID
+        configuration, or None if there is no Vendor ID configuration.
+
+        The controller is replaced whenever the configuration changes,
+        so a change made with ConfigureVendorIDScript takes effect
+        without restarting the app.
+        """
+        configuration = Configuration.vendor_id(self._db)
+        vendor_id, node_value, delegates = configuration
+        if not vendor_id:
+            return None
+        cached = self._adobe_vendor_id
+        if cached is None or cached[0] != configuration:
+            cached = (
+                configuration,
+                AdobeVendorIDController(
+                    self._db, vendor_id, node_value, delegates
+                )
             )
-        else:
-            self.adobe_vendor_id = None
+            self._adobe_vendor_id = cached
+        return cached[1]
 
     def url_for(self, view, *args, **kwargs):
         kwargs['_external'] = True
@@ -172,19 +195,53 @@ class LibraryRegistryController(BaseController):
         super(LibraryRegistryController, self).__init__(app)
         self.annotator = LibraryRegistryAnnotator(app)
         self.log = self.app.log
-        emailer = None
+        self.emailer_class = emailer_class
+
+    @property
+    def emailer(self):
+        """An Emailer for the current email configuration, or None if
+        email isn't configured.
+
+        The configuration is cached until it changes, so this is cheap
+        to call for every request, and a change made with
+        ConfigureEmailerScript takes effect without restarting the app.
+        """
         try:
-            emailer = emailer_class.from_sitewide_integration(self._db)
+            return self.emailer_class.from_sitewide_integration(self._db)
         except CannotLoadConfiguration as e:
             self.log.error(
                 "Cannot load email configuration. Will not be sending any emails.",
                 exc_info=e
             )
-        self.emailer = emailer
+            return None
+
+    def feed_etag(self, *variables):
+        """Find the ETag for an OPDS feed served in response to the
+        current request.
+
+        There's no Last-Modified date to go with it: some of the
+        things that go into a feed, like the sitewide configuration,
+        don't record when they changed.
+
+        :param variables: Anything besides the request itself that
+            affects what goes into the feed, such as the client's
+            location.
+        """
+        version = Library.feed_version(self._db)
+        key = repr(
+            (version, flask.request.url,
+             flask.request.headers.get('Accept-Language')) + variables
+        )
+        etag = hashlib.sha1(key.encode("utf8")).hexdigest()
+        return etag
 
     def nearby(self, location, live=True):
-        qu = Library.nearby(self._db, location, production=live)
-        qu = qu.limit(5)
+        etag = self.feed_etag(location, live)
+        not_modified = not_modified_response(etag)
+        if not_modified:
+            return not_modified
+
+        qu = Library.nearby(self._db, location, production=live, limit=5)
         if live:
             nearby_controller = 'nearby'
         else:
@@ -194,7 +251,7 @@ class LibraryRegistryController(BaseController):
             self._db, str(_("Libraries near you")), this_url, qu,
             annotator=self.annotator, live=live
         )
-        return catalog_response(catalog)
+        return catalog_response(catalog, etag=etag)
 
     def search(self, location, live=True):
         query = flask.request.args.get('q')
@@ -203,6 +260,11 @@ class LibraryRegistryController(BaseController):
         else:
             search_controller = 'search_qa'
         if query:
+            etag = self.feed_etag(location, live)
+            not_modified = not_modified_response(etag)
+            if not_modified:
+                return not_modified
+
             # Run the query and send the results.
             results = Library.search(
                 self._db, location, query, production=live
@@ -216,7 +278,9 @@ class LibraryRegistryController(BaseController):
                 this_url, results,
                 annotator=self.annotator, live=live
             )
-            return catalog_response(catalog)
+            return catalog_response(
+                catalog, etag=etag
+            )
         else:
             # Send the search form.
             body = self.OPENSEARCH_TEMPLATE % dict(
@@ -256,6 +320,11 @@ class LibraryRegistryController(BaseController):
         :param location: If this is set, then libraries near this point will be
            promoted out of the alphabetical list.
         """
+        etag = self.feed_etag(location, live)
+        not_modified = not_modified_response(etag)
+        if not_modified:
+            return not_modified
+
         alphabetical = self._db.query(Library).order_by(Library.name)
 
         # We always want to filter out cancelled libraries.  If live, we also filter out
@@ -287,8 +356,8 @@ class LibraryRegistryController(BaseController):
             # but it won't return more than five results.
             a = time.time()
             nearby_libraries = Library.nearby(
-                self._db, location, production=live
-            ).limit(5).all()
+                self._db, location, production=live, limit=5
+            ).all()
             b = time.time()
             self.log.info("Fetched libraries near %s in %.2fsec" % (location, b-a))
 
@@ -309,7 +378,7 @@ class LibraryRegistryController(BaseController):
         )
         b = time.time()
         self.log.info("Built library catalog in %.2fsec" % (b-a))
-        return catalog_response(catalog)
+        return catalog_response(catalog, etag=etag)
 
     def library_details(self, uuid, library=None):
         # Return complete information about one specific library.
@@ -410,8 +479,12 @@ class LibraryRegistryController(BaseController):
         registry_stage = flask.request.form.get("Registry Stage")
         library_stage = flask.request.form.get("Library Stage")
 
+        old_stages = (library._library_stage, library.registry_stage)
         library._library_stage = library_stage
         library.registry_stage = registry_stage
+        if (library_stage, registry_stage) != old_stages:
+            # A library's stage is shown on the vector tiles.
+            ServiceArea.bump_generation(self._db)
         return Response(str(library.internal_urn), 200)
 
     def add_or_edit_pls_id(self):
@@ -447,6 +520,11 @@ class LibraryRegistryController(BaseController):
 
     def library(self):
         library = flask.request.library
+        etag = self.feed_etag()
+        not_modified = not_modified_response(etag)
+        if not_modified:
+            return not_modified
+
         this_url = self.app.url_for(
             'library', uuid=library.internal_urn
         )
@@ -455,7 +533,7 @@ class LibraryRegistryController(BaseController):
             this_url, [library],
             annotator=self.annotator, live=False,
         )
-        return catalog_response(catalog)
+        return catalog_response(catalog, etag=etag)
 
     def render(self):
         response = Response(flask.render_template_string(
@@ -546,6 +624,36 @@ class LibraryRegistryController(BaseController):
         if isinstance(integration_contact_email, ProblemDetail):
             return integration_contact_email
 
+        reset_shared_secret = flask.request.form.get(
+            "reset_shared_secret", False
+        )
+
+        if self.registers_asynchronously:
+            return self.queue_registration(
+                auth_url, integration_contact_email, shared_secret,
+                library_stage, reset_shared_secret
+            )
+
+        result = self.process_registration(
+            auth_url, integration_contact_email, shared_secret,
+            library_stage, reset_shared_secret, do_get=do_get
+        )
+        if isinstance(result, ProblemDetail):
+            return result
+        catalog, status_code = result
+        return self.catalog_response(catalog, status_code)
+
+    def process_registration(self, auth_url, integration_contact_email,
+                             shared_secret, library_stage,
+                             reset_shared_secret, do_get=HTTP.debuggable_get):
+        """Register a library, or re-register a library that's already
+        registered.
+
+        This must be run inside a Flask request context, so that
+        URLs can be generated.
+
+        :return: A ProblemDetail, or a 2-tuple (catalog, status code).
+        """
         # Registration is a complex multi-step process. Start a subtransaction
         # so we can back out of the whole thing if any part of it fails.
         __transaction = self._db.begin_nested()
@@ -622,14 +730,11 @@ class LibraryRegistryController(BaseController):
                 (Hyperlink.INTEGRATION_CONTACT_REL, [integration_contact_email])
             )
 
-        reset_shared_secret = False
-        if elevated_permissions:
-            # If you have elevated permissions you may ask for the
-            # shared secret to be reset.
-            reset_shared_secret = flask.request.form.get(
-                "reset_shared_secret", False
-            )
-
+        if not elevated_permissions:
+            # Only if you have elevated permissions may you ask for
+            # the shared secret to be reset.
+            reset_shared_secret = False
+        else:
             if library.opds_url != opds_url:
                 # The library's OPDS URL has changed, e.g. moved from
                 # HTTP to HTTPS. Since we have elevated permissions,
@@ -689,7 +794,96 @@ class LibraryRegistryController(BaseController):
             status_code = 201
         else:
             status_code = 200
-        return self.catalog_response(catalog, status_code)
+        return catalog, status_code
+
+    @property
+    def registers_asynchronously(self):
+        """Should the current registration request be queued up instead
+        of being carried out immediately?
+
+        This only happens if the client asks for it with "Prefer:
+        respond-async" (RFC 7240) and the registry is configured to
+        allow it.
+        """
+        prefer = flask.request.headers.get("Prefer") or ""
+        preferences = [
+            x.split(";", 1)[0].strip().lower() for x in prefer.split(",")
+        ]
+        if "respond-async" not in preferences:
+            return False
+        return bool(ConfigurationSetting.sitewide(
+            self._db, Configuration.ASYNCHRONOUS_REGISTRATION
+        ).bool_value)
+
+    def queue_registration(self, auth_url, integration_contact_email,
+                           shared_secret, library_stage,
+                           reset_shared_secret):
+        """Queue up a registration request to be processed later by
+        RegistrationWorkerScript.
+
+        :return: A 202 response pointing to the registration status URL.
+        """
+        job, ignore = create(
+            self._db, RegistrationJob,
+            authentication_url=auth_url,
+            contact=integration_contact_email,
+            shared_secret=shared_secret,
+            library_stage=library_stage,
+            reset_shared_secret=bool(reset_shared_secret),
+            base_url=flask.request.url_root,
+        )
+        self.log.info("Queued registration of %s as %r", auth_url, job)
+        return self.registration_job_response(job)
+
+    def registration_job_response(self, job):
+        """Describe a registration that hasn't finished yet."""
+        status_url = self.app.url_for("registration_status", key=job.key)
+        document = dict(status=job.state)
+        OPDSCatalog.add_link_to_catalog(
+            document, rel="monitor", href=status_url, type="application/json"
+        )
+        headers = {
+            "Content-Type": "application/json",
+            "Location": status_url,
+        }
+        return Response(json.dumps(document), 202, headers=headers)
+
+    def registration_status(self, key):
+        """Check on a queued registration.
+
+        :return: A 202 response if the registration hasn't been
+            processed yet; otherwise the response the client would
+            have received if the registration had been processed
+            immediately.
+        """
+        job = get_one(self._db, RegistrationJob, key=key)
+        if not job:
+            return REGISTRATION_JOB_NOT_FOUND
+        if job.state != RegistrationJob.COMPLETE:
+            return self.registration_job_response(job)
+        headers = {"Content-Type": job.media_type}
+        return Response(job.response, job.status_code, headers=headers)
+
+    def run_registration_job(self, job, do_get=HTTP.debuggable_get):
+        """Carry out a queued registration and store the outcome in
+        the RegistrationJob.
+
+        Like process_registration, this must be run inside a Flask
+        request context.
+        """
+        result = self.process_registration(
+            job.authentication_url, job.contact, job.shared_secret,
+            job.library_stage, job.reset_shared_secret, do_get=do_get
+        )
+        if isinstance(result, ProblemDetail):
+            document, status_code, headers = result.response
+            media_type = headers["Content-Type"]
+        else:
+            catalog, status_code = result
+            document = json.dumps(catalog)
+            media_type = OPDS_CATALOG_REGISTRATION_MEDIA_TYPE
+        job.complete(status_code, media_type, document)
+        return job
 
 
 class ValidationController(BaseController):
@@ -767,9 +961,27 @@ class CoverageController(BaseController):
         if isinstance(document, dict):
             document = json.dumps(document)
         headers = {"Content-Type": "application/geo+json"}
-        return Response(document, 200, headers=headers)
+        response = Response(document, 200, headers=headers)
+        response.add_etag()
+        return response.make_conditional(flask.request)
+
+    def resolution(self):
+        """Find the resolution the client wants the GeoJSON in."""
+        resolution = flask.request.args.get(
+            'resolution', Place.FULL_RESOLUTION
+        )
+        if resolution not in Place.GEOJSON_RESOLUTIONS:
+            return INVALID_INPUT.detailed(
+                _("Unknown resolution: %(resolution)s. Use one of: %(resolutions)s",
+                  resolution=resolution,
+                  resolutions=", ".join(sorted(Place.GEOJSON_RESOLUTIONS)))
+            )
+        return resolution
 
     def lookup(self):
+        resolution = self.resolution()
+        if isinstance(resolution, ProblemDetail):
+            return resolution
         coverage = flask.request.args.get('coverage')
         try:
             coverage = json.loads(coverage)
@@ -778,24 +990,56 @@ class CoverageController(BaseController):
         places, unknown, ambiguous = AuthenticationDocument.parse_coverage(
             self._db, coverage
         )
-        document = Place.to_geojson(self._db, *places)
 
         # Extend the GeoJSON with extra information about parts of the
         # coverage document we found ambiguous or couldn't associate
         # with a Place.
+        extensions = {}
         if unknown:
-            document['unknown'] = unknown
+            extensions['unknown'] = unknown
         if ambiguous:
-            document['ambiguous'] = ambiguous
+            extensions['ambiguous'] = ambiguous
+        document = Place.geojson(self._db, places, resolution, **extensions)
         return self.geojson_response(document)
 
     def _geojson_for_service_area(self, service_type):
         """Serve a GeoJSON document describing some subset of the active
         library's service areas.
         """
+        resolution = self.resolution()
+        if isinstance(resolution, ProblemDetail):
+            return resolution
         areas = [x.place for x in flask.request.library.service_areas
                  if x.type==service_type]
-        return self.geojson_response(Place.to_geojson(self._db, *areas))
+        return self.geojson_response(
+            Place.geojson(self._db, areas, resolution)
+        )
+
+    # Keep this many bytes of vector tiles in memory.
+    TILE_CACHE_SIZE = 32 * 1024 * 1024
+    MAX_ZOOM = 22
+    VECTOR_TILE_MEDIA_TYPE = "application/vnd.mapbox-vector-tile"
+
+    # Maps (z, x, y) to (service area generation, tile).
+    _tiles = LRUCache(TILE_CACHE_SIZE, sizeof=lambda item: len(item[1]))
+
+    def tile(self, z, x, y):
+        """Serve a Mapbox Vector Tile showing libraries' service areas."""
+        if not (0 <= z <= self.MAX_ZOOM and 0 <= x < 2**z and 0 <= y < 2**z):
+            return INVALID_INPUT.detailed(
+                _("There is no tile %(z)s/%(x)s/%(y)s.", z=z, x=x, y=y)
+            )
+        generation = ServiceArea.generation(self._db)
+        cached = self._tiles.get((z, x, y))
+        if cached is not None and cached[0] == generation:
+            data = cached[1]
+        else:
+            data = ServiceArea.vector_tile(self._db, z, x, y)
+            self._tiles.set((z, x, y), (generation, data))
+        headers = {"Content-Type": self.VECTOR_TILE_MEDIA_TYPE}
+        response = Response(data, 200, headers=headers)
+        response.add_etag()
+        return response.make_conditional(flask.request)
 
     def eligibility_for_library(self):
         """Serve a GeoJSON document representing the eligibility area
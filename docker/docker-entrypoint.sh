@@ -57,6 +57,15 @@ until [ -n "$PG_READY" ] || [ $COUNT -gt $RETRIES ]; do
     fi
 done
 
+##############################################################################
+# Bring the database schema up to date once, so the web workers don't each
+# have to do it when they start
+##############################################################################
+
+if [ -n "$PG_READY" ]; then
+    (cd /simplye_app && pipenv run python bin/initialize_database) || exit 1
+fi
+
 ##############################################################################
 # Start the Supervisor process that manages Nginx and Gunicorn, with
 # a webpack file watcher for the front end if we're in dev mode.
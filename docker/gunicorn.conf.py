@@ -15,7 +15,7 @@ loglevel = "info"
 limit_request_line = 4094   # max size of HTTP request line, in bytes
 limit_request_fields = 100  # max number of header fields allowed in a request
 limit_request_field_size = 8190  # allowed size of a single HTTP header field
-preload_app = False         # defer app load till after worker start
+preload_app = True          # load the app once, before forking the workers
 chdir = os.environ.get("LIBREG_HOME", "/simplye_app")  # change to this dir before loading apps
 daemon = False              # Don't background the process
 user = "nginx"
@@ -34,3 +34,17 @@ if os.environ.get('FLASK_ENV', None) == 'development':
     reload = True       # restart workers when app code changes
     loglevel = "debug"  # default loglevel is 'info'
     workers = 1         # single worker for local dev
+    preload_app = False  # code reloading only works if each worker loads the app
+
+
+# A preloaded app is imported by the master process, which only needs
+# the parts that are safe to share. Each worker builds the rest for
+# itself in post_fork().
+if preload_app:
+    os.environ["LIBRARY_REGISTRY_DEFER_WORKER_INITIALIZATION"] = "True"
+
+
+def post_fork(server, worker):
+    if server.cfg.preload_app:
+        from app import initialize_worker
+        initialize_worker()
@@ -2,6 +2,7 @@ from email.header import Header
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email import charset
+import datetime
 import email
 import smtplib
 
@@ -13,6 +14,7 @@ charset.add_charset('utf-8', charset.QP, charset.QP, 'utf-8')
 
 from config import (
     CannotLoadConfiguration,
+    Configuration,
 )
 
 
@@ -25,6 +27,15 @@ class Emailer(object):
     FROM_ADDRESS = 'from_address'
     FROM_NAME = 'from_name'
 
+    # If this setting is true, emails are stored in the database
+    # (see model.OutgoingEmail) and sent later by
+    # bin/send_queued_email, instead of being sent immediately.
+    USE_OUTBOX = 'use_outbox'
+
+    # When sending queued email, send at most this many messages over
+    # a single SMTP connection.
+    DEFAULT_BATCH_SIZE = 100
+
     DEFAULT_FROM_NAME = 'Library Simplified registry support'
 
     # Constants for different types of email.
@@ -76,11 +87,24 @@ The link will expire in about a day. If the link expires, just re-register your
 
         :param _db: A database connection
         """
+        configuration = Configuration.cached(
+            _db, ("emailer", cls), cls._sitewide_configuration
+        )
+        kwargs = dict(configuration)
+        kwargs['templates'] = dict(configuration['templates'])
+        return cls(_db=_db, **kwargs)
+
+    @classmethod
+    def _sitewide_configuration(cls, _db):
+        """Load the arguments to the Emailer constructor from the
+        site-wide email integration.
+        """
         integration = cls._sitewide_integration(_db)
         host = integration.url
         port = integration.setting(cls.PORT).int_value or 587
         from_address = integration.setting(cls.FROM_ADDRESS).value
         from_name = integration.setting(cls.FROM_NAME).value or cls.DEFAULT_FROM_NAME
+        use_outbox = bool(integration.setting(cls.USE_OUTBOX).bool_value)
 
         email_templates = {}
         for email_type in cls.EMAIL_TYPES:
@@ -95,11 +119,12 @@ The link will expire in about a day. If the link expires, just re-register your
             template = EmailTemplate(subject, body)
             email_templates[email_type] = template
 
-        return cls(smtp_username=integration.username,
-                   smtp_password=integration.password,
-                   smtp_host=host, smtp_port=port, from_name=from_name,
-                   from_address=from_address,
-                   templates=email_templates)
+        return dict(smtp_username=integration.username,
+                    smtp_password=integration.password,
+                    smtp_host=host, smtp_port=port, from_name=from_name,
+                    from_address=from_address,
+                    templates=email_templates,
+                    use_outbox=use_outbox)
 
     @classmethod
     def _sitewide_integration(cls, _db):
@@ -126,8 +151,15 @@ The link will expire in about a day. If the link expires, just re-register your
         return integration
 
     def __init__(self, smtp_username, smtp_password, smtp_host, smtp_port,
-                 from_name, from_address, templates):
-        """Constructor."""
+                 from_name, from_address, templates, _db=None,
+                 use_outbox=False):
+        """Constructor.
+
+        :param _db: A database connection, used to queue email if
+            `use_outbox` is true.
+        :param use_outbox: If this is true, send() will queue emails
+            in the database instead of sending them immediately.
+        """
         if not smtp_username:
             raise CannotLoadConfiguration("No SMTP username specified")
         self.smtp_username = smtp_username
@@ -147,6 +179,12 @@ The link will expire in about a day. If the link expires, just re-register your
         self.from_name = from_name
         self.from_address = from_address
         self.templates = templates
+        if use_outbox and not _db:
+            raise CannotLoadConfiguration(
+                "Cannot queue email without a database connection"
+            )
+        self._db = _db
+        self.use_outbox = use_outbox
 
         # Make sure the templates don't contain any template values we
         # can't handle.
@@ -183,17 +221,97 @@ The link will expire in about a day. If the link expires, just re-register your
         kwargs['from_address'] = self.from_address
         kwargs['to_address'] = to_address
         body = template.body(from_header, to_address, **kwargs)
+        if self.use_outbox and not smtp:
+            return self._queue_email(to_address, body)
         return self._send_email(to_address, body, smtp)
 
-    def _send_email(self, to_address, body, smtp=None):
-        """Actually send an email."""
-        smtp = smtp or smtplib.SMTP()
+    def _queue_email(self, to_address, body):
+        """Store an email in the database, to be sent later by
+        send_queued().
+        """
+        from model import (
+            OutgoingEmail,
+            create,
+        )
+        outgoing, ignore = create(
+            self._db, OutgoingEmail, to_address=to_address, body=body
+        )
+        return outgoing
+
+    def _connect(self, smtp):
+        """Open an authenticated SMTP session."""
         smtp.connect(self.smtp_host, self.smtp_port)
+        # When we reconnect, `smtp` still remembers the server's
+        # greeting from the old connection, so greet the server
+        # explicitly instead of letting starttls() rely on it.
+        smtp.ehlo()
         smtp.starttls()
         smtp.login(self.smtp_username, self.smtp_password)
+
+    def _send_email(self, to_address, body, smtp=None):
+        """Actually send an email."""
+        smtp = smtp or smtplib.SMTP()
+        self._connect(smtp)
         smtp.sendmail(self.from_address, to_address, body)
         smtp.quit()
 
+    def send_queued(self, _db, batch_size=DEFAULT_BATCH_SIZE, smtp=None,
+                    now=None):
+        """Send queued emails over a single SMTP session.
+
+        An email that can't be sent is scheduled to be retried later.
+
+        :param batch_size: Send at most this many emails.
+        :param smtp: Use this object as a mock instead of creating an
+            smtplib.SMTP object.
+        :return: A 2-tuple (number of emails sent, number of
+            emails that failed).
+        """
+        from model import OutgoingEmail
+        now = now or datetime.datetime.utcnow()
+        emails = OutgoingEmail.ready(_db, now).limit(batch_size).all()
+        if not emails:
+            return 0, 0
+
+        smtp = smtp or smtplib.SMTP()
+        try:
+            self._connect(smtp)
+        except (smtplib.SMTPException, OSError) as e:
+            # We can't send any email right now.
+            for outgoing in emails:
+                outgoing.failed(e, now)
+            return 0, len(emails)
+
+        sent = failed = 0
+        connected = True
+        for outgoing in emails:
+            try:
+                if not connected:
+                    # The server hung up on us partway through the
+                    # batch. Try once to reconnect.
+                    self._connect(smtp)
+                    connected = True
+                smtp.sendmail(self.from_address, outgoing.to_address, outgoing.body)
+            except (smtplib.SMTPException, OSError) as e:
+                outgoing.failed(e, now)
+                failed += 1
+                if isinstance(e, (smtplib.SMTPServerDisconnected, OSError)):
+                    if not connected:
+                        # Reconnecting didn't work; give up on this
+                        # batch and leave the rest for next time.
+                        break
+                    connected = False
+                continue
+            outgoing.sent = now
+            sent += 1
+
+        if connected:
+            try:
+                smtp.quit()
+            except smtplib.SMTPException:
+                pass
+        return sent, failed
+
 
 class EmailTemplate(object):
     """A template for email messages."""
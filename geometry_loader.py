@@ -51,12 +51,13 @@ class GeometryLoader(object):
             create_method_kwargs = dict(geometry=geometry)
         )
 
-        # Set these values, even the ones that were set in
-        # create_method_kwargs, so that we can update any that have
-        # changed.
+        # Set these values so that we can update any that have
+        # changed. A new place already has its geometry, and setting
+        # it again would make the database summarize it twice.
         place.external_name = name
         place.abbreviated_name = abbreviated_name
-        place.geometry = geometry
+        if not is_new:
+            place.geometry = geometry
 
         # We only ever add aliases. If the database contains an alias
         # for this place that doesn't show up in the metadata, it
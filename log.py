@@ -1,18 +1,41 @@
+import atexit
+import copy
 import datetime
 import logging
+from logging.handlers import (
+    QueueHandler,
+    QueueListener,
+)
 import json
 import os
+import queue
 import socket
-from config import Configuration
+import threading
+import time
+import requests
+from config import (
+    CannotLoadConfiguration,
+    Configuration,
+)
 from io import StringIO
-from loggly.handlers import HTTPSHandler as LogglyHandler
 
 
 class JSONFormatter(logging.Formatter):
-    hostname = socket.gethostname()
-    fqdn = socket.getfqdn()
-    if len(fqdn) > len(hostname):
-        hostname = fqdn
+    _hostname = None
+
+    @classmethod
+    def hostname(cls):
+        """Find the name of this host. This can mean a DNS lookup, so
+        it's only done the first time a message is formatted.
+        """
+        if cls._hostname is None:
+            hostname = socket.gethostname()
+            fqdn = socket.getfqdn()
+            if len(fqdn) > len(hostname):
+                hostname = fqdn
+            cls._hostname = hostname
+        return cls._hostname
+
     def format(self, record):
         message = record.msg
         if record.args:
@@ -21,7 +44,7 @@ class JSONFormatter(logging.Formatter):
             except TypeError as e:
                 raise e
         data = dict(
-            host=self.hostname,
+            host=self.hostname(),
             app="simplified",
             name=record.name,
             level=record.levelname,
@@ -31,6 +54,9 @@ class JSONFormatter(logging.Formatter):
         )
         if record.exc_info:
             data['traceback'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            # The traceback was formatted before the record was queued.
+            data['traceback'] = record.exc_text
         return json.dumps(data)
 
 
@@ -45,6 +71,189 @@ class StringFormatter(logging.Formatter):
         return str(data)
 
 
+# Used to format tracebacks before log records are queued.
+_traceback_formatter = logging.Formatter()
+
+
+class BoundedQueueHandler(QueueHandler):
+    """Put log records on a queue to be handled by another thread.
+
+    If the queue is full, the record is dropped rather than making the
+    thread that logged it wait.
+    """
+
+    def __init__(self, queue):
+        super(BoundedQueueHandler, self).__init__(queue)
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+
+    def prepare(self, record):
+        """Make a copy of the record that's safe to hand to another
+        thread.
+
+        The message is put together here, because its arguments may
+        be objects that only this thread can safely look at. Turning
+        the record into JSON, and sending it anywhere, is left to
+        the other thread.
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _traceback_formatter.formatException(
+                    record.exc_info
+                )
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+
+class LogListener(QueueListener):
+    """Take log records off a queue and pass them to the handlers
+    that will actually write or send them.
+
+    Every `flush_interval` seconds, whether or not records are still
+    arriving, the handlers are flushed so that a handler that sends
+    records in batches doesn't hold on to them for too long, and a
+    warning is logged if any records were dropped because the queue
+    was full.
+    """
+
+    FLUSH_INTERVAL = 5
+
+    # When stopping, wait this many seconds for room on the queue.
+    STOP_TIMEOUT = 10
+
+    def __init__(self, queue_handler, *handlers,
+                 flush_interval=FLUSH_INTERVAL):
+        super(LogListener, self).__init__(
+            queue_handler.queue, *handlers, respect_handler_level=True
+        )
+        self.queue_handler = queue_handler
+        self.flush_interval = flush_interval
+        self._reported_drops = 0
+        self._last_flush = time.monotonic()
+
+    def dequeue(self, block):
+        if not block:
+            return self.queue.get(block)
+        while True:
+            timeout = self._last_flush + self.flush_interval - time.monotonic()
+            if timeout <= 0:
+                self.flush()
+                continue
+            try:
+                return self.queue.get(timeout=timeout)
+            except queue.Empty:
+                pass
+
+    def enqueue_sentinel(self):
+        # Unlike a log record, the sentinel can't be dropped when the
+        # queue is full, or the listener thread would never stop.
+        self.queue.put(self._sentinel, timeout=self.STOP_TIMEOUT)
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        dropped = self.queue_handler.dropped
+        if dropped > self._reported_drops:
+            self.handle(logging.makeLogRecord(dict(
+                name="Log listener", levelno=logging.WARN,
+                levelname=logging.getLevelName(logging.WARN),
+                msg="The log queue was full; %d log records were dropped." % (
+                    dropped - self._reported_drops
+                ),
+            )))
+            self._reported_drops = dropped
+        for handler in self.handlers:
+            handler.flush()
+
+    def stop(self):
+        try:
+            super(LogListener, self).stop()
+        except queue.Full:
+            # The listener thread isn't taking records off the queue.
+            # It's a daemon thread, so leave it to die with the
+            # process rather than touching the handlers it's using.
+            self._thread = None
+            return
+        self.flush()
+        for handler in self.handlers:
+            handler.close()
+
+
+class LogglyHandler(logging.Handler):
+    """Send log records to Loggly in batches.
+
+    This is meant to run on a LogListener's thread: sending a batch
+    means waiting on the network.
+    """
+
+    BATCH_SIZE = 100
+    TIMEOUT = 5
+
+    def __init__(self, url, batch_size=BATCH_SIZE, session=None):
+        super(LogglyHandler, self).__init__()
+        self.url = url
+        self.batch_size = batch_size
+        # Reusing one session keeps a connection to Loggly open
+        # between batches.
+        self.session = session or requests.Session()
+        self.buffer = []
+        self.sent = 0
+        self.dropped = 0
+
+    @property
+    def bulk_url(self):
+        """The URL to send a batch of records to.
+
+        A Loggly URL is usually configured for sending one record at
+        a time; the bulk endpoint takes many at once, one per line.
+        """
+        return self.url.replace("/inputs/", "/bulk/", 1)
+
+    def emit(self, record):
+        try:
+            self.buffer.append(self.format(record))
+        except Exception:
+            self.handleError(record)
+            return
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        self.acquire()
+        try:
+            batch, self.buffer = self.buffer, []
+            if not batch:
+                return
+            try:
+                response = self.session.post(
+                    self.bulk_url, data="\n".join(batch).encode("utf8"),
+                    headers={"Content-Type": "text/plain"},
+                    timeout=self.TIMEOUT,
+                )
+                response.raise_for_status()
+                self.sent += len(batch)
+            except Exception:
+                # Give up on this batch. Holding on to it until Loggly
+                # comes back could use up all our memory.
+                self.dropped += len(batch)
+        finally:
+            self.release()
+
+    def close(self):
+        self.flush()
+        self.session.close()
+        super(LogglyHandler, self).close()
+
+
 class LogConfiguration(object):
     """Configures the active Python logging handlers based on logging
     configuration from the database.
@@ -61,6 +270,15 @@ class LogConfiguration(object):
     JSON_LOG_FORMAT = 'json'
     TEXT_LOG_FORMAT = 'text'
 
+    # At most this many log records can be waiting to be written or
+    # sent. Any more are dropped.
+    QUEUE_SIZE = 10000
+
+    # The LogListener currently handling log records for this process,
+    # and the ID of the process that started it.
+    _listener = None
+    _listener_pid = None
+
     # Settings for the integration with protocol=INTERNAL_LOGGING
     LOG_LEVEL = 'log_level'
     LOG_FORMAT = 'log_format'
@@ -82,6 +300,19 @@ class LogConfiguration(object):
             cls.from_configuration(_db, testing)
         )
 
+        # Writing and sending log records is done by a separate
+        # thread, so that logging never makes the caller wait. During
+        # unit tests, it's more useful for log messages to show up
+        # immediately.
+        old_listener = (cls._listener, cls._listener_pid)
+        cls._listener = cls._listener_pid = None
+        if not testing:
+            queue_handler = BoundedQueueHandler(queue.Queue(cls.QUEUE_SIZE))
+            cls._listener = LogListener(queue_handler, *new_handlers)
+            cls._listener_pid = os.getpid()
+            cls._listener.start()
+            new_handlers = [queue_handler]
+
         # Replace the set of handlers associated with the root logger.
         logger = logging.getLogger()
         logger.setLevel(log_level)
@@ -91,6 +322,10 @@ class LogConfiguration(object):
         for handler in old_handlers:
             logger.removeHandler(handler)
 
+        # Now that nothing is adding records to the old queue, the old
+        # listener can finish up.
+        cls._stop_listener(*old_listener)
+
         # Set the loggers for various verbose libraries to the database
         # log level, which is probably higher than the normal log level.
         for logger in (
@@ -111,6 +346,22 @@ class LogConfiguration(object):
             logging.getLogger(logger).setLevel(loop_prevention_log_level)
         return log_level
 
+    @classmethod
+    def stop_listener(cls):
+        """Stop handling log records in the background, once any
+        records that are already waiting have been handled.
+        """
+        listener, pid = cls._listener, cls._listener_pid
+        cls._listener = cls._listener_pid = None
+        cls._stop_listener(listener, pid)
+
+    @classmethod
+    def _stop_listener(cls, listener, pid):
+        if listener and pid == os.getpid():
+            listener.stop()
+        # Otherwise the listener was started before this process was
+        # forked, and its thread only exists in the parent process.
+
     @classmethod
     def from_configuration(cls, _db, testing=False):
         """Return the logging policy as configured in the database.
@@ -217,7 +468,7 @@ class LogConfiguration(object):
         try:
             url = cls._interpolate_loggly_url(url, token)
         except (TypeError, KeyError) as e:
-            raise CannotLoadConfiguraiton(
+            raise CannotLoadConfiguration(
                 "Cannot interpolate token %s into loggly URL %s" % (
                     token, url,
                 )
@@ -234,3 +485,5 @@ class LogConfiguration(object):
         # Assume the token is already in the URL.
         return url
 
+
+atexit.register(LogConfiguration.stop_listener)
@@ -1,11 +1,18 @@
-from collections import defaultdict
+from collections import (
+    defaultdict,
+    namedtuple,
+)
 from config import Configuration
 from flask_babel import lazy_gettext as _
 from flask_bcrypt import (
     check_password_hash,
     generate_password_hash
 )
+import csv
 import datetime
+import hashlib
+import io
+import itertools
 import logging
 
 import os
@@ -17,6 +24,8 @@ import uszipcode
 import uuid
 import warnings
 from collections import Counter
+import concurrent.futures
+import threading
 from psycopg2.extensions import adapt as sqlescape
 from sqlalchemy import (
     Binary,
@@ -24,6 +33,7 @@ from sqlalchemy import (
     Column,
     DateTime,
     Enum,
+    Float,
     ForeignKey,
     Index,
     Integer,
@@ -33,6 +43,8 @@ from sqlalchemy import (
 )
 from sqlalchemy import (
     create_engine,
+    event,
+    inspect,
     exc as sa_exc,
     func,
     or_,
@@ -50,6 +62,8 @@ from sqlalchemy.ext.hybrid import (
 from sqlalchemy.orm import (
     aliased,
     backref,
+    deferred,
+    load_only,
     relationship,
     sessionmaker,
     validates,
@@ -62,16 +76,20 @@ from sqlalchemy.orm.session import Session
 from sqlalchemy.sql import compiler
 from sqlalchemy.sql.expression import (
     cast,
+    literal,
     literal_column,
     or_,
     and_,
     case,
+    exists,
     select,
     join,
     outerjoin,
 )
 from sqlalchemy.ext.hybrid import hybrid_property
 
+from sqlalchemy.dialects import postgresql
+
 from geoalchemy2 import Geography, Geometry
 
 from emailer import Emailer
@@ -79,6 +97,7 @@ from util.language import LanguageCodes
 from util import (
     GeometryUtility,
 )
+from util.lru import LRUCache
 from util.short_client_token import ShortClientTokenTool
 from util.string_helpers import random_string
 
@@ -106,12 +125,25 @@ def generate_secret():
 
 class SessionManager(object):
 
+    # Each process has one engine (and one connection pool) per
+    # database URL.
     engine_for_url = {}
 
+    # The URLs whose schema has been brought up to date by this process.
+    initialized_urls = set()
+
     @classmethod
     def engine(cls, url=None):
         url = url or Configuration.database_url()
-        return create_engine(url, echo=DEBUG)
+        engine = cls.engine_for_url.get(url)
+        if engine is None:
+            engine = create_engine(
+                url, echo=DEBUG, **Configuration.database_engine_arguments()
+            )
+            event.listen(engine, "connect", cls._record_connection_pid)
+            event.listen(engine, "checkout", cls._check_connection_pid)
+            cls.engine_for_url[url] = engine
+        return engine
 
     @classmethod
     def sessionmaker(cls, url=None):
@@ -119,18 +151,190 @@ class SessionManager(object):
         return sessionmaker(bind=engine)
 
     @classmethod
-    def initialize(cls, url):
-        if url in cls.engine_for_url:
-            engine = cls.engine_for_url[url]
-            return engine, engine.connect()
-
+    def initialize(cls, url, initialize_schema=True):
+        """Get an engine and a connection for the given database.
+
+        :param initialize_schema: If this is True, the first call for
+            a given URL creates any missing tables and indexes. If it's
+            False, the schema is assumed to have been set up already
+            (by InitializeDatabaseScript) and is only checked against
+            the version stamp, which takes one small query. If the
+            stamp doesn't match, the schema is initialized anyway.
+        """
         engine = cls.engine(url)
+        if url not in cls.initialized_urls:
+            if initialize_schema or not cls.schema_is_current(engine):
+                cls.initialize_schema(engine)
+            cls.initialized_urls.add(url)
+        return engine, engine.connect()
 
-        Base.metadata.create_all(engine)
+    @classmethod
+    def initialize_schema(cls, bind):
+        """Create any missing tables and columns and record that the
+        schema is up to date.
+
+        Indexes added to existing tables aren't created here, since
+        that would lock the tables while the web application is
+        starting up. InitializeDatabaseScript creates them afterwards
+        (see create_missing_indexes).
+        """
+        Base.metadata.create_all(bind)
+        cls.add_missing_columns(bind)
+        SchemaVersion.stamp(bind, cls.schema_version())
 
+    @classmethod
+    def schema_version(cls):
+        """A fingerprint of the schema the current code expects.
 
-        cls.engine_for_url[url] = engine
-        return engine, engine.connect()
+        It changes whenever a table, column or index is added,
+        removed or renamed, or a column changes type.
+        """
+        if cls._schema_version is None:
+            description = []
+            for table in sorted(Base.metadata.tables.values(),
+                                key=lambda t: t.name):
+                description.append(table.name)
+                for column in sorted(table.columns, key=lambda c: c.name):
+                    description.append(
+                        "%s %s" % (column.name, type(column.type).__name__)
+                    )
+                for index in sorted(table.indexes, key=lambda i: i.name):
+                    description.append(index.name)
+            cls._schema_version = hashlib.sha1(
+                "\n".join(description).encode("utf8")
+            ).hexdigest()
+        return cls._schema_version
+    _schema_version = None
+
+    @classmethod
+    def schema_is_current(cls, bind):
+        """Does the database's version stamp match this code?"""
+        try:
+            version = SchemaVersion.current(bind)
+        except sa_exc.ProgrammingError as e:
+            # The stamp table doesn't exist yet.
+            return False
+        if version != cls.schema_version():
+            logging.warning(
+                "Database schema version %s doesn't match %s; initializing the schema.",
+                version, cls.schema_version()
+            )
+            return False
+        return True
+
+    @classmethod
+    def dispose_all(cls):
+        """Close every idle connection in every pool."""
+        for engine in list(cls.engine_for_url.values()):
+            engine.dispose()
+
+    # A process must never use a database connection it inherited
+    # from its parent, since the parent may still be using it. Before
+    # forking, idle connections are closed, and any connection that
+    # was checked out at the time is thrown away the first time the
+    # child tries to use it.
+
+    @staticmethod
+    def _record_connection_pid(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @staticmethod
+    def _check_connection_pid(dbapi_connection, connection_record,
+                              connection_proxy):
+        pid = os.getpid()
+        if connection_record.info.get('pid', pid) != pid:
+            # Forget about the connection without closing it, so that
+            # the parent process can go on using it.
+            connection_record.connection = connection_proxy.connection = None
+            raise sa_exc.DisconnectionError(
+                "Connection belongs to process %s, not %s." % (
+                    connection_record.info['pid'], pid
+                )
+            )
+
+    @classmethod
+    def add_missing_columns(cls, engine):
+        """Add any columns that were added to tables after the tables
+        themselves were created.
+
+        This only works for columns that may be null and have no
+        server-side default. Existing rows get a null value.
+        """
+        inspector = inspect(engine)
+        existing_tables = set(inspector.get_table_names())
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing = set(
+                column['name'] for column in inspector.get_columns(table.name)
+            )
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                logging.info("Adding column %s.%s.", table.name, column.name)
+                engine.execute(
+                    'ALTER TABLE %s ADD COLUMN IF NOT EXISTS %s %s' % (
+                        table.name, column.name,
+                        column.type.compile(engine.dialect)
+                    )
+                )
+
+    @classmethod
+    def create_missing_indexes(cls, bind):
+        """Create any indexes that were added to tables after the tables
+        themselves were created. create_all() only creates indexes
+        along with brand new tables.
+
+        The indexes are built with CREATE INDEX CONCURRENTLY, so the
+        tables can still be written to in the meantime. That can't
+        happen inside a transaction, so this uses a connection of its
+        own. PostgreSQL waits for every transaction that's already
+        open to finish before it builds an index this way, so the
+        caller must not have one open.
+        """
+        engine = getattr(bind, 'engine', bind)
+        with engine.connect() as connection:
+            connection = connection.execution_options(
+                isolation_level="AUTOCOMMIT"
+            )
+            existing_tables = set(inspect(connection).get_table_names())
+            for table in Base.metadata.sorted_tables:
+                if table.name not in existing_tables:
+                    continue
+                # The inspector doesn't see indexes on expressions,
+                # or whether an index is valid, so ask PostgreSQL
+                # directly.
+                existing = dict(connection.execute(
+                    "SELECT index_class.relname, pg_index.indisvalid"
+                    " FROM pg_index"
+                    " JOIN pg_class index_class ON index_class.oid = pg_index.indexrelid"
+                    " JOIN pg_class table_class ON table_class.oid = pg_index.indrelid"
+                    " WHERE table_class.relname = %(table)s",
+                    dict(table=table.name)
+                ).fetchall())
+                for index in table.indexes:
+                    valid = existing.get(index.name)
+                    if valid:
+                        continue
+                    if valid is False:
+                        # An earlier attempt to build this index was
+                        # interrupted and left an unusable index behind.
+                        logging.info("Dropping invalid index %s.", index.name)
+                        connection.execute(
+                            'DROP INDEX CONCURRENTLY IF EXISTS "%s"' % index.name
+                        )
+                    logging.info("Creating index %s.", index.name)
+                    cls._create_index_concurrently(connection, index)
+
+    @staticmethod
+    def _create_index_concurrently(connection, index):
+        options = index.dialect_options['postgresql']
+        concurrently = options['concurrently']
+        options['concurrently'] = True
+        try:
+            index.create(connection)
+        finally:
+            options['concurrently'] = concurrently
 
     @classmethod
     def session(cls, url):
@@ -147,6 +351,10 @@ class SessionManager(object):
     def initialize_data(cls, session):
         pass
 
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=SessionManager.dispose_all)
+
+
 def get_one(db, model, on_multiple='error', **kwargs):
     q = db.query(model).filter_by(**kwargs)
     try:
@@ -514,6 +722,41 @@ class Library(Base):
                 registry_field.in_((prod, test))
             )
 
+    @classmethod
+    def feed_version(cls, _db, now=None):
+        """Find out what version of the libraries' OPDS feeds is current.
+
+        :return: A string that changes whenever anything that goes
+            into a feed might have changed: a library, its validated
+            contact addresses, its service areas, or the sitewide
+            configuration. Since a pending validation becomes
+            inactive when its deadline passes, without anything being
+            written to the database, the version also changes
+            whenever that happens.
+        """
+        now = now or datetime.datetime.utcnow()
+        expired_before = now - Validation.EXPIRES_AFTER
+        (timestamp, libraries, started, validated,
+         expired) = _db.execute(select([
+            select([func.max(Library.timestamp)]).as_scalar(),
+            select([func.count(Library.id)]).as_scalar(),
+            select([func.max(Validation.started_at)]).as_scalar(),
+            select([func.count(Validation.id)]).where(
+                Validation.success==True
+            ).as_scalar(),
+            select([func.count(Validation.id)]).where(
+                and_(Validation.success==False,
+                     Validation.started_at <= expired_before)
+            ).as_scalar(),
+        ])).fetchone()
+        version = "%s-%d-%s-%d-%d-%d-%d" % (
+            timestamp and timestamp.isoformat(), libraries,
+            started and started.isoformat(), validated, expired,
+            Configuration.configuration_generation(_db),
+            ServiceArea.generation(_db),
+        )
+        return version
+
     @classmethod
     def relevant(cls, _db, target, language, audiences=None, production=True):
         """Find libraries that are most relevant for a user.
@@ -734,7 +977,8 @@ class Library(Base):
         return c
 
     @classmethod
-    def nearby(cls, _db, target, max_radius=150, production=True):
+    def nearby(cls, _db, target, max_radius=150, production=True,
+               geography=True, limit=None):
         """Find libraries whose service areas include or are close to the
         given point.
 
@@ -744,10 +988,16 @@ class Library(Base):
             for a library's service area, in kilometers.
         :param production: If True, only libraries that are ready for
             production are shown.
+        :param geography: If True, measure the radius in meters on
+            the globe, using the index on places' geographies. If
+            False, use the older method of converting the radius to
+            degrees, which can't use an index.
+        :param limit: Find at most this many libraries. See
+            _order_by_distance().
 
         :return: A database query that returns lists of 2-tuples
-        (library, distance from starting point). Distances are
-        measured in meters.
+        (library, distance from starting point), closest first.
+        Distances are measured in meters.
         """
         # We start with a single point on the globe. Call this Point
         # A.
@@ -755,36 +1005,90 @@ class Library(Base):
             target = GeometryUtility.point(*target)
         target_geography = cast(target, Geography)
 
-        # Find another point on the globe that's 150 kilometers
-        # northeast of Point A. Call this Point B.
-        other_point = func.ST_Project(
-            target_geography, max_radius*1000, func.radians(90.0)
-        )
-        other_point = cast(other_point, Geometry)
-
-        # Determine the distance between Point A and Point B, in
-        # radians. (150 kilometers is a different number of radians in
-        # different parts of the world.)
-        distance_to_other_point = func.ST_Distance(target, other_point)
+        if geography:
+            # Find all Places within that many meters of A.
+            nearby = func.ST_DWithin(
+                Place.geography, target_geography, max_radius*1000
+            )
+        else:
+            # Find another point on the globe that's 150 kilometers
+            # northeast of Point A. Call this Point B.
+            other_point = func.ST_Project(
+                target_geography, max_radius*1000, func.radians(90.0)
+            )
+            other_point = cast(other_point, Geometry)
 
-        # Find all Places that are no further away from A than that
-        # number of radians.
-        nearby = func.ST_DWithin(target,
-                                 Place.geometry,
-                                 distance_to_other_point)
+            # Determine the distance between Point A and Point B, in
+            # radians. (150 kilometers is a different number of radians in
+            # different parts of the world.)
+            distance_to_other_point = func.ST_Distance(target, other_point)
 
-        # For each library served by such a place, calculate the
-        # minimum distance between the library's service area and
-        # Point A in meters.
-        min_distance = func.min(func.ST_DistanceSphere(target, Place.geometry))
+            # Find all Places that are no further away from A than that
+            # number of radians.
+            nearby = func.ST_DWithin(target,
+                                     Place.geometry,
+                                     distance_to_other_point)
 
         qu = _db.query(Library).join(Library.service_areas).join(
             ServiceArea.place)
         qu = qu.filter(cls._feed_restriction(production))
         qu = qu.filter(nearby)
-        qu = qu.add_columns(
-                min_distance).group_by(Library.id).order_by(
-                min_distance.asc())
+
+        # For each library served by such a place, calculate the
+        # minimum distance between the library's service area and
+        # Point A in meters.
+        return cls._order_by_distance(qu, target, limit=limit)
+
+    @classmethod
+    def _order_by_distance(cls, qu, target, place=None, limit=None):
+        """Add the distance from `target` to each library's closest
+        place to a query, and sort by it.
+
+        :param place: Measure the distance to this alias for Place,
+            rather than to Place itself.
+        :param limit: Return only this many of the closest libraries.
+            Their exact distances are only measured for libraries that
+            might be among them (see Place.distance_lower_bound), but
+            the answer is the same as if every library had been
+            measured. If this is None, every library is measured and
+            returned.
+        """
+        if place is None:
+            place = Place
+        exact_distance = func.min(func.ST_DistanceSphere(
+            target, place.geometry
+        ))
+        if limit:
+            # No library is closer than its lower bound, and the lower
+            # bound is much quicker to work out.
+            lower_bound = func.min(Place.distance_lower_bound(target, place))
+            by_library = qu.with_entities(Library.id).group_by(Library.id)
+
+            # Measure the libraries with the lowest lower bounds. The
+            # farthest of them is no farther away than the `limit`th
+            # closest library overall...
+            closest = by_library.order_by(lower_bound.asc()).limit(
+                limit
+            ).subquery()
+            distances = qu.with_entities(
+                exact_distance.label("distance")
+            ).filter(
+                Library.id.in_(select([closest.c.id]))
+            ).group_by(Library.id).subquery()
+            threshold = select([func.max(distances.c.distance)]).as_scalar()
+
+            # ...so only libraries whose lower bounds are at least that
+            # low can be among the closest. A library with no places
+            # at all is kept, to be sorted last.
+            close_enough = by_library.having(or_(
+                lower_bound <= threshold, lower_bound == None
+            )).subquery()
+            qu = qu.filter(Library.id.in_(select([close_enough.c.id])))
+        qu = qu.add_columns(exact_distance).group_by(Library.id).order_by(
+            exact_distance.asc(), Library.id
+        )
+        if limit:
+            qu = qu.limit(limit)
         return qu
 
     @classmethod
@@ -823,16 +1127,16 @@ class Library(Base):
         # We start with libraries that match the name query.
         if library_query:
             libraries_for_name = cls.search_by_library_name(
-                _db, library_query, here, production).limit(
-                    max_libraries).all()
+                _db, library_query, here, production, max_libraries
+            ).all()
         else:
             libraries_for_name = []
 
         # We tack on any additional libraries that match a place query.
         if place_query:
             libraries_for_location = cls.search_by_location_name(
-                _db, place_query, place_type, here, production
-            ).limit(max_libraries).all()
+                _db, place_query, place_type, here, production, max_libraries
+            ).all()
         else:
             libraries_for_location = []
 
@@ -846,28 +1150,33 @@ class Library(Base):
         # A lot of libraries list their locations only within their description, so it's worth
         # checking the description for the search term.
         libraries_for_description = cls.search_within_description(
-            _db, query, here, production
-        ).limit(max_libraries).all()
+            _db, query, here, production, max_libraries
+        ).all()
 
         return libraries_for_name + libraries_for_location + libraries_for_description
 
     @classmethod
-    def search_by_library_name(cls, _db, name, here=None, production=True):
+    def search_by_library_name(cls, _db, name, here=None, production=True,
+                               limit=None):
         """Find libraries whose name or alias matches the given name.
 
         :param name: Name of the library to search for.
         :param here: Order results by proximity to this location.
         :param production: If True, only libraries that are ready for
             production are shown.
+        :param limit: Find at most this many libraries.
         """
         name_matches = cls.fuzzy_match(Library.name, name)
         alias_matches = cls.fuzzy_match(LibraryAlias.name, name)
         partial_matches = cls.partial_match(Library.name, name)
-        return cls.create_query(_db, here, production, name_matches, alias_matches, partial_matches)
+        return cls.create_query(
+            _db, here, production, name_matches, alias_matches,
+            partial_matches, limit=limit
+        )
 
     @classmethod
     def search_by_location_name(cls, _db, query, type=None, here=None,
-                                production=True):
+                                production=True, limit=None):
         """Find libraries whose service area overlaps a place with
         the given name.
 
@@ -876,6 +1185,7 @@ class Library(Base):
         :param here: Order results by proximity to this location.
         :param production: If True, only libraries that are ready for
             production are shown.
+        :param limit: Find at most this many libraries.
         """
         # For a library to match, the Place named by the query must
         # intersect a Place served by that library.
@@ -884,7 +1194,10 @@ class Library(Base):
             Library.service_areas).join(
                 ServiceArea.place).join(
                     named_place,
-                    func.ST_Intersects(Place.geometry, named_place.geometry)
+                    PlaceSubdivision.intersects(
+                        Place.id, Place.geometry,
+                        named_place.id, named_place.geometry
+                    )
                 ).outerjoin(named_place.aliases)
         qu = qu.filter(cls._feed_restriction(production))
         name_match = cls.fuzzy_match(named_place.external_name, query)
@@ -893,10 +1206,20 @@ class Library(Base):
         if type:
             qu = qu.filter(named_place.type==type)
         if here:
-            min_distance = func.min(func.ST_DistanceSphere(here, named_place.geometry))
-            qu = qu.add_columns(min_distance)
-            qu = qu.group_by(Library.id)
-            qu = qu.order_by(min_distance.asc())
+            # This also groups the results by library.
+            qu = cls._order_by_distance(
+                qu, here, place=named_place, limit=limit
+            )
+        else:
+            # A library may match through several of its places, or
+            # several places with the name, but should only be
+            # returned once.
+            matches = qu.with_entities(Library.id).subquery()
+            qu = _db.query(Library).filter(
+                Library.id.in_(select([matches.c.id]))
+            )
+            if limit:
+                qu = qu.limit(limit)
         return qu
 
     us_zip = re.compile("^[0-9]{5}$")
@@ -904,7 +1227,8 @@ class Library(Base):
     running_whitespace = re.compile(r"\s+")
 
     @classmethod
-    def create_query(cls, _db, here=None, production=True, *args):
+    def create_query(cls, _db, here=None, production=True, *args,
+                     limit=None):
         qu = _db.query(Library).outerjoin(Library.aliases)
         if here:
             qu = qu.outerjoin(Library.service_areas).outerjoin(ServiceArea.place)
@@ -913,26 +1237,28 @@ class Library(Base):
         if here:
             # Order by the minimum distance between one of the
             # library's service areas and the current location.
-            min_distance = func.min(
-                func.ST_DistanceSphere(here, Place.geometry)
-            )
-            qu = qu.add_columns(min_distance)
-            qu = qu.group_by(Library.id)
-            qu = qu.order_by(min_distance.asc())
+            qu = cls._order_by_distance(qu, here, limit=limit)
+        elif limit:
+            qu = qu.limit(limit)
         return qu
 
     @classmethod
-    def search_within_description(cls, _db, query, here=None, production=True):
+    def search_within_description(cls, _db, query, here=None,
+                                  production=True, limit=None):
         """Find libraries whose descriptions include the search term.
 
         :param query: The string to search for.
         :param here: Order results by proximity to this location.
         :param production: If True, only libraries that are ready for
             production are shown.
+        :param limit: Find at most this many libraries.
         """
         description_matches = cls.fuzzy_match(Library.description, query)
         partial_matches = cls.partial_match(Library.description, query)
-        return cls.create_query(_db, here, production, description_matches, partial_matches)
+        return cls.create_query(
+            _db, here, production, description_matches, partial_matches,
+            limit=limit
+        )
 
     @classmethod
     def query_cleanup(cls, query):
@@ -1040,6 +1366,10 @@ class Library(Base):
             hyperlink.href = default_href
             is_modified = True
 
+        if is_modified:
+            # The library's links show up in its OPDS entry, so the
+            # entry has changed.
+            self.timestamp = datetime.datetime.utcnow()
         return hyperlink, is_modified
 
     @classmethod
@@ -1095,6 +1425,65 @@ class ServiceArea(Base):
         UniqueConstraint('library_id', 'place_id', 'type'),
     )
 
+    # This number goes up whenever the libraries' service areas
+    # change, so every process knows to throw away its vector tiles.
+    GENERATION = "service_area_generation"
+
+    # Vector tiles are drawn on a grid this many units on a side,
+    # with this many units of buffer around the edges.
+    TILE_EXTENT = 4096
+    TILE_BUFFER = 64
+    TILE_LAYER = "service_areas"
+
+    @classmethod
+    def generation(cls, _db):
+        return ConfigurationSetting.sitewide(_db, cls.GENERATION).int_value or 0
+
+    @classmethod
+    def bump_generation(cls, _db):
+        """Let every process know that the service areas have changed,
+        once this session commits.
+        """
+        ConfigurationSetting.sitewide(_db, cls.GENERATION).increment()
+        _db.flush()
+
+    @classmethod
+    def vector_tile(cls, _db, z, x, y):
+        """Draw a Mapbox Vector Tile of the service areas of every
+        library that's in production or testing.
+
+        Each feature has the library's ID, URN, library_stage and
+        registry_stage, and the type of service area.
+
+        :return: A bytestring.
+        """
+        envelope = func.ST_TileEnvelope(z, x, y)
+        geometry = func.ST_AsMVTGeom(
+            func.ST_Transform(Place.geometry, 3857), envelope,
+            cls.TILE_EXTENT, cls.TILE_BUFFER, True
+        )
+        features = select(
+            [Library.id.label("library_id"),
+             Library.internal_urn.label("uuid"),
+             cast(Library._library_stage, Unicode).label("library_stage"),
+             cast(Library.registry_stage, Unicode).label("registry_stage"),
+             cast(cls.type, Unicode).label("type"),
+             geometry.label("geom")]
+        ).select_from(
+            join(cls, Place, cls.place_id==Place.id).join(
+                Library, cls.library_id==Library.id
+            )
+        ).where(
+            Place.geometry.intersects(func.ST_Transform(envelope, 4326))
+        ).where(
+            Library._feed_restriction(production=False)
+        ).alias("features")
+        tile = select(
+            [func.ST_AsMVT(literal_column("features"), cls.TILE_LAYER,
+                           cls.TILE_EXTENT, "geom")]
+        ).select_from(features).where(features.c.geom != None)
+        return bytes(_db.execute(tile).scalar() or b'')
+
 
 class Place(Base):
     __tablename__ = 'places'
@@ -1137,16 +1526,68 @@ class Place(Base):
         Integer, ForeignKey('places.id'), index=True
     )
 
+    # A state can have thousands of children, so they're only loaded
+    # when someone asks for them.
     children = relationship(
         "Place",
         backref=backref("parent", remote_side = [id]),
-        lazy="joined"
     )
 
     # The geography of the place itself. It is stored internally as a
     # geometry, which means we have to cast to Geography when doing
     # calculations.
-    geometry = Column(Geometry(srid=4326), nullable=True)
+    #
+    # A geometry can be megabytes in size and most code only needs it
+    # inside SQL expressions, so it's not loaded along with the rest
+    # of the Place.
+    geometry = deferred(Column(Geometry(srid=4326), nullable=True))
+
+    # Summaries of the geometry, calculated by the database whenever
+    # the geometry changes (see summarize_geometries). They're much
+    # cheaper to measure distances to than a complex polygon.
+    # `bbox` is the smallest rectangle containing the geometry and
+    # `area` is measured in square meters. `radius` is the distance in
+    # meters from the centroid to the farthest point of the geometry
+    # (see distance_lower_bound). In a database that existed before
+    # these columns did, they're NULL until InitializeDatabaseScript
+    # or SummarizePlaceGeometriesScript fills them in, so queries must
+    # fall back to the geometry itself.
+    centroid = deferred(Column(Geometry(srid=4326), nullable=True))
+    bbox = deferred(Column(Geometry(srid=4326), nullable=True))
+    area = Column(Float, nullable=True)
+    radius = Column(Float, nullable=True)
+
+    # Every point within this many meters of a point on the globe
+    # (a quarter of the way around it, less a little) lies in a region
+    # smaller than a hemisphere, which contains every great circle arc
+    # between two of its points.
+    MAX_BOUNDING_RADIUS = 10000 * 1000
+
+    # GeoJSON for a place can be served at these resolutions. Each
+    # one maps to a simplification tolerance, in degrees, and the
+    # number of decimal places kept in each coordinate. (None means
+    # to leave the geometry alone.)
+    FULL_RESOLUTION = 'full'
+    GEOJSON_RESOLUTIONS = {
+        FULL_RESOLUTION: (None, None),
+        'high': (0.0001, 5),
+        'medium': (0.001, 4),
+        'low': (0.01, 3),
+    }
+
+    # The place's geometry as a geography, so distances can be
+    # measured in meters. There's an index on this expression (see
+    # below), so it's fast to filter on.
+    @hybrid_property
+    def geography(self):
+        return cast(self.geometry, Geography(srid=4326))
+
+    # The columns needed to resolve a place name. Name lookups load
+    # only these.
+    NAME_COLUMNS = [
+        'id', 'type', 'external_id', 'external_name', 'abbreviated_name',
+        'parent_id'
+    ]
 
     aliases = relationship("PlaceAlias", backref='place')
 
@@ -1189,6 +1630,79 @@ class Place(Base):
                 )
         return default_nation
 
+    @classmethod
+    def distance_lower_bound(cls, target, place=None):
+        """A SQL expression for a distance, in meters, that's no farther
+        than ST_DistanceSphere(target, place.geometry), but much
+        quicker to work out.
+
+        Every point of a place lies within `radius` of its centroid,
+        so nothing in the place can be closer to `target` than the
+        centroid is, less `radius`. That only holds while `radius` is
+        less than MAX_BOUNDING_RADIUS: ST_DistanceSphere follows great
+        circles between a geometry's points, and a larger circle around
+        the centroid doesn't contain them all. A bounding box is no
+        good as a lower bound for the same reason: its edges are great
+        circles, which bow away from the parallels the geometry
+        itself follows.
+
+        :param place: Use this alias for Place, rather than Place
+            itself.
+        """
+        if place is None:
+            place = cls
+        return case(
+            [
+                # This place hasn't been summarized yet.
+                (place.radius == None,
+                 func.ST_DistanceSphere(target, place.geometry)),
+                (place.radius >= cls.MAX_BOUNDING_RADIUS, 0),
+            ],
+            # Take off another meter in case of rounding errors.
+            else_=func.greatest(
+                func.ST_DistanceSphere(target, place.centroid)
+                - place.radius - 1, 0
+            )
+        )
+
+    @classmethod
+    def summarize_geometries(cls, _db, place_ids=None, limit=None):
+        """Calculate the centroid, bounding box, area and radius of
+        places' geometries.
+
+        :param place_ids: Summarize these places. If this is None,
+            summarize places whose geometries have never been
+            summarized.
+        :param limit: Summarize at most this many places.
+        :return: The number of places summarized.
+        """
+        table = cls.__table__
+        which = select([table.c.id]).where(table.c.geometry != None)
+        if place_ids is None:
+            which = which.where(
+                or_(table.c.centroid == None, table.c.radius == None)
+            )
+        else:
+            which = which.where(table.c.id.in_(place_ids))
+        if limit:
+            which = which.limit(limit)
+        # The farthest point of a geometry from its centroid is one of
+        # its vertices.
+        points = func.ST_DumpPoints(table.c.geometry).alias("points")
+        radius = select([
+            func.coalesce(func.max(func.ST_DistanceSphere(
+                func.ST_Centroid(table.c.geometry),
+                literal_column("(points).geom")
+            )), 0)
+        ]).select_from(points).as_scalar()
+        update = table.update().where(table.c.id.in_(which)).values(
+            centroid=func.ST_Centroid(table.c.geometry),
+            bbox=func.ST_Envelope(table.c.geometry),
+            area=func.ST_Area(cast(table.c.geometry, Geography(srid=4326))),
+            radius=radius,
+        )
+        return _db.execute(update).rowcount
+
     @classmethod
     def larger_place_types(cls, type):
         """Return a list of place types known to be bigger than `type`.
@@ -1236,7 +1750,9 @@ class Place(Base):
         """
         if not place_type:
             name, place_type = cls.parse_name(name)
-        qu = _db.query(Place).outerjoin(PlaceAlias).filter(
+        qu = _db.query(Place).options(load_only(*cls.NAME_COLUMNS)).outerjoin(
+            PlaceAlias
+        ).filter(
             or_(Place.external_name==name, Place.abbreviated_name==name,
                 PlaceAlias.name==name)
         )
@@ -1263,22 +1779,40 @@ class Place(Base):
         """Convert one or more Place objects to a dictionary that will become
         a GeoJSON document when converted to JSON.
         """
-        geojson = select(
-            [func.ST_AsGeoJSON(Place.geometry)]
-        ).where(
-            Place.id.in_([x.id for x in places])
+        return json.loads(cls.geojson(_db, places))
+
+    @classmethod
+    def geojson(cls, _db, places, resolution=FULL_RESOLUTION, **extensions):
+        """Build a GeoJSON document describing one or more Places.
+
+        The document is assembled from stored GeoJSON strings without
+        being parsed.
+
+        :param resolution: One of the keys of GEOJSON_RESOLUTIONS.
+        :param extensions: Extra fields to add to the top-level object.
+        :return: A string.
+        """
+        by_place = PlaceGeoJSON.for_places(
+            _db, [x.id for x in places], resolution
         )
-        results = [x[0] for x in _db.execute(geojson)]
-        if len(results) == 1:
+        geometries = [by_place[x.id] for x in places if x.id in by_place]
+        if len(geometries) == 1:
             # There's only one item, and it is a valid
             # GeoJSON document on its own.
-            return json.loads(results[0])
-
-        # We have either more or less than one valid item.
-        # In either case, a GeometryCollection is appropriate.
-        body = { "type": "GeometryCollection",
-                 "geometries" : [json.loads(x) for x in results] }
-        return body
+            document = geometries[0]
+        else:
+            # We have either more or less than one valid item.
+            # In either case, a GeometryCollection is appropriate.
+            document = '{"type": "GeometryCollection", "geometries": [%s]}' % (
+                ", ".join(geometries)
+            )
+        if extensions:
+            fields = ", ".join(
+                "%s: %s" % (json.dumps(key), json.dumps(value))
+                for key, value in sorted(extensions.items())
+            )
+            document = document.rstrip()[:-1] + ", " + fields + "}"
+        return document
 
     @classmethod
     def name_parts(cls, name):
@@ -1325,6 +1859,20 @@ class Place(Base):
         #  France
         return self.external_name
 
+    @property
+    def has_geometry(self):
+        """Does this place have a geometry?
+
+        If the geometry hasn't been loaded, this asks the database
+        instead of loading it.
+        """
+        if 'geometry' not in inspect(self).unloaded:
+            return self.geometry is not None
+        _db = Session.object_session(self)
+        return _db.query(Place.geometry != None).filter(
+            Place.id==self.id
+        ).scalar()
+
     def overlaps_not_counting_border(self, qu):
         """Modifies a filter to find places that have points inside this
         Place, not counting the border.
@@ -1333,9 +1881,17 @@ class Place(Base):
         share a border. This method creates a more real-world notion
         of 'inside' that does not count a shared border.
         """
-        intersects = Place.geometry.intersects(self.geometry)
-        touches = func.ST_Touches(Place.geometry, self.geometry)
-        return qu.filter(intersects).filter(touches==False)
+        # Have the database look up this place's geometry rather
+        # than loading it and sending it back. It's only needed if
+        # one of the places hasn't been subdivided.
+        this_place = aliased(Place)
+        geometry = select([this_place.geometry]).where(
+            this_place.id==self.id
+        ).as_scalar()
+        return qu.filter(PlaceSubdivision.intersects(
+            Place.id, Place.geometry, self.id, geometry,
+            counting_border=False
+        ))
 
     def lookup_inside(self, name, using_overlap=False, using_external_source=True):
 
@@ -1408,7 +1964,7 @@ class Place(Base):
             # find one and only one place with a certain name.
             pass
         else:
-            if using_overlap and self.geometry is not None:
+            if using_overlap and self.has_geometry:
                 qu = self.overlaps_not_counting_border(qu)
             else:
                 parent = aliased(Place)
@@ -1515,6 +2071,9 @@ class Place(Base):
         return str(output)
 
 
+Index("ix_places_geography", Place.geography, postgresql_using="gist")
+
+
 class PlaceAlias(Base):
 
     """An alternate name for a place."""
@@ -1530,6 +2089,232 @@ class PlaceAlias(Base):
     )
 
 
+class PlaceGeoJSON(Base):
+    """A Place's geometry as a GeoJSON string, at one of the resolutions
+    in Place.GEOJSON_RESOLUTIONS.
+
+    These are generated the first time they're needed, and deleted
+    when the Place's geometry changes.
+    """
+    __tablename__ = 'placegeojson'
+
+    id = Column(Integer, primary_key=True)
+    place_id = Column(
+        Integer, ForeignKey('places.id', ondelete='CASCADE'), index=True,
+        nullable=False
+    )
+    resolution = Column(Unicode, nullable=False)
+    geojson = Column(Unicode, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint('place_id', 'resolution'),
+    )
+
+    @classmethod
+    def for_places(cls, _db, place_ids, resolution):
+        """Find the GeoJSON for some Places at the given resolution,
+        generating any that isn't stored yet.
+
+        :return: A dictionary mapping Place IDs to GeoJSON strings.
+            Places with no geometry are left out.
+        """
+        if resolution not in Place.GEOJSON_RESOLUTIONS:
+            raise ValueError("Unknown resolution: %s" % resolution)
+        # Make sure any changed geometries have been written, and
+        # their stale GeoJSON deleted.
+        _db.flush()
+        place_ids = set(place_ids)
+        table = cls.__table__
+
+        def stored(ids):
+            return dict(_db.execute(
+                select([table.c.place_id, table.c.geojson]).where(
+                    and_(table.c.place_id.in_(ids),
+                         table.c.resolution==resolution)
+                )
+            ).fetchall())
+
+        found = stored(list(place_ids))
+        missing = place_ids - set(found)
+        if missing:
+            tolerance, digits = Place.GEOJSON_RESOLUTIONS[resolution]
+            geometry = Place.geometry
+            if tolerance:
+                geometry = func.ST_SimplifyPreserveTopology(geometry, tolerance)
+            if digits:
+                geojson = func.ST_AsGeoJSON(geometry, digits)
+            else:
+                geojson = func.ST_AsGeoJSON(geometry)
+            generate = select(
+                [Place.id, literal(resolution, Unicode), geojson]
+            ).where(
+                and_(Place.id.in_(list(missing)), Place.geometry!=None)
+            )
+            _db.execute(
+                postgresql.insert(table).from_select(
+                    [table.c.place_id, table.c.resolution, table.c.geojson],
+                    generate
+                ).on_conflict_do_nothing(
+                    index_elements=[table.c.place_id, table.c.resolution]
+                )
+            )
+            found.update(stored(list(missing)))
+        return found
+
+
+class PlaceSubdivision(Base):
+    """A small piece of a Place's geometry.
+
+    The outline of a nation or state can have tens of thousands of
+    points. Cut into pieces with a few hundred points each, every
+    piece with its own small bounding box, it's much faster to check
+    for intersection.
+
+    These are created by the database whenever a Place's geometry
+    changes (see subdivide). A place that hasn't been subdivided yet
+    is compared as a whole (see intersects).
+    """
+    __tablename__ = 'place_subdivisions'
+
+    # No piece has more points than this.
+    MAX_VERTICES = 256
+
+    id = Column(Integer, primary_key=True)
+    place_id = Column(
+        Integer, ForeignKey('places.id', ondelete='CASCADE'), index=True,
+        nullable=False
+    )
+    geometry = Column(Geometry(srid=4326), nullable=False)
+
+    @classmethod
+    def subdivide(cls, _db, place_ids=None, limit=None):
+        """Cut places' geometries into pieces, replacing any pieces
+        they already had.
+
+        :param place_ids: Subdivide these places. If this is None,
+            subdivide places that have never been subdivided.
+        :param limit: Subdivide at most this many places.
+        :return: The number of places subdivided.
+        """
+        places = Place.__table__
+        table = cls.__table__
+        which = select([places.c.id]).where(
+            and_(places.c.geometry != None,
+                 func.ST_IsEmpty(places.c.geometry)==False)
+        )
+        if place_ids is None:
+            which = which.where(
+                ~exists().where(table.c.place_id==places.c.id)
+            )
+        else:
+            which = which.where(places.c.id.in_(place_ids))
+            _db.execute(
+                table.delete().where(table.c.place_id.in_(place_ids))
+            )
+        if limit:
+            which = which.limit(limit)
+        ids = [place_id for [place_id] in _db.execute(which)]
+        if ids:
+            pieces = select(
+                [places.c.id,
+                 func.ST_Subdivide(places.c.geometry, cls.MAX_VERTICES)]
+            ).where(places.c.id.in_(ids))
+            _db.execute(
+                table.insert().from_select(
+                    [table.c.place_id, table.c.geometry], pieces
+                )
+            )
+        return len(ids)
+
+    @classmethod
+    def intersects(cls, place_id_1, geometry_1, place_id_2, geometry_2,
+                   counting_border=True):
+        """Build an SQL expression that's true if two places'
+        geometries intersect.
+
+        The places' pieces are compared rather than their whole
+        geometries, so the database only has to check small pieces. If
+        either place hasn't been subdivided yet, e.g. because it was
+        loaded before subdivisions existed, the whole geometries are
+        compared instead.
+
+        :param counting_border: If this is False, places that only
+            share a border don't count as intersecting. Neither do
+            pieces that only share a border, so this works the same
+            either way.
+        """
+        def meet(a, b):
+            clause = func.ST_Intersects(a, b)
+            if not counting_border:
+                clause = and_(clause, func.ST_Touches(a, b)==False)
+            return clause
+
+        pieces_1 = aliased(cls)
+        pieces_2 = aliased(cls)
+        by_pieces = exists().where(and_(
+            pieces_1.place_id==place_id_1,
+            pieces_2.place_id==place_id_2,
+            meet(pieces_1.geometry, pieces_2.geometry),
+        ))
+        not_subdivided = or_(
+            ~exists().where(pieces_1.place_id==place_id_1),
+            ~exists().where(pieces_2.place_id==place_id_2),
+        )
+        return or_(
+            by_pieces,
+            and_(not_subdivided, meet(geometry_1, geometry_2))
+        )
+
+
+@event.listens_for(Session, 'after_flush')
+def _summarize_new_geometries(session, flush_context):
+    """Update the summaries and subdivisions of any geometries that
+    were just written.
+
+    Places that are already loaded won't see the new values until
+    they're refreshed, but these are only used inside queries.
+    """
+    place_ids = [
+        obj.id for obj in itertools.chain(session.new, session.dirty)
+        if isinstance(obj, Place)
+        and inspect(obj).attrs.geometry.history.has_changes()
+    ]
+    if place_ids:
+        Place.summarize_geometries(session, place_ids)
+        PlaceSubdivision.subdivide(session, place_ids)
+
+
+@event.listens_for(Session, 'before_flush')
+def _bump_service_area_generation(session, flush_context, instances):
+    """Let other processes know that their vector tiles are out of date
+    if the geometry of a place in a service area is about to change.
+    """
+    place_ids = [
+        obj.id for obj in session.dirty
+        if isinstance(obj, Place)
+        and inspect(obj).attrs.geometry.history.has_changes()
+    ]
+    if not place_ids:
+        return
+    in_service_area = session.query(
+        exists().where(ServiceArea.place_id.in_(place_ids))
+    ).scalar()
+    if in_service_area:
+        _increment_during_flush(session, ServiceArea.GENERATION)
+
+@event.listens_for(Session, 'after_flush')
+def _forget_stale_geojson(session, flush_context):
+    """Delete the stored GeoJSON for any Place whose geometry changed."""
+    place_ids = [
+        obj.id for obj in session.dirty
+        if isinstance(obj, Place)
+        and inspect(obj).attrs.geometry.history.has_changes()
+    ]
+    if place_ids:
+        table = PlaceGeoJSON.__table__
+        session.execute(table.delete().where(table.c.place_id.in_(place_ids)))
+
+
 class Audience(Base):
     """A class of person served by a library."""
     __tablename__ = 'audiences'
@@ -1847,7 +2632,7 @@ class DelegatedPatronIdentifier(Base):
 
     # This is the identifier we made up for the patron. This is what the
     # foreign library is trying to look up.
-    delegated_identifier = Column(String)
+    delegated_identifier = Column(String, index=True)
 
     __table_args__ = (
         UniqueConstraint('type', 'library_id', 'patron_identifier'),
@@ -1861,7 +2646,8 @@ class DelegatedPatronIdentifier(Base):
         """Look up the delegated identifier for the given patron. If there is
         none, create one.
 
-        :param library: The Library in charge of the patron's record.
+        :param library: The Library in charge of the patron's record,
+         or its database ID.
 
         :param patron_identifier: An identifier used by that library
          to distinguish between this patron and others. This should be
@@ -1883,9 +2669,14 @@ class DelegatedPatronIdentifier(Base):
         :return: A 2-tuple (DelegatedPatronIdentifier, is_new)
 
         """
+        if isinstance(library, Library):
+            library_criteria = dict(library=library)
+        else:
+            library_criteria = dict(library_id=library)
         identifier, is_new = get_one_or_create(
-            _db, DelegatedPatronIdentifier, library=library,
-            patron_identifier=patron_identifier, type=identifier_type
+            _db, DelegatedPatronIdentifier,
+            patron_identifier=patron_identifier, type=identifier_type,
+            **library_criteria
         )
         if is_new:
             if callable(identifier_or_identifier_factory):
@@ -1899,6 +2690,151 @@ class DelegatedPatronIdentifier(Base):
             identifier.delegated_identifier = delegated_identifier
         return identifier, is_new
 
+    # Patrons' apps ask for the same delegated identifiers over and
+    # over, and a delegated identifier never changes once it's
+    # created. So recently used identifiers are kept in this
+    # process-wide cache, keyed by (library ID, patron identifier,
+    # identifier type).
+    CACHE_SIZE = 10000
+    _cache = LRUCache(CACHE_SIZE)
+
+    # Identifiers found or created in a database session are put here
+    # in Session.info, and only go into the cache once the session
+    # commits.
+    _PENDING_CACHE_KEY = "delegated_patron_identifiers_to_cache"
+
+    @classmethod
+    def delegated_identifier_for(
+            cls, _db, library_id, patron_identifier, identifier_type,
+            identifier_or_identifier_factory
+    ):
+        """Look up the delegated identifier for the given patron. If there
+        is none, create one.
+
+        This does the same job as get_one_or_create(), but it returns
+        only the delegated identifier, and most of the time it doesn't
+        need to touch the database at all.
+
+        :param library_id: The database ID of the Library in charge of
+         the patron's record.
+
+        :return: The delegated identifier, as a string.
+        """
+        key = (library_id, patron_identifier, identifier_type)
+        delegated_identifier = cls._cache.get(key)
+        if delegated_identifier is not None:
+            return delegated_identifier
+
+        table = cls.__table__
+        find = select([table.c.delegated_identifier]).where(
+            and_(
+                table.c.library_id==library_id,
+                table.c.patron_identifier==patron_identifier,
+                table.c.type==identifier_type,
+            )
+        )
+        row = _db.execute(find).first()
+        if row is None:
+            if callable(identifier_or_identifier_factory):
+                delegated_identifier = identifier_or_identifier_factory()
+            else:
+                delegated_identifier = identifier_or_identifier_factory
+
+            # Create the record unless someone else created it
+            # after we looked. Either way, there's no need for a
+            # savepoint.
+            insert = postgresql.insert(table).values(
+                library_id=library_id, patron_identifier=patron_identifier,
+                type=identifier_type,
+                delegated_identifier=delegated_identifier,
+            ).on_conflict_do_nothing(
+                index_elements=[
+                    table.c.type, table.c.library_id,
+                    table.c.patron_identifier
+                ]
+            ).returning(table.c.delegated_identifier)
+            row = _db.execute(insert).first()
+            if row is None:
+                row = _db.execute(find).first()
+
+        delegated_identifier = row[0]
+        if delegated_identifier is not None:
+            pending = _db.info.setdefault(cls._PENDING_CACHE_KEY, {})
+            pending[key] = delegated_identifier
+        return delegated_identifier
+
+    # Rows are copied into this temporary table before being merged
+    # into the real one.
+    _IMPORT_TABLE = "delegatedpatronidentifiers_import"
+
+    @classmethod
+    def bulk_import(cls, _db, rows, identifier_type=ADOBE_ACCOUNT_ID):
+        """Add a large number of delegated identifiers at once.
+
+        This is for migrating from another Vendor ID server, where
+        there may be millions of patrons who already have an Adobe
+        Account ID. The rows are sent to the database with COPY and
+        merged into the table with a single INSERT.
+
+        :param rows: A list of 3-tuples (library ID, patron identifier,
+            delegated identifier).
+        :return: The number of delegated identifiers created. Patrons
+            who already have a delegated identifier of this type are
+            left alone.
+        """
+        if not rows:
+            return 0
+        data = io.StringIO()
+        csv.writer(data).writerows(rows)
+        data.seek(0)
+
+        cursor = _db.connection().connection.cursor()
+        try:
+            cursor.execute(
+                "CREATE TEMPORARY TABLE IF NOT EXISTS %s ("
+                " library_id integer,"
+                " patron_identifier varchar(255),"
+                " delegated_identifier varchar"
+                ") ON COMMIT DELETE ROWS" % cls._IMPORT_TABLE
+            )
+            cursor.copy_expert(
+                "COPY %s FROM STDIN WITH (FORMAT csv)" % cls._IMPORT_TABLE,
+                data
+            )
+            cursor.execute(
+                "INSERT INTO delegatedpatronidentifiers"
+                " (type, library_id, patron_identifier, delegated_identifier)"
+                " SELECT %%s, library_id, patron_identifier, delegated_identifier"
+                " FROM %s"
+                " ON CONFLICT (type, library_id, patron_identifier) DO NOTHING"
+                % cls._IMPORT_TABLE,
+                (identifier_type,)
+            )
+            created = cursor.rowcount
+            cursor.execute("TRUNCATE %s" % cls._IMPORT_TABLE)
+        finally:
+            cursor.close()
+        return created
+
+
+@event.listens_for(Session, 'after_commit')
+def _cache_delegated_identifiers(session):
+    """Identifiers found or created in this session are now safe to
+    cache.
+    """
+    pending = session.info.pop(
+        DelegatedPatronIdentifier._PENDING_CACHE_KEY, None
+    )
+    for key, delegated_identifier in (pending or {}).items():
+        DelegatedPatronIdentifier._cache.set(key, delegated_identifier)
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_pending_delegated_identifiers(session):
+    """Identifiers created in this session never made it into the
+    database, so they must not be cached.
+    """
+    session.info.pop(DelegatedPatronIdentifier._PENDING_CACHE_KEY, None)
+
 
 class ShortClientTokenDecoder(ShortClientTokenTool):
     """Turn a short client token into a DelegatedPatronIdentifier.
@@ -1936,22 +2872,79 @@ class ShortClientTokenDecoder(ShortClientTokenTool):
 
         :raise ValueError: When the token is not valid for any reason.
         """
+        username, password = self._split_authdata(token)
+        return self.decode_two_part(_db, username, password)
+
+    def decode_to_account_id(self, _db, token):
+        """Decode a short client token into an Adobe Account ID.
+
+        :return: The delegated identifier for the patron, as a string.
+
+        :raise ValueError: When the token is not valid for any reason.
+        """
+        username, password = self._split_authdata(token)
+        return self.decode_two_part_to_account_id(_db, username, password)
+
+    def _split_authdata(self, token):
+        """Split a short client token into 'username' and 'password' parts."""
         if not token:
             raise ValueError("Cannot decode an empty token.")
         if not '|' in token:
             raise ValueError(
                 'Supposed client token "%s" does not contain a pipe.' % token
             )
-
-        username, password = token.rsplit('|', 1)
-        return self.decode_two_part(_db, username, password)
+        return token.rsplit('|', 1)
 
     def decode_two_part(self, _db, username, password):
         """Decode a short client token that has already been split into
         two parts.
+
+        :return: a DelegatedPatronIdentifier
         """
-        library = patron_identifier = account_id = None
+        library_id, patron_identifier, account_id = self._authenticate(
+            _db, username, password
+        )
+        delegated_patron_identifier, is_new = (
+            DelegatedPatronIdentifier.get_one_or_create(
+                _db, library_id, patron_identifier,
+                DelegatedPatronIdentifier.ADOBE_ACCOUNT_ID, account_id
+            )
+        )
+        return delegated_patron_identifier
+
+    def decode_two_part_to_account_id(self, _db, username, password):
+        """Decode a short client token that has already been split into
+        two parts, without loading a DelegatedPatronIdentifier.
+
+        This is the code path used to handle Adobe sign-in requests.
+
+        :return: The delegated identifier for the patron, as a string.
+        """
+        library_id, patron_identifier, account_id = self._authenticate(
+            _db, username, password
+        )
+        return DelegatedPatronIdentifier.delegated_identifier_for(
+            _db, library_id, patron_identifier,
+            DelegatedPatronIdentifier.ADOBE_ACCOUNT_ID, account_id
+        )
+
+    def _authenticate(self, _db, username, password):
+        """Check a short client token that has already been split into
+        two parts.
+
+        The token's signature is checked locally first. The delegates
+        are consulted only if that fails, or if the patron turns out to
+        need a brand new delegated identifier (in case a delegate
+        already knows the patron under some other identifier).
+
+        :return: A 3-tuple (library ID, patron identifier,
+            account_id). account_id may be an Adobe Account ID or a
+            function that will create one.
 
+        :raise ValueError: If the token is not a short client token.
+        :raise TokenRejected: If the token is a short client token
+            that neither this server nor any delegate could verify.
+        """
         # No matter how we do this, if we're going to create
         # a DelegatedPatronIdentifier, we need to extract the Library
         # and the library's identifier for this patron from the 'username'
@@ -1960,59 +2953,169 @@ class ShortClientTokenDecoder(ShortClientTokenTool):
         # If this username/password is not actually a Short Client
         # Token, this will raise an exception, which gives us a quick
         # way to bail out.
-        library, expires, patron_identifier = self._split_token(
-            _db, username
-        )
+        parsed = self._split_token(_db, username)
+        library_key, expires, patron_identifier = parsed
 
-        # First see if a delegate can give us an Adobe ID (account_id)
-        # for this patron.
-        for delegate in self.delegates:
-            try:
-                account_id, label, content = delegate.sign_in_standard(
-                    username, password
-                )
-            except Exception as e:
-                # This delegate couldn't help us.
-                pass
-            if account_id:
-                # We got it -- no need to keep checking delegates.
-                break
+        def sign_in(delegate):
+            return delegate.sign_in_standard(username, password)
 
-        if not account_id:
-            # The delegates couldn't help us; let's try to do it
-            # ourselves.
+        try:
             try:
                 signature = self.adobe_base64_decode(password)
             except Exception as e:
                 raise ValueError("Invalid password: %s" % password)
-
-            patron_identifier, account_id = self._decode(
-                _db, username, signature
+            patron_identifier, account_id = self._verify(
+                _db, username, parsed, signature
             )
+        except ValueError as e:
+            # We can't verify the token ourselves; maybe a delegate can.
+            answer = self.ask_delegates(sign_in)
+            if not answer:
+                raise self.TokenRejected(str(e))
+            account_id = answer[0]
+        else:
+            if self.delegates:
+                # The token is good. If we end up needing to create a
+                # delegated identifier for this patron, we'll first
+                # see whether a delegate already has one.
+                local_account_id = account_id
+                def account_id_from_delegates():
+                    answer = self.ask_delegates(sign_in)
+                    if answer:
+                        return answer[0]
+                    if callable(local_account_id):
+                        return local_account_id()
+                    return local_account_id
+                account_id = account_id_from_delegates
 
         # If we got this far, we have a Library, a patron_identifier,
         # and an account_id.
-        delegated_patron_identifier, is_new = (
-            DelegatedPatronIdentifier.get_one_or_create(
-                _db, library, patron_identifier,
-                DelegatedPatronIdentifier.ADOBE_ACCOUNT_ID, account_id
-            )
-        )
-        return delegated_patron_identifier
+        return library_key.library_id, patron_identifier, account_id
+
+    class TokenRejected(ValueError):
+        """A short client token could not be verified, either locally or
+        by any of the delegates.
+        """
+
+    # Delegates are asked questions in parallel, using threads from
+    # this pool.
+    DELEGATE_THREADS = 8
+    _delegate_pool = None
+    _delegate_pool_lock = threading.Lock()
+
+    # Stop waiting for the delegates after this many seconds.
+    DELEGATE_TIMEOUT = 15
+
+    @classmethod
+    def _delegate_executor(cls):
+        with cls._delegate_pool_lock:
+            if cls._delegate_pool is None:
+                cls._delegate_pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=cls.DELEGATE_THREADS
+                )
+            return cls._delegate_pool
+
+    def ask_delegates(self, ask):
+        """Ask all of the delegates the same question at once.
+
+        :param ask: A function that takes a delegate and returns a
+            3-tuple (account ID, label, content), or raises an
+            exception if the delegate can't help.
+        :return: The first successful answer, or None if no delegate
+            could help.
+        """
+        if not self.delegates:
+            return None
+        futures = [
+            self._delegate_executor().submit(ask, delegate)
+            for delegate in self.delegates
+        ]
+        try:
+            for future in concurrent.futures.as_completed(
+                futures, timeout=self.DELEGATE_TIMEOUT
+            ):
+                try:
+                    answer = future.result()
+                except Exception as e:
+                    # This delegate couldn't help us.
+                    continue
+                if answer and answer[0]:
+                    return answer
+        except concurrent.futures.TimeoutError as e:
+            logging.warning("Timed out waiting for Vendor ID delegates.")
+        finally:
+            # Don't bother asking any delegates we haven't gotten
+            # around to.
+            for future in futures:
+                future.cancel()
+        return None
+
+    # Information about a library needed to check its tokens' signatures.
+    LibraryKey = namedtuple(
+        "LibraryKey", ["library_id", "signing_key", "generation"]
+    )
+
+    # Maps library short names to LibraryKeys. This is shared by every
+    # decoder in the process, so that most tokens can be checked
+    # without looking up the Library.
+    _library_keys = {}
+
+    # This sitewide setting goes up whenever a library's shared secret
+    # or short name changes, or a library is deleted. A LibraryKey
+    # loaded under an older generation is reloaded, so a secret
+    # changed by another process stops being accepted by this one as
+    # soon as the change is committed. Changes made in this process
+    # take effect immediately; see forget_library().
+    GENERATION = "library_key_generation"
+
+    @classmethod
+    def generation(cls, _db):
+        return ConfigurationSetting.sitewide(_db, cls.GENERATION).int_value or 0
+
+    @classmethod
+    def forget_library(cls, short_name):
+        """Remove a library from the key cache, e.g. because its shared
+        secret changed.
+        """
+        if short_name:
+            cls._library_keys.pop(short_name.upper(), None)
+
+    def _library_key(self, _db, short_name, refresh=False):
+        """Find the information needed to check the signature of a token
+        issued by the given library.
+
+        :param refresh: If this is True, ignore any cached value.
+        :return: A LibraryKey, or None if there is no such library.
+        """
+        generation = self.generation(_db)
+        key = self._library_keys.get(short_name)
+        if key and not refresh and key.generation == generation:
+            return key
+
+        library = get_one(_db, Library, short_name=short_name)
+        if not library:
+            self.forget_library(short_name)
+            return None
+        signing_key = None
+        if library.shared_secret:
+            signing_key = self.signer.prepare_key(library.shared_secret)
+        key = self.LibraryKey(library.id, signing_key, generation)
+        self._library_keys[short_name] = key
+        return key
 
     def _split_token(self, _db, token):
         """Split the 'username' part of a Short Client Token.
 
-        :return: A 3-tuple (Library, expiration, foreign patron identifier)
+        :return: A 3-tuple (LibraryKey, expiration, foreign patron identifier)
         """
         if token.count('|') < 2:
             raise ValueError("Invalid client token: %s" % token)
         library_short_name, expiration, patron_identifier = token.split("|", 2)
         library_short_name = library_short_name.upper()
 
-        # Look up the Library object based on short name.
-        library = get_one(_db, Library, short_name=library_short_name)
-        if not library:
+        # Look up the library based on short name.
+        library_key = self._library_key(_db, library_short_name)
+        if not library_key:
             raise ValueError(
                 "I don't know how to handle tokens from library \"%s\"" % library_short_name
             )
@@ -2020,14 +3123,22 @@ class ShortClientTokenDecoder(ShortClientTokenTool):
             expiration = float(expiration)
         except ValueError:
             raise ValueError('Expiration time "%s" is not numeric.' % expiration)
-        return library, expiration, patron_identifier
+        return library_key, expiration, patron_identifier
 
     def _decode(self, _db, token, supposed_signature):
         """Make sure a client token is properly formatted, correctly signed,
         and not expired.
         """
-        library, expiration, patron_identifier = self._split_token(_db, token)
-        secret = library.shared_secret
+        parsed = self._split_token(_db, token)
+        return self._verify(_db, token, parsed, supposed_signature)
+
+    def _verify(self, _db, token, parsed, supposed_signature):
+        """Make sure an already split client token is correctly signed
+        and not expired.
+
+        :param parsed: The return value of _split_token(token).
+        """
+        library_key, expiration, patron_identifier = parsed
 
         # We don't police the content of the patron identifier but there
         # has to be _something_ there.
@@ -2062,19 +3173,80 @@ class ShortClientTokenDecoder(ShortClientTokenTool):
             )
 
         # Sign the token and check against the provided signature.
-        key = self.signer.prepare_key(secret)
         token_bytes = token.encode("utf8")
-        actual_signature = self.signer.sign(token_bytes, key)
-
-        if actual_signature != supposed_signature:
-            raise ValueError(
-                "Invalid signature for %s." % token
-            )
+        if not self._signature_matches(
+            library_key, token_bytes, supposed_signature
+        ):
+            # The library's secret may have been changed by another
+            # process since we cached its key. Check again with the
+            # current secret before giving up.
+            short_name = token.split("|", 1)[0].upper()
+            library_key = self._library_key(_db, short_name, refresh=True)
+            if not self._signature_matches(
+                library_key, token_bytes, supposed_signature
+            ):
+                raise ValueError(
+                    "Invalid signature for %s." % token
+                )
 
         # We have a Library, and a patron identifier which we know is valid.
         # Find or create a DelegatedPatronIdentifier for this person.
         return patron_identifier, self.uuid
 
+    def _signature_matches(self, library_key, token_bytes, supposed_signature):
+        if not library_key or not library_key.signing_key:
+            return False
+        actual_signature = self.signer.sign(token_bytes, library_key.signing_key)
+        return actual_signature == supposed_signature
+
+
+@event.listens_for(Library.shared_secret, 'set')
+def _shared_secret_changed(target, value, oldvalue, initiator):
+    """Any cached signing key for the library is no longer valid."""
+    ShortClientTokenDecoder.forget_library(target.short_name)
+
+@event.listens_for(Library.short_name, 'set')
+def _short_name_changed(target, value, oldvalue, initiator):
+    """Tokens issued under the old short name should no longer be
+    accepted, and any cached key for the new one is for another library.
+    """
+    for short_name in (oldvalue, value):
+        if isinstance(short_name, str):
+            ShortClientTokenDecoder.forget_library(short_name)
+
+@event.listens_for(Session, 'before_flush')
+def _bump_library_key_generation(session, flush_context, instances):
+    """Let other processes know that a signing key they've cached may
+    no longer be valid.
+    """
+    def changed(obj):
+        if obj in session.deleted:
+            return True
+        attrs = inspect(obj).attrs
+        return (attrs.shared_secret.history.has_changes()
+                or attrs.short_name.history.has_changes())
+    for obj in itertools.chain(session.dirty, session.deleted):
+        if isinstance(obj, Library) and changed(obj):
+            break
+    else:
+        return
+
+    _increment_during_flush(session, ShortClientTokenDecoder.GENERATION)
+
+def _increment_during_flush(session, key):
+    """Increment a sitewide counter from a before_flush listener."""
+    # ConfigurationSetting.sitewide() would flush the session to create
+    # a missing setting, which can't be done in the middle of a flush.
+    setting = get_one(
+        session, ConfigurationSetting, library_id=None,
+        external_integration_id=None, key=key
+    )
+    if setting:
+        setting.increment()
+    else:
+        session.add(ConfigurationSetting(key=key, value="1"))
+
+
 class ExternalIntegration(Base):
 
     """An external integration contains configuration for connecting
@@ -2330,13 +3502,80 @@ class ConfigurationSetting(Base):
         library_id = None
         if library:
             library_id = library.id
+        external_integration_id = None
+        if external_integration:
+            external_integration_id = external_integration.id
+
+        settings = None
+        if not ((library and library_id is None) or
+                (external_integration and external_integration_id is None)):
+            settings = cls._snapshot(_db, library_id)
+            setting = settings.get(
+                (library_id, external_integration_id, key)
+            )
+            if setting is not None:
+                return setting
+
         setting, ignore = get_one_or_create(
             _db, ConfigurationSetting,
             library_id=library_id, external_integration=external_integration,
             key=key
         )
+        if settings is not None:
+            settings[(library_id, external_integration_id, key)] = setting
         return setting
 
+    # The ConfigurationSettings loaded by a database session are kept
+    # in Session.info under this key, so that looking up a setting
+    # doesn't mean going to the database every time. In the web app
+    # a session lasts for one request.
+    _SNAPSHOT_KEY = "configuration_settings"
+
+    @classmethod
+    def _snapshot(cls, _db, library_id=None):
+        """Load ConfigurationSettings into the session's snapshot.
+
+        The first time this is called in a session, every setting that
+        doesn't belong to a library is loaded with a single query. The
+        settings for a library are loaded the first time they're
+        needed.
+
+        :return: A dictionary mapping (library ID, external integration
+            ID, key) to ConfigurationSetting.
+        """
+        snapshot = _db.info.get(cls._SNAPSHOT_KEY)
+        if snapshot is None:
+            snapshot = _db.info[cls._SNAPSHOT_KEY] = dict(
+                settings={}, libraries=set()
+            )
+            cls._load_snapshot(
+                _db, snapshot, ConfigurationSetting.library_id==None
+            )
+        if (library_id is not None
+            and library_id not in snapshot['libraries']):
+            cls._load_snapshot(
+                _db, snapshot, ConfigurationSetting.library_id==library_id
+            )
+            snapshot['libraries'].add(library_id)
+        return snapshot['settings']
+
+    @classmethod
+    def _load_snapshot(cls, _db, snapshot, clause):
+        settings = snapshot['settings']
+        for setting in _db.query(ConfigurationSetting).filter(clause):
+            key = (
+                setting.library_id, setting.external_integration_id,
+                setting.key
+            )
+            settings.setdefault(key, setting)
+
+    @classmethod
+    def forget_snapshot(cls, _db):
+        """Make sure the next setting lookup in this session goes to
+        the database.
+        """
+        _db.info.pop(cls._SNAPSHOT_KEY, None)
+
     @property
     def library(self):
         _db = Session.object_session(self)
@@ -2420,6 +3659,18 @@ class ConfigurationSetting(Base):
             return False
         return None
 
+    def increment(self):
+        """Add one to this setting's value.
+
+        The value is incremented in the database rather than in Python,
+        so two processes doing this at once can't both set it to the
+        same number.
+        """
+        self._value = cast(
+            cast(func.coalesce(ConfigurationSetting._value, '0'), Integer)
+            + 1, Unicode
+        )
+
     @property
     def int_value(self):
         """Turn the value into an int if possible.
@@ -2456,6 +3707,53 @@ class ConfigurationSetting(Base):
             return json.loads(self.value)
         return None
 
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_soft_rollback')
+def _forget_configuration_snapshot(session, *args):
+    """Once a session commits or rolls back, the settings it loaded
+    may be out of date.
+    """
+    ConfigurationSetting.forget_snapshot(session)
+
+@event.listens_for(Session, 'after_flush')
+def _forget_deleted_configuration(session, flush_context):
+    """Don't hand out settings that were just deleted."""
+    for obj in session.deleted:
+        if isinstance(obj, (ConfigurationSetting, ExternalIntegration, Library)):
+            ConfigurationSetting.forget_snapshot(session)
+            break
+
+
+def changes_configuration(session):
+    """Does this session have unflushed changes to configuration that
+    processes may have cached?
+    """
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if (isinstance(obj, ExternalIntegration)
+            or (isinstance(obj, ConfigurationSetting)
+                and obj.library_id is None)):
+            if obj in session.dirty and not session.is_modified(obj):
+                continue
+            return True
+    return False
+
+@event.listens_for(Session, 'before_flush')
+def _note_configuration_change(session, flush_context, instances):
+    """Note when a session changes configuration that processes may
+    have cached, so that the session itself doesn't use the cache.
+    """
+    if session.info.get(Configuration.CONFIGURATION_CHANGED):
+        return
+    if changes_configuration(session):
+        session.info[Configuration.CONFIGURATION_CHANGED] = True
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def _forget_configuration_change(session):
+    session.info.pop(Configuration.CONFIGURATION_CHANGED, None)
+
+
 # Join tables for many-to-many relationships
 
 libraries_audiences = Table(
@@ -2502,3 +3800,205 @@ class Admin(Base):
 
     def __repr__(self):
         return "<Admin: username=%s>" % self.username
+
+
+class RegistrationJob(Base):
+    """A request to register a library that will be carried out in the
+    background, rather than while the client waits.
+
+    The web application creates a RegistrationJob and tells the client
+    where to check on its status. A worker process (see
+    RegistrationWorkerScript) picks up the job, carries out the
+    registration, and stores the response the client would have
+    received if the registration had been done immediately.
+    """
+    __tablename__ = 'registrationjobs'
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    COMPLETE = 'complete'
+    state_enum = Enum(QUEUED, RUNNING, COMPLETE, name='registration_job_state')
+
+    # A job that has been running for this long is presumed to belong
+    # to a worker that died. Another worker may pick it up.
+    STALE_AFTER = datetime.timedelta(hours=1)
+
+    # A finished job is kept around this long, so the client has a
+    # chance to check on its outcome, and then deleted.
+    KEEP_FINISHED = datetime.timedelta(days=1)
+
+    id = Column(Integer, primary_key=True)
+
+    # The job is identified publicly by this secret, so that a
+    # client can only check on the status of its own registration.
+    key = Column(Unicode, default=generate_secret, unique=True,
+                 nullable=False)
+
+    state = Column(state_enum, index=True, nullable=False, default=QUEUED)
+
+    # The parameters of the original registration request.
+    authentication_url = Column(Unicode, nullable=False)
+    contact = Column(Unicode)
+    shared_secret = Column(Unicode)
+    library_stage = Column(Unicode)
+    reset_shared_secret = Column(Boolean, default=False)
+
+    # The root URL of the original request. The worker uses this to
+    # generate the same URLs the web application would have generated.
+    base_url = Column(Unicode)
+
+    created = Column(DateTime, index=True, nullable=False,
+                     default=lambda: datetime.datetime.utcnow())
+    started = Column(DateTime)
+    finished = Column(DateTime)
+
+    # The HTTP response the client would have received if the
+    # registration had been carried out immediately.
+    status_code = Column(Integer)
+    media_type = Column(Unicode)
+    response = Column(Unicode)
+
+    @classmethod
+    def next(cls, _db, now=None):
+        """Claim the oldest job that is waiting to be run.
+
+        The job's row is locked, and rows locked by other workers are
+        skipped, so any number of workers can share the queue. The
+        caller should commit as soon as possible to release the lock.
+
+        :return: A RegistrationJob, or None if the queue is empty.
+        """
+        now = now or datetime.datetime.utcnow()
+        stale = now - cls.STALE_AFTER
+        qu = _db.query(cls).filter(
+            or_(
+                cls.state==cls.QUEUED,
+                and_(cls.state==cls.RUNNING, cls.started < stale)
+            )
+        ).order_by(cls.created, cls.id).with_for_update(skip_locked=True)
+        job = qu.first()
+        if job:
+            job.state = cls.RUNNING
+            job.started = now
+        return job
+
+    @classmethod
+    def purge(cls, _db, now=None):
+        """Delete jobs that finished more than KEEP_FINISHED ago.
+
+        :return: The number of jobs deleted.
+        """
+        now = now or datetime.datetime.utcnow()
+        return _db.query(cls).filter(cls.state==cls.COMPLETE).filter(
+            cls.finished < now - cls.KEEP_FINISHED
+        ).delete(synchronize_session=False)
+
+    def complete(self, status_code, media_type, response):
+        """Record the outcome of the registration."""
+        self.status_code = status_code
+        self.media_type = media_type
+        self.response = response
+        self.state = self.COMPLETE
+        self.finished = datetime.datetime.utcnow()
+        # The shared secret is only needed to carry out the
+        # registration. Whether it worked or not, there's no reason
+        # to keep it around.
+        self.shared_secret = None
+
+    def __repr__(self):
+        return "<RegistrationJob: %s state=%s url=%s>" % (
+            self.id, self.state, self.authentication_url
+        )
+
+
+class OutgoingEmail(Base):
+    """An email waiting to be sent by Emailer.send_queued()."""
+    __tablename__ = 'outgoingemails'
+
+    # After this many failed attempts, we stop trying to send an email.
+    MAX_ATTEMPTS = 8
+
+    # After a failed attempt, wait this long before trying again. The
+    # delay doubles with each failure, up to MAX_RETRY_DELAY.
+    RETRY_DELAY = datetime.timedelta(minutes=1)
+    MAX_RETRY_DELAY = datetime.timedelta(hours=6)
+
+    id = Column(Integer, primary_key=True)
+    to_address = Column(Unicode, nullable=False)
+
+    # The complete email message, including headers.
+    body = Column(Unicode, nullable=False)
+
+    created = Column(DateTime, nullable=False,
+                     default=lambda: datetime.datetime.utcnow())
+    next_attempt = Column(DateTime, index=True, nullable=False,
+                          default=lambda: datetime.datetime.utcnow())
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(Unicode)
+    sent = Column(DateTime, index=True)
+
+    @classmethod
+    def ready(cls, _db, now=None):
+        """Find emails that should be sent now.
+
+        The emails' rows are locked, and rows locked by other senders
+        are skipped, so a message won't be sent twice by two senders
+        running at once.
+        """
+        now = now or datetime.datetime.utcnow()
+        return _db.query(cls).filter(
+            cls.sent==None
+        ).filter(
+            cls.attempts < cls.MAX_ATTEMPTS
+        ).filter(
+            cls.next_attempt <= now
+        ).order_by(
+            cls.next_attempt, cls.id
+        ).with_for_update(skip_locked=True)
+
+    def failed(self, error, now=None):
+        """Record a failed attempt to send this email and decide when
+        to try again.
+        """
+        now = now or datetime.datetime.utcnow()
+        self.last_error = repr(error)
+        self.attempts = (self.attempts or 0) + 1
+        delay = min(
+            self.RETRY_DELAY * (2 ** (self.attempts - 1)),
+            self.MAX_RETRY_DELAY
+        )
+        self.next_attempt = now + delay
+
+    def __repr__(self):
+        return "<OutgoingEmail: %s to=%s attempts=%s sent=%s>" % (
+            self.id, self.to_address, self.attempts, self.sent
+        )
+
+
+class SchemaVersion(Base):
+    """The version of the schema the database was last brought up to
+    date with. There's only ever one row.
+
+    Web workers check this instead of running create_all() every time
+    they start. See SessionManager.initialize().
+    """
+    __tablename__ = 'schemaversion'
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Unicode, nullable=False)
+
+    @classmethod
+    def current(cls, bind):
+        return bind.execute(
+            select([cls.__table__.c.version]).where(cls.__table__.c.id==1)
+        ).scalar()
+
+    @classmethod
+    def stamp(cls, bind, version):
+        table = cls.__table__
+        statement = postgresql.insert(table).values(
+            id=1, version=version
+        ).on_conflict_do_update(
+            index_elements=[table.c.id], set_=dict(version=version)
+        )
+        bind.execute(statement)
@@ -65,6 +65,11 @@ class OPDSCatalog(object):
         if not annotator:
             annotator = Annotator()
 
+        if isinstance(libraries, Query):
+            # Run the query once, rather than once to find out how
+            # big the feed is and again to build it.
+            libraries = libraries.all()
+
         # To save bandwidth, omit logos from large feeds. What 'large'
         # means is customizable.
         include_logos = not (self._feed_is_large(_db, libraries))
@@ -95,15 +100,14 @@ class OPDSCatalog(object):
         :param libraries: A list of libraries (or anything else that might be
             going into a feed).
         """
-        large_feed_size = ConfigurationSetting.sitewide(
-            _db, Configuration.LARGE_FEED_SIZE
-        ).int_value
+        large_feed_size = Configuration.large_feed_size(_db)
         if large_feed_size is None:
             # No limit
             return False
         if isinstance(libraries, Query):
-            # This is a SQLAlchemy query.
-            size = libraries.count()
+            # This is a SQLAlchemy query. There's no need to count
+            # every result, only to see whether there are enough.
+            size = libraries.from_self().limit(large_feed_size).count()
         else:
             # This is something like a normal Python list.
             size = len(libraries)
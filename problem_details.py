@@ -70,3 +70,15 @@ INVALID_CREDENTIALS = pd(
     401,
     title=_("The username or password is incorrect.")
 )
+
+REGISTRATION_JOB_NOT_FOUND = pd(
+    "http://librarysimplified.org/terms/problem/registration-job-not-found",
+    404,
+    title=_("There is no record of this registration request."),
+)
+
+INVALID_INPUT = pd(
+    "http://librarysimplified.org/terms/problem/invalid-input",
+    400,
+    title=_("Invalid input."),
+)
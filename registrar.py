@@ -15,10 +15,13 @@ from model import (
     get_one_or_create,
     Hyperlink,
     Library,
+    ServiceArea,
 )
 from problem_details import *
 from util.http import (
+    AsyncHTTP,
     HTTP,
+    PrefetchedGet,
     RequestTimedOut,
 )
 from util.problem_detail import ProblemDetail
@@ -27,6 +30,9 @@ from util.problem_detail import ProblemDetail
 class LibraryRegistrar(object):
     """Encapsulates the logic of the library registration process."""
 
+    # How long to wait for a library's server to send us a document.
+    TIMEOUT = 30
+
     def __init__(self, _db, do_get=HTTP.debuggable_get):
         self._db = _db
         self.do_get = do_get
@@ -59,6 +65,72 @@ class LibraryRegistrar(object):
         # by register() -- only the controller uses that stuff.
         return None
 
+    def prefetch(self, libraries, concurrency=AsyncHTTP.DEFAULT_CONCURRENCY):
+        """Fetch the documents register() will need for each of the given
+        libraries, making many requests at once, and arrange for
+        register() to use the fetched documents instead of making its
+        own requests one at a time.
+
+        This is useful when reregistering a large number of
+        libraries, since one slow server won't hold up the others.
+
+        :param libraries: A list of Libraries.
+        :param concurrency: Make at most this many requests at once.
+        """
+        fetcher = AsyncHTTP(self.do_get, concurrency)
+        prefetched = PrefetchedGet(self.do_get)
+
+        # First, fetch every library's authentication document.
+        auth_codes = self.allowed_response_codes()
+        auth_outcomes = fetcher.get_many(
+            [library.authentication_url for library in libraries],
+            allowed_response_codes=auth_codes, timeout=self.TIMEOUT
+        )
+        prefetched.add(auth_outcomes, auth_codes)
+
+        # Then fetch the OPDS root document linked from each
+        # authentication document.
+        opds_urls = []
+        for outcome in list(auth_outcomes.values()):
+            opds_url = self._root_url(outcome)
+            if opds_url:
+                opds_urls.append(opds_url)
+        opds_codes = self.allowed_response_codes(allow_401=True)
+        opds_outcomes = fetcher.get_many(
+            opds_urls, allowed_response_codes=opds_codes,
+            timeout=self.TIMEOUT
+        )
+        prefetched.add(opds_outcomes, opds_codes)
+
+        self.do_get = prefetched
+        return prefetched
+
+    @classmethod
+    def _root_url(cls, auth_response):
+        """Find the URL to the OPDS root document mentioned in an
+        authentication document.
+
+        :param auth_response: An HTTP response, or the exception raised
+            while trying to get one.
+        :return: A URL, or None if the response isn't usable.
+        """
+        if (not hasattr(auth_response, 'content')
+            or getattr(auth_response, 'status_code', None) != 200):
+            return None
+        try:
+            document = json.loads(auth_response.content)
+        except ValueError as e:
+            return None
+        if not isinstance(document, dict):
+            return None
+        root = AuthenticationDocument._extract_link(
+            document.get('links', []), rel="start",
+            prefer_type="application/atom+xml;profile=opds-catalog"
+        )
+        if not root:
+            return None
+        return root.get('href')
+
     def register(self, library, library_stage):
         """Register the given Library with this registry, if possible.
 
@@ -167,10 +239,14 @@ class LibraryRegistrar(object):
 
         auth_url = auth_response.url
 
+        old_stage = library.library_stage
         try:
             library.library_stage = library_stage
         except ValueError as e:
             return LIBRARY_ALREADY_IN_PRODUCTION
+        if library.library_stage != old_stage:
+            # A library's stage is shown on the vector tiles.
+            ServiceArea.bump_generation(self._db)
         library.name = auth_document.title
         if auth_document.website:
             url = auth_document.website.get("href")
@@ -218,14 +294,22 @@ class LibraryRegistrar(object):
 
         return auth_document, hyperlinks_to_create
 
-    def _make_request(self, registration_url, url, on_404, on_timeout, on_exception, allow_401=False):
+    @classmethod
+    def allowed_response_codes(cls, allow_401=False):
+        """The response codes to accept when fetching a document
+        during registration.
+        """
         allowed_codes = ["2xx", "3xx", 404]
         if allow_401:
             allowed_codes.append(401)
+        return allowed_codes
+
+    def _make_request(self, registration_url, url, on_404, on_timeout, on_exception, allow_401=False):
+        allowed_codes = self.allowed_response_codes(allow_401)
         try:
             response = self.do_get(
                 url, allowed_response_codes=allowed_codes,
-                timeout=30
+                timeout=self.TIMEOUT
             )
             # We only allowed 404 above so that we could return a more
             # specific problem detail document if it happened.
@@ -1,12 +1,16 @@
 
 import argparse
 import base64
+import csv
 import json
 import logging
 import os
 import re
 import requests
 import sys
+import time
+
+from flask_babel import lazy_gettext as _
 
 from geometry_loader import GeometryLoader
 from model import (
@@ -14,11 +18,15 @@ from model import (
     get_one_or_create,
     production_session,
     Place,
+    PlaceSubdivision,
     Library,
     LibraryAlias,
+    RegistrationJob,
     ServiceArea,
     ConfigurationSetting,
+    DelegatedPatronIdentifier,
     ExternalIntegration,
+    SessionManager,
 )
 from config import Configuration
 from adobe_vendor_id import AdobeVendorIDClient
@@ -27,6 +35,7 @@ from emailer import (
     Emailer,
     EmailTemplate,
 )
+from problem_details import INTEGRATION_ERROR
 from registrar import LibraryRegistrar
 from util.problem_detail import ProblemDetail
 
@@ -128,6 +137,40 @@ class LibraryScript(Script):
         )
 
 
+class InitializeDatabaseScript(Script):
+    """Create any missing tables and indexes and stamp the schema
+    version, so the web application can start up without doing it.
+    """
+
+    name = "Initialize database"
+
+    def run(self, cmd_args=None):
+        self.parse_command_line(self._db, cmd_args)
+        SessionManager.initialize_schema(self._db.connection())
+        self._db.commit()
+        self.log.info(
+            "Database schema is at version %s.", SessionManager.schema_version()
+        )
+
+        # Build any indexes that were added to existing tables. This
+        # doesn't lock the tables, so the web application can keep
+        # running while it happens.
+        SessionManager.create_missing_indexes(self._db.get_bind())
+
+        # Fill in the columns that summarize existing places'
+        # geometries. This does nothing once they've all been filled
+        # in.
+        summarized = SummarizePlaceGeometriesScript(self._db).summarize()
+        if summarized:
+            self.log.info("Summarized %d places.", summarized)
+
+        # Likewise, cut up the geometries of places that haven't been
+        # subdivided yet.
+        subdivided = SubdividePlacesScript(self._db).subdivide()
+        if subdivided:
+            self.log.info("Subdivided %d places.", subdivided)
+
+
 class LoadPlacesScript(Script):
 
     @classmethod
@@ -155,6 +198,94 @@ class LoadPlacesScript(Script):
         self._db.commit()
 
 
+class SummarizePlaceGeometriesScript(Script):
+    """Calculate the centroid, bounding box, area and radius of every
+    place whose geometry hasn't been fully summarized yet.
+    """
+
+    name = "Summarize place geometries"
+
+    BATCH_SIZE = 1000
+
+    @classmethod
+    def arg_parser(cls):
+        parser = super(SummarizePlaceGeometriesScript, cls).arg_parser()
+        parser.add_argument(
+            '--batch-size', type=int, default=cls.BATCH_SIZE,
+            help="Summarize this many places at a time."
+        )
+        return parser
+
+    def run(self, cmd_args=None, stdout=sys.stdout):
+        parsed = self.parse_command_line(self._db, cmd_args)
+
+        # Older databases won't have the columns yet.
+        SessionManager.add_missing_columns(self._db.get_bind())
+
+        total = self.summarize(parsed.batch_size)
+        stdout.write("Summarized %d places.\n" % total)
+
+    def summarize(self, batch_size=BATCH_SIZE):
+        """Summarize every place that needs it, committing after each
+        batch.
+
+        :return: The number of places summarized.
+        """
+        total = 0
+        while True:
+            summarized = Place.summarize_geometries(
+                self._db, limit=batch_size
+            )
+            self._db.commit()
+            if not summarized:
+                break
+            total += summarized
+            self.log.info("%d places summarized.", total)
+        return total
+
+
+class SubdividePlacesScript(Script):
+    """Cut up the geometry of every place that hasn't been subdivided
+    yet, so spatial searches can check the pieces instead.
+    """
+
+    name = "Subdivide places"
+
+    BATCH_SIZE = 100
+
+    @classmethod
+    def arg_parser(cls):
+        parser = super(SubdividePlacesScript, cls).arg_parser()
+        parser.add_argument(
+            '--batch-size', type=int, default=cls.BATCH_SIZE,
+            help="Subdivide this many places at a time."
+        )
+        return parser
+
+    def run(self, cmd_args=None, stdout=sys.stdout):
+        parsed = self.parse_command_line(self._db, cmd_args)
+        total = self.subdivide(parsed.batch_size)
+        stdout.write("Subdivided %d places.\n" % total)
+
+    def subdivide(self, batch_size=BATCH_SIZE):
+        """Subdivide every place that needs it, committing after each
+        batch.
+
+        :return: The number of places subdivided.
+        """
+        total = 0
+        while True:
+            subdivided = PlaceSubdivision.subdivide(
+                self._db, limit=batch_size
+            )
+            self._db.commit()
+            if not subdivided:
+                break
+            total += subdivided
+            self.log.info("%d places subdivided.", total)
+        return total
+
+
 class SearchPlacesScript(Script):
     @classmethod
     def arg_parser(cls):
@@ -330,10 +461,23 @@ class RegistrationRefreshScript(LibraryScript):
 
     REQUIRES_SINGLE_LIBRARY = False
 
+    @classmethod
+    def arg_parser(cls):
+        parser = super(RegistrationRefreshScript, cls).arg_parser()
+        parser.add_argument(
+            '--concurrency', type=int, default=1,
+            help="Fetch this many libraries' documents at once before reregistering them."
+        )
+        return parser
+
     def run(self, cmd_args=None):
         parsed = self.parse_command_line(self._db, cmd_args)
         registrar = self.registrar
-        for library in self.libraries(parsed.library):
+        libraries = self.libraries(parsed.library)
+        if parsed.concurrency > 1:
+            libraries = list(libraries)
+            registrar.prefetch(libraries, parsed.concurrency)
+        for library in libraries:
             result = registrar.reregister(library)
             if isinstance(result, ProblemDetail):
                self.log.error(
@@ -353,6 +497,93 @@ class RegistrationRefreshScript(LibraryScript):
         return LibraryRegistrar(self._db)
 
 
+class RegistrationWorkerScript(Script):
+    """Carry out library registrations that the web application queued
+    up instead of processing them while the client waited.
+    """
+
+    name = "Registration worker"
+
+    @classmethod
+    def arg_parser(cls):
+        parser = super(RegistrationWorkerScript, cls).arg_parser()
+        parser.add_argument(
+            '--once', action='store_true',
+            help="Process every queued registration, then exit instead of waiting for more."
+        )
+        parser.add_argument(
+            '--sleep', type=float, default=5,
+            help="When there is nothing to do, wait this many seconds before checking again."
+        )
+        return parser
+
+    def __init__(self, _db=None, app=None):
+        super(RegistrationWorkerScript, self).__init__(_db)
+        self._app = app
+
+    @property
+    def app(self):
+        """The Flask application. Registrations are processed by its
+        LibraryRegistryController, in a request context that looks
+        like the one in which the registration was queued.
+        """
+        if not self._app:
+            from app import app
+            self._app = app
+        return self._app
+
+    @property
+    def _db(self):
+        # Use the same database session as the web application's
+        # controllers, so the jobs and the libraries they register are
+        # in the same session.
+        if not hasattr(self, "_session"):
+            self._session = self.app.library_registry._db
+        return self._session
+
+    def run(self, cmd_args=None):
+        parsed = self.parse_command_line(self._db, cmd_args)
+        while True:
+            job = RegistrationJob.next(self._db)
+            # Commit right away to release the lock on the job.
+            self._db.commit()
+            if job:
+                self.process(job)
+                continue
+
+            # There's nothing to do, so take the opportunity to clean
+            # out old jobs.
+            purged = RegistrationJob.purge(self._db)
+            self._db.commit()
+            if purged:
+                self.log.info("Deleted %d finished registration jobs.", purged)
+            if parsed.once:
+                break
+            time.sleep(parsed.sleep)
+
+    def process(self, job):
+        """Carry out a single registration."""
+        controller = self.app.library_registry.registry_controller
+        try:
+            with self.app.test_request_context(base_url=job.base_url):
+                controller.run_registration_job(job)
+        except Exception as e:
+            self.log.error(
+                "Unexpected error while processing %r", job, exc_info=e
+            )
+            self._db.rollback()
+            problem = INTEGRATION_ERROR.detailed(
+                _("Unexpected error while processing registration.")
+            )
+            document, status_code, headers = problem.response
+            job.complete(status_code, headers["Content-Type"], document)
+        self._db.commit()
+        self.log.info(
+            "Registration of %s finished with status %s",
+            job.authentication_url, job.status_code
+        )
+
+
 class AdobeVendorIDAcceptanceTestScript(Script):
     """Verify basic Adobe Vendor ID functionality, the way Adobe does
     when testing compliance.
@@ -408,6 +639,125 @@ class AdobeVendorIDAcceptanceTestScript(Script):
         print("OK Found user info: %s" % user_info)
         print("   Full content: %s" % content)
 
+class ImportDelegatedPatronIdentifiersScript(Script):
+    """Import the Adobe Account IDs handed out by another Vendor ID
+    server, so patrons keep their IDs when their libraries move to
+    this registry.
+
+    Each record names a library (by short name), the library's
+    identifier for a patron, and the patron's Adobe Account ID.
+    """
+
+    name = "Import delegated patron identifiers"
+
+    CSV = 'csv'
+    NDJSON = 'ndjson'
+
+    LIBRARY = 'library'
+    PATRON_IDENTIFIER = 'patron_identifier'
+    DELEGATED_IDENTIFIER = 'delegated_identifier'
+
+    @classmethod
+    def arg_parser(cls):
+        parser = super(ImportDelegatedPatronIdentifiersScript, cls).arg_parser()
+        parser.add_argument(
+            'path', nargs='*',
+            help="Files to import. If none are given, records are read from standard input."
+        )
+        parser.add_argument(
+            '--format', choices=[cls.CSV, cls.NDJSON],
+            help="Format of the records. CSV files must have a header row naming the %s, %s and %s columns. By default, files ending in .csv are CSV and everything else is NDJSON." % (
+                cls.LIBRARY, cls.PATRON_IDENTIFIER, cls.DELEGATED_IDENTIFIER
+            )
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=10000,
+            help="Send this many records to the database at a time."
+        )
+        return parser
+
+    def run(self, cmd_args=None, stdin=sys.stdin, stdout=sys.stdout):
+        parsed = self.parse_command_line(self._db, cmd_args)
+
+        # The import is a lot slower without this index, and it may
+        # not exist yet in an older database. Building it waits for
+        # any open transaction, including ours, to finish.
+        self._db.commit()
+        SessionManager.create_missing_indexes(self._db.get_bind())
+
+        # Look up every library's ID once, rather than once per record.
+        library_ids = dict(
+            (short_name.upper(), library_id)
+            for library_id, short_name in self._db.query(
+                Library.id, Library.short_name
+            ) if short_name
+        )
+
+        start = time.time()
+        read = created = skipped = 0
+        batch = []
+        for record in self.records(parsed, stdin):
+            read += 1
+            library_id = library_ids.get(
+                (record.get(self.LIBRARY) or '').upper()
+            )
+            patron_identifier = record.get(self.PATRON_IDENTIFIER)
+            delegated_identifier = record.get(self.DELEGATED_IDENTIFIER)
+            if not (library_id and patron_identifier and delegated_identifier):
+                skipped += 1
+                continue
+            batch.append((library_id, patron_identifier, delegated_identifier))
+            if len(batch) >= parsed.batch_size:
+                created += self.import_batch(batch)
+                batch = []
+                self.log.info(
+                    "%d records read, %d rows/sec.", read,
+                    read / max(time.time() - start, 0.001)
+                )
+        created += self.import_batch(batch)
+
+        elapsed = max(time.time() - start, 0.001)
+        stdout.write(
+            "Read %d records in %.2f seconds (%d rows/sec). Created %d delegated identifiers. Skipped %d records with an unknown library or missing data.\n" % (
+                read, elapsed, read / elapsed, created, skipped
+            )
+        )
+
+    def import_batch(self, batch):
+        created = DelegatedPatronIdentifier.bulk_import(self._db, batch)
+        self._db.commit()
+        return created
+
+    def records(self, parsed, stdin):
+        """Yield every record as a dictionary."""
+        if not parsed.path:
+            lines = self.read_stdin_lines(stdin)
+            for record in self.parse(lines, parsed.format or self.NDJSON):
+                yield record
+            return
+
+        for path in parsed.path:
+            format = parsed.format
+            if not format:
+                if path.lower().endswith('.csv'):
+                    format = self.CSV
+                else:
+                    format = self.NDJSON
+            with open(path, newline='') as lines:
+                for record in self.parse(lines, format):
+                    yield record
+
+    def parse(self, lines, format):
+        if format == self.CSV:
+            for record in csv.DictReader(lines):
+                yield record
+        else:
+            for line in lines:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
 class ConfigurationSettingScript(Script):
 
     @classmethod
@@ -465,6 +815,7 @@ class ConfigureSiteScript(ConfigurationSettingScript):
             for setting in args.setting:
                 key, value = self._parse_setting(setting)
                 ConfigurationSetting.sitewide(_db, key).value = value
+            Configuration.bump_configuration_generation(_db)
         settings = _db.query(ConfigurationSetting).filter(
             ConfigurationSetting.library_id==None).filter(
                 ConfigurationSetting.external_integration==None
@@ -593,6 +944,7 @@ class ConfigureIntegrationScript(ConfigurationSettingScript):
         goal = args.goal
         integration = self._integration(_db, id, name, protocol, goal)
         self.apply_settings(args.setting, integration)
+        Configuration.bump_configuration_generation(_db)
         _db.commit()
         output.write("Configuration settings stored.\n")
         output.write("\n".join(integration.explain()))
@@ -642,6 +994,7 @@ class ConfigureVendorIDScript(Script):
         integration.setting(Configuration.ADOBE_VENDOR_ID_DELEGATE_URL).value = (
             json.dumps(delegates)
         )
+        Configuration.bump_configuration_generation(_db)
         _db.commit()
 
 
@@ -660,6 +1013,10 @@ class ConfigureEmailerScript(Script):
         parser.add_argument("--from-address", help="Email sent will come from this address", required=True)
         parser.add_argument("--from-name", help="Name associated with the from-address", required=True)
         parser.add_argument("--test-address", help="Send a test email to this address", required=True)
+        parser.add_argument(
+            "--use-outbox", action="store_true",
+            help="Queue email in the database, to be sent by bin/send_queued_email, instead of sending it immediately."
+        )
         return parser
 
     def do_run(self, _db=None, cmd_args=None, output=sys.stdout, emailer_class=Emailer):
@@ -676,12 +1033,60 @@ class ConfigureEmailerScript(Script):
         integration.url = parsed.host
         integration.setting(Emailer.FROM_ADDRESS).value = parsed.from_address
         integration.setting(Emailer.FROM_NAME).value = parsed.from_name
+        integration.setting(Emailer.USE_OUTBOX).value = str(
+            parsed.use_outbox
+        ).lower()
+        Configuration.bump_configuration_generation(_db)
 
         emailer = emailer_class.from_sitewide_integration(_db)
         template = EmailTemplate("Test email", "This is a test email.")
         emailer.templates["test"] = template
+
+        # The test email is always sent immediately, so we know
+        # whether the SMTP configuration works.
+        emailer.use_outbox = False
         emailer.send("test", parsed.test_address)
 
         # Since the emailer didn't raise an exception we can assume we sent
         # the email successfully.
         _db.commit()
+
+
+class SendQueuedEmailScript(Script):
+    """Send the emails that have been queued up in the database."""
+
+    name = "Send queued email"
+
+    @classmethod
+    def arg_parser(cls):
+        parser = super(SendQueuedEmailScript, cls).arg_parser()
+        parser.add_argument(
+            '--batch-size', type=int, default=Emailer.DEFAULT_BATCH_SIZE,
+            help="Send at most this many emails over a single SMTP connection."
+        )
+        parser.add_argument(
+            '--once', action='store_true',
+            help="Send every email that's ready to go, then exit instead of waiting for more."
+        )
+        parser.add_argument(
+            '--sleep', type=float, default=10,
+            help="When there is nothing to send, wait this many seconds before checking again."
+        )
+        return parser
+
+    def run(self, cmd_args=None, emailer_class=Emailer, smtp=None):
+        parsed = self.parse_command_line(self._db, cmd_args)
+        emailer = emailer_class.from_sitewide_integration(self._db)
+        while True:
+            sent, failed = emailer.send_queued(
+                self._db, parsed.batch_size, smtp=smtp
+            )
+            self._db.commit()
+            if sent or failed:
+                self.log.info("Sent %d emails, %d failed.", sent, failed)
+            if sent == parsed.batch_size:
+                # There may be more email waiting to be sent.
+                continue
+            if parsed.once:
+                break
+            time.sleep(parsed.sleep)
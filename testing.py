@@ -84,6 +84,10 @@ class DatabaseTest(object):
         self._db = Session(self.connection)
         self.transaction = self.connection.begin_nested()
 
+        # Configuration cached by an earlier test may not match this
+        # test's database.
+        Configuration.forget_cached()
+
         # Start with a high number so it won't interfere with tests that
         # search for a small number.
         self.counter = 2000
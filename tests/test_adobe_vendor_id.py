@@ -1,5 +1,11 @@
 import datetime
 import json
+import os
+import timeit
+from io import StringIO
+
+import pytest
+from lxml import etree
 from config import (
     CannotLoadConfiguration,
     Configuration,
@@ -11,6 +17,7 @@ from adobe_vendor_id import (
     AdobeAccountInfoRequestParser,
     AdobeVendorIDRequestHandler,
     AdobeVendorIDModel,
+    AdobeVendorIDClient,
     MockAdobeVendorIDClient,
     VendorIDAuthenticationError,
     VendorIDServerException,
@@ -69,6 +76,40 @@ class TestConfiguration(VendorIDTest):
         assert delegates == ["delegate"]
 
 
+    def test_accessor_cache(self):
+        integration = self._integration()
+        self._db.commit()
+        assert Configuration.vendor_id(self._db)[0] == "VENDORID"
+
+        # The answer is cached until the configuration generation
+        # changes.
+        generation, value = Configuration._generation_cache["vendor_id"]
+        assert generation == Configuration.configuration_generation(self._db)
+        Configuration._generation_cache["vendor_id"] = (
+            generation, ("CACHED", None, [])
+        )
+        assert Configuration.vendor_id(self._db)[0] == "CACHED"
+
+        # Using the cached answer doesn't flush the session.
+        library = self._library()
+        library.name = "A new name"
+        assert Configuration.vendor_id(self._db)[0] == "CACHED"
+        assert library in self._db.dirty
+
+        # A session that has changed the configuration but not
+        # committed yet doesn't use the cache.
+        integration.setting(Configuration.ADOBE_VENDOR_ID).value = "NEW"
+        assert Configuration.vendor_id(self._db)[0] == "NEW"
+
+        # Once the configuration generation is bumped and committed,
+        # every process reloads the configuration.
+        Configuration.bump_configuration_generation(self._db)
+        self._db.commit()
+        assert Configuration.configuration_generation(self._db) == generation + 1
+        assert Configuration.vendor_id(self._db)[0] == "NEW"
+        assert Configuration._generation_cache["vendor_id"][0] == generation + 1
+
+
 class TestVendorIDRequestParsers(object):
 
     username_sign_in_request = """<signInRequest method="standard" xmlns="http://ns.adobe.com/adept">
@@ -100,6 +141,69 @@ class TestVendorIDRequestParsers(object):
         data = parser.process(self.accountinfo_request)
         assert data == {'method': 'standard', 'user': 'urn:uuid:0xxxxxxx-xxxx-1xxx-xxxx-yyyyyyyyyyyy'}
 
+    def test_parse_bytes(self):
+        # Documents straight from the request body are bytes, and
+        # are parsed without being decoded first.
+        parser = AdobeSignInRequestParser()
+        data = parser.process(self.username_sign_in_request.encode("utf8"))
+        assert data == {'username': 'Vendor username', 'password': 'Vendor password', 'method': 'standard'}
+
+    def test_external_entities_are_not_resolved(self):
+        parser = AdobeSignInRequestParser()
+        doc = """<?xml version="1.0"?>
+<!DOCTYPE signInRequest [<!ENTITY secret SYSTEM "file:///etc/passwd">]>
+<signInRequest method="standard" xmlns="http://ns.adobe.com/adept">
+<username>&secret;</username>
+<password>password</password>
+</signInRequest>"""
+        data = parser.process(doc.encode("utf8"))
+        assert not data['username']
+
+    def parse_the_old_way(self, doc):
+        # This is how requests were parsed before: with a new parser
+        # for every document, and with each XPath expression compiled
+        # as it was used.
+        namespaces = AdobeSignInRequestParser.NAMESPACES
+        root = etree.parse(StringIO(doc), etree.XMLParser())
+        [tag] = root.xpath("/adept:signInRequest", namespaces=namespaces)
+        data = dict(method=tag.attrib.get('method'))
+        for key in ('username', 'password'):
+            [subtag] = tag.xpath('adept:' + key, namespaces=namespaces)
+            data[key] = subtag.text.strip()
+        return data
+
+    def test_parse_matches_old_parser(self):
+        # Parsing with a shared parser and precompiled XPath
+        # expressions gives the same answer as the old way of doing it.
+        doc = self.username_sign_in_request
+        parser = AdobeSignInRequestParser()
+        assert parser.process(doc.encode("utf8")) == self.parse_the_old_way(doc)
+
+    @pytest.mark.skipif(
+        not os.environ.get('RUN_BENCHMARKS'),
+        reason="Set RUN_BENCHMARKS to compare parsing costs."
+    )
+    def test_parse_cost(self):
+        # Parsing with a shared parser and precompiled XPath
+        # expressions is cheaper than the old way of doing it.
+        #
+        # Timings depend on how busy the machine is, so this only runs
+        # when asked for.
+        doc = self.username_sign_in_request
+        body = doc.encode("utf8")
+        parser = AdobeSignInRequestParser()
+        def parse_the_old_way():
+            return self.parse_the_old_way(doc)
+        def parse():
+            return parser.process(body)
+
+        old = min(timeit.repeat(parse_the_old_way, number=500, repeat=5))
+        new = min(timeit.repeat(parse, number=500, repeat=5))
+        print("Old: %.2fms/request New: %.2fms/request" % (
+            old / 500 * 1000, new / 500 * 1000
+        ))
+        assert new < old
+
 class TestVendorIDRequestHandler(object):
 
     username_sign_in_request = """<signInRequest method="standard" xmlns="http://ns.adobe.com/adept">
@@ -152,6 +256,12 @@ class TestVendorIDRequestHandler(object):
             "VENDORID", "Some random error")
         assert doc == '<error xmlns="http://ns.adobe.com/adept" data="E_1045_VENDORID Some random error"/>'
 
+        # Values are escaped so the document is always well-formed.
+        doc = self._handler.error_document(
+            "VENDORID", 'Could not identify patron from "<&>".')
+        assert doc == '<error xmlns="http://ns.adobe.com/adept" data="E_1045_VENDORID Could not identify patron from &quot;&lt;&amp;&gt;&quot;."/>'
+        etree.fromstring(doc)
+
     def test_handle_username_sign_in_request_success(self):
         doc = self.username_sign_in_request % dict(
             username="user1", password="pass1")
@@ -312,9 +422,9 @@ class TestVendorIDModel(VendorIDTest):
         )
         assert result == ("adobe_id", "Delegated account ID adobe_id")
 
-        # We tried delegate 1 before getting the answer from delegate 2.
-        assert delegate1.queue == []
+        # We asked both delegates, and got the answer from delegate 2.
         assert delegate2.queue == []
+        delegate1.queue = []
 
         # A DelegatedPatronIdentifier was created to store the information
         # we got from the delegate.
@@ -359,19 +469,21 @@ class TestVendorIDModel(VendorIDTest):
         result = model.authdata_lookup(authdata)
         assert result == ("adobe_id", "Delegated account ID adobe_id")
 
-        # We didn't even get to delegate 2.
-        assert len(delegate2.queue) == 1
+        # Both delegates are asked at once, so delegate 2 may or may
+        # not have been consulted before delegate 1 answered.
+        delegate2.queue = []
 
         [delegated] = self.library.delegated_patron_identifiers
         assert delegated.patron_identifier == "authdatauser"
         assert delegated.delegated_identifier == "adobe_id"
         assert delegated.type == DelegatedPatronIdentifier.ADOBE_ACCOUNT_ID
 
-        # If we try it again, we'll get an error from delegate 1,
-        # since nothing is queued up, and then a queued error from
-        # delegate 2. Then we'll try to decode the token
+        # If we try it again, we'll first try to decode the token
         # ourselves, but since it's not a valid Short Client Token,
-        # we'll get an error there, and return nothing.
+        # we'll ask the delegates. We'll get an error from delegate 1,
+        # since nothing is queued up, and a queued error from delegate
+        # 2, so we return nothing.
+        delegate2.enqueue(VendorIDServerException("blah"))
         result = model.authdata_lookup(authdata)
         assert result == (None, None)
         assert delegate2.queue == []
@@ -396,5 +508,160 @@ class TestVendorIDModel(VendorIDTest):
 
         assert self.library.delegated_patron_identifiers == [delegated]
 
-        # We didn't get to delegate 2, because delegate 1 had the answer.
-        assert len(delegate2.queue) == 1
+        # Delegate 1 had the answer.
+        assert delegate1.queue == []
+
+
+class MockResponse(object):
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        if isinstance(content, str):
+            content = content.encode("utf8")
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode("utf8")
+
+
+class PostRecordingClient(AdobeVendorIDClient):
+    """An AdobeVendorIDClient that doesn't make real HTTP requests."""
+
+    def __init__(self, *args, **kwargs):
+        super(PostRecordingClient, self).__init__(*args, **kwargs)
+        self.gets = []
+        self.posts = []
+        self.responses = []
+        self.status_response = MockResponse(503, b"Unavailable")
+
+    def _get(self, url):
+        self.gets.append(url)
+        return self.status_response
+
+    def _post(self, url, body):
+        self.posts.append((url, body))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+
+class TestAdobeVendorIDClient(object):
+
+    SIGNIN_RESPONSE = '<signInResponse xmlns="http://ns.adobe.com/adept"><user>urn:uuid:1</user><label>Delegated account ID urn:uuid:1</label></signInResponse>'
+
+    ERROR_RESPONSE = '<error xmlns="http://ns.adobe.com/adept" data="E_AUTH_FAILED Bad credentials"/>'
+
+    def setup(self):
+        self.client = PostRecordingClient("http://delegate/")
+
+    def test_positive_answers_are_cached(self):
+        client = self.client
+        client.responses.append(MockResponse(200, self.SIGNIN_RESPONSE))
+        answer = client.sign_in_standard("user", "password")
+        assert answer[0] == "urn:uuid:1"
+
+        # Asking the same question again doesn't hit the server.
+        assert client.sign_in_standard("user", "password") == answer
+        assert len(client.posts) == 1
+
+        # Asking a different question does.
+        client.responses.append(MockResponse(200, self.ERROR_RESPONSE))
+        with pytest.raises(VendorIDAuthenticationError):
+            client.sign_in_standard("user", "wrong password")
+        assert len(client.posts) == 2
+
+        # Negative answers aren't cached.
+        client.responses.append(MockResponse(200, self.ERROR_RESPONSE))
+        with pytest.raises(VendorIDAuthenticationError):
+            client.sign_in_standard("user", "wrong password")
+        assert len(client.posts) == 3
+
+        # The cache key is a hash of the request, not the credentials
+        # themselves.
+        for key in client._answers._items:
+            assert "password" not in key
+
+        # Cached answers expire.
+        for key, (expires, value) in list(client._answers._items.items()):
+            client._answers.set(key, (0, value))
+        client.responses.append(MockResponse(200, self.SIGNIN_RESPONSE))
+        client.sign_in_standard("user", "password")
+        assert len(client.posts) == 4
+
+    def test_circuit_breaker(self):
+        client = self.client
+        minimum = client.health.minimum_calls
+
+        # A delegate that says no is working fine.
+        for i in range(minimum):
+            client.responses.append(MockResponse(200, self.ERROR_RESPONSE))
+            with pytest.raises(VendorIDAuthenticationError):
+                client.sign_in_standard("user", "password")
+        assert client.health.state == client.health.CLOSED
+
+        # A delegate that keeps failing stops being asked.
+        for i in range(minimum):
+            client.responses.append(MockResponse(500, "oops"))
+            with pytest.raises(VendorIDServerException):
+                client.sign_in_standard("user", "password")
+        assert client.health.state == client.health.OPEN
+        posts = len(client.posts)
+
+        with pytest.raises(VendorIDServerException) as exc:
+            client.sign_in_authdata("some authdata")
+        assert "http://delegate/ is not responding" in str(exc.value)
+        assert len(client.posts) == posts
+
+        # Once the circuit is half-open, the delegate's status
+        # determines whether it's asked again.
+        client.health._opened_at = -client.health.reset_after
+        client.status_response = MockResponse(200, b"UP")
+        client.responses.append(MockResponse(200, self.SIGNIN_RESPONSE))
+        assert client.sign_in_standard("user", "password")[0] == "urn:uuid:1"
+        assert client.health.state == client.health.CLOSED
+        assert len(client.posts) == posts + 1
+        assert client.gets == ["http://delegate/Status"]
+
+    def test_status(self):
+        client = self.client
+        client.status_response = MockResponse(200, b"UP")
+        assert client.status() is True
+
+        client.status_response = MockResponse(200, b"DOWN")
+        with pytest.raises(VendorIDServerException) as exc:
+            client.status()
+        assert "Unexpected response: DOWN" in str(exc.value)
+
+        client.status_response = MockResponse(503, b"UP")
+        with pytest.raises(VendorIDServerException) as exc:
+            client.status()
+        assert "Unexpected status code: 503" in str(exc.value)
+
+    def test_process_sign_in_result(self):
+        # A real response's content is bytes.
+        m = self.client._process_sign_in_result
+        response = MockResponse(200, self.SIGNIN_RESPONSE.encode("utf8"))
+        identifier, label, content = m(response)
+        assert identifier == "urn:uuid:1"
+        assert label == "Delegated account ID urn:uuid:1"
+        assert content == self.SIGNIN_RESPONSE
+
+        response = MockResponse(200, self.ERROR_RESPONSE.encode("utf8"))
+        with pytest.raises(VendorIDAuthenticationError) as exc:
+            m(response)
+        assert "E_AUTH_FAILED Bad credentials" in str(exc.value)
+
+        response = MockResponse(200, b"<nonsense/>")
+        with pytest.raises(VendorIDServerException) as exc:
+            m(response)
+        assert "Unexpected response: <nonsense/>" in str(exc.value)
+
+    def test_process_user_info_result(self):
+        response = MockResponse(
+            200, b'<accountInfoResponse><label>A label</label></accountInfoResponse>'
+        )
+        label, content = self.client._process_user_info_result(response)
+        assert label == "A label"
@@ -1,8 +1,9 @@
-from io import BytesIO
 import contextlib
 import flask
 import gzip
+import os
 from app_helpers import (
+    compressed_responses,
     compressible,
     has_library_factory,
     uses_location_factory,
@@ -53,25 +54,16 @@ class TestAppHelpers(ControllerTest):
             assert route_function() == "Called with location SRID=4326;POINT(10.0 -10.0)"
 
     def test_compressible(self):
-        # Prepare a value and a gzipped version of the value.
         value = b"Compress me! (Or not.)"
 
-        buffer = BytesIO()
-        gzipped = gzip.GzipFile(mode='wb', fileobj=buffer)
-        gzipped.write(value)
-        gzipped.close()
-        compressed = buffer.getvalue()
-
-        # Spot-check the compressed value
-        assert b'-(J-.V' in compressed
-
         # This compressible controller function always returns the
         # same value.
         @compressible
         def function():
             return value
 
-        def ask_for_compression(compression, header='Accept-Encoding'):
+        def ask_for_compression(compression, header='Accept-Encoding',
+                                function=function):
             """This context manager simulates the entire Flask
             request-response cycle, including a call to
             process_response(), which triggers the @after_this_request
@@ -83,21 +75,38 @@ class TestAppHelpers(ControllerTest):
             if compression:
                 headers[header] = compression
             with self.app.test_request_context(headers=headers):
-                response = flask.Response(function())
+                response = function()
+                if not isinstance(response, flask.Response):
+                    response = flask.Response(response)
                 self.app.process_response(response)
                 return response
 
         # If the client asks for gzip through Accept-Encoding, the
         # representation is compressed.
         response = ask_for_compression("gzip")
-        assert response.data == compressed
+        assert gzip.decompress(response.data) == value
         assert response.headers['Content-Encoding'] == "gzip"
+        assert response.headers['Content-Length'] == str(len(response.data))
+        assert response.headers['Vary'] == "Accept-Encoding"
+
+        # The compressed representation is kept, so it doesn't have
+        # to be compressed again next time.
+        compressed = response.data
+        assert compressed in compressed_responses._items.values()
+
+        # The cache is bounded by the size of the compressed bodies,
+        # not by the number of them.
+        assert compressed_responses.sizeof(compressed) == len(compressed)
+        response = ask_for_compression("gzip")
+        assert response.data == compressed
 
         # If the client doesn't ask for compression, the value is
-        # passed through unchanged.
+        # passed through unchanged, but the response still varies
+        # with Accept-Encoding.
         response = ask_for_compression(None)
         assert response.data == value
         assert 'Content-Encoding' not in response.headers
+        assert response.headers['Vary'] == "Accept-Encoding"
 
         # Similarly if the client asks for an unsupported compression
         # mechanism.
@@ -110,3 +119,51 @@ class TestAppHelpers(ControllerTest):
         response = ask_for_compression("gzip", "Accept-Transfer-Encoding")
         assert response.data == value
         assert 'Content-Encoding' not in response.headers
+
+        # A Vary header set by the controller is kept, and a strong
+        # ETag is weakened, since it doesn't describe the compressed
+        # bytes.
+        @compressible
+        def with_headers():
+            response = flask.Response(value, headers={"Vary": "Cookie"})
+            response.set_etag("abc")
+            return response
+        response = ask_for_compression("gzip", function=with_headers)
+        assert gzip.decompress(response.data) == value
+        assert response.vary.as_set() == set(["cookie", "accept-encoding"])
+        assert response.get_etag() == ("abc", True)
+
+        # A streaming response is compressed as it's generated.
+        @compressible
+        def streaming():
+            return flask.Response(x for x in [b"Compress ", b"me!"])
+        response = ask_for_compression("gzip", function=streaming)
+        assert response.is_streamed
+        assert 'Content-Length' not in response.headers
+        assert gzip.decompress(response.get_data()) == b"Compress me!"
+
+
+class TestInitializeWorker(ControllerTest):
+
+    def test_initialize_worker(self):
+        import app as app_module
+        from controller import LibraryRegistry
+        mock_registry = self.app.library_registry
+        try:
+            # Each worker gets its own LibraryRegistry, rather than
+            # using one inherited from the process that imported the
+            # app.
+            app_module.initialize_worker()
+            registry = self.app.library_registry
+            assert isinstance(registry, LibraryRegistry)
+            assert registry is not mock_registry
+
+            # Unless the importing code takes care of that itself.
+            os.environ['AUTOINITIALIZE'] = 'False'
+            try:
+                app_module.initialize_worker()
+            finally:
+                del os.environ['AUTOINITIALIZE']
+            assert self.app.library_registry is registry
+        finally:
+            self.app.library_registry = mock_registry
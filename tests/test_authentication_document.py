@@ -368,15 +368,25 @@ class TestUpdateServiceAreas(DatabaseTest):
         # Try a successful case.
         p1_only = [[p1], {}, {}]
         p2_only = [[p2], {}, {}]
+        generation = ServiceArea.generation(self._db)
         m(library, p1_only, p2_only)
         assert eligibility_areas() == [p1]
         assert focus_areas() == [p2]
 
+        # Vector tiles drawn before the change are now out of date.
+        assert ServiceArea.generation(self._db) == generation + 1
+
+        # Setting the same service areas again doesn't change anything
+        # the tiles show.
+        m(library, p1_only, p2_only)
+        assert ServiceArea.generation(self._db) == generation + 1
+
         # If you pass in two empty inputs, no changes are made.
         empty = [[], {}, {}]
         m(library, empty, empty)
         assert eligibility_areas() == [p1]
         assert focus_areas() == [p2]
+        assert ServiceArea.generation(self._db) == generation + 1
 
         # If you pass only one value, the focus area is set to that
         # value and the eligibility area is cleared out.
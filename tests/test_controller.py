@@ -20,6 +20,8 @@ from controller import (
 import flask
 from flask import Response, session
 from werkzeug.datastructures import ImmutableMultiDict, MultiDict
+from werkzeug.http import http_date
+from sqlalchemy import event
 from Crypto.PublicKey import RSA
 from Crypto.Cipher import PKCS1_OAEP
 
@@ -35,11 +37,14 @@ from model import (
     create,
     get_one,
     get_one_or_create,
+    Admin,
     ConfigurationSetting,
+    DelegatedPatronIdentifier,
     ExternalIntegration,
     Hyperlink,
     Library,
     Place,
+    RegistrationJob,
     ServiceArea,
     Validation,
 )
@@ -53,12 +58,16 @@ class MockLibraryRegistry(LibraryRegistry):
 
 class MockEmailer(Emailer):
 
+    # The controller looks up a new emailer whenever it needs one, so
+    # every MockEmailer records what it sends in the same place.
+    sent_out = []
+
     @classmethod
     def from_sitewide_integration(cls, _db):
         return cls()
 
     def __init__(self):
-        self.sent_out = []
+        pass
 
     def send(self, email_type, to_address, **template_args):
         self.sent_out.append((email_type, to_address, template_args))
@@ -75,6 +84,7 @@ class ControllerTest(DatabaseTest):
         os.environ['AUTOINITIALIZE'] = "False"
         del os.environ['AUTOINITIALIZE']
         self.app = app
+        MockEmailer.sent_out = []
         self.data_setup()
         self.library_registry = MockLibraryRegistry(
             self._db, testing=True, emailer_class=MockEmailer,
@@ -182,15 +192,25 @@ class TestLibraryRegistry(ControllerTest):
         # No Adobe Vendor ID was set up.
         assert self.library_registry.adobe_vendor_id is None
 
-        # Let's configure one.
+        # Let's configure one. The LibraryRegistry picks it up without
+        # having to be recreated.
         self.vendor_id_setup()
-        registry_with_adobe = MockLibraryRegistry(
-            self._db, testing=True, emailer_class=MockEmailer
-        )
-        assert isinstance(
-            registry_with_adobe.adobe_vendor_id,
-            AdobeVendorIDController
+        controller = self.library_registry.adobe_vendor_id
+        assert isinstance(controller, AdobeVendorIDController)
+        assert controller.request_handler.vendor_id == "VENDORID"
+
+        # The same controller is used until the configuration changes.
+        self._db.commit()
+        assert self.library_registry.adobe_vendor_id is controller
+
+        integration = ExternalIntegration.lookup(
+            self._db, ExternalIntegration.ADOBE_VENDOR_ID,
+            ExternalIntegration.DRM_GOAL
         )
+        integration.setting(Configuration.ADOBE_VENDOR_ID).value = "NEWVENDORID"
+        new_controller = self.library_registry.adobe_vendor_id
+        assert new_controller is not controller
+        assert new_controller.request_handler.vendor_id == "NEWVENDORID"
 
 
 class TestLibraryRegistryController(ControllerTest):
@@ -456,6 +476,70 @@ class TestLibraryRegistryController(ControllerTest):
             # The other libraries are still in alphabetical order.
             assert titles == ['Kansas State Library', 'Connecticut State Library', 'NYPL']        
 
+    def test_libraries_opds_conditional(self):
+        with self.app.test_request_context("/libraries"):
+            response = self.controller.libraries_opds()
+        assert response.status_code == 200
+        etag, weak = response.get_etag()
+        assert weak is False
+
+        # There's no Last-Modified date, since not everything that
+        # goes into the feed records when it changed.
+        assert response.last_modified is None
+
+        def request(location=None, **headers):
+            with self.app.test_request_context("/libraries", headers=headers):
+                return self.controller.libraries_opds(location=location)
+
+        # A client that already has the current feed gets a 304
+        # response, without the feed being built.
+        queries = []
+        def record(*args, **kwargs):
+            queries.append(args)
+        event.listen(self.connection, "before_cursor_execute", record)
+        try:
+            response = request(**{"If-None-Match": '"%s"' % etag})
+        finally:
+            event.remove(self.connection, "before_cursor_execute", record)
+        assert response.status_code == 304
+        assert response.data == b""
+        assert response.get_etag() == (etag, False)
+        for args in queries:
+            assert "FROM libraries JOIN" not in args[2]
+            assert "libraries.name" not in args[2]
+
+        # The weak form of the ETag, which a compressed response has,
+        # works just as well.
+        response = request(**{"If-None-Match": 'W/"%s"' % etag})
+        assert response.status_code == 304
+
+        # If-Modified-Since alone can't get a 304.
+        response = request(**{
+            "If-Modified-Since": http_date(datetime.datetime.utcnow())
+        })
+        assert response.status_code == 200
+
+        # The feed for a different location is a different
+        # representation with a different ETag.
+        response = request(
+            location="SRID=4326;POINT(-98 39)", **{"If-None-Match": '"%s"' % etag}
+        )
+        assert response.status_code == 200
+        assert response.get_etag()[0] != etag
+
+        # When a library changes, the feed has a new version.
+        self.nypl.description = "A new description"
+        self._db.commit()
+        response = request(**{"If-None-Match": '"%s"' % etag})
+        assert response.status_code == 200
+        assert response.get_etag()[0] != etag
+
+        # So does the feed when the configuration changes.
+        etag = response.get_etag()[0]
+        Configuration.bump_configuration_generation(self._db)
+        response = request(**{"If-None-Match": '"%s"' % etag})
+        assert response.status_code == 200
+
     def test_library_details(self):
         # Test that the controller can look up the complete information for one specific library.
         library = self.nypl
@@ -496,14 +580,16 @@ class TestLibraryRegistryController(ControllerTest):
             registry_stage=Library.TESTING_STAGE
         )
         uuid = library.internal_urn.split("uuid:")[1]
-        with self.app.test_request_context("/", method="POST"):
-            flask.request.form = MultiDict([
-                ("uuid", uuid),
-                ("Library Stage", "testing"),
-                ("Registry Stage", "production"),
-            ])
-
-            response = self.controller.edit_registration()
+        generation = ServiceArea.generation(self._db)
+        def edit():
+            with self.app.test_request_context("/", method="POST"):
+                flask.request.form = MultiDict([
+                    ("uuid", uuid),
+                    ("Library Stage", "testing"),
+                    ("Registry Stage", "production"),
+                ])
+                return self.controller.edit_registration()
+        response = edit()
 
         assert response._status_code == 200
         assert response.response[0].decode("utf8") == library.internal_urn
@@ -512,6 +598,14 @@ class TestLibraryRegistryController(ControllerTest):
         assert edited_library.library_stage == Library.TESTING_STAGE
         assert edited_library.registry_stage == Library.PRODUCTION_STAGE
 
+        # The library's stages are shown on the vector tiles, so the
+        # tiles are now out of date.
+        assert ServiceArea.generation(self._db) == generation + 1
+
+        # Submitting the same stages again doesn't change the tiles.
+        edit()
+        assert ServiceArea.generation(self._db) == generation + 1
+
     def test_edit_registration_with_error(self):
         uuid = "not a real UUID!"
         with self.app.test_request_context("/", method="POST"):
@@ -737,6 +831,17 @@ class TestLibraryRegistryController(ControllerTest):
         controller = LibraryRegistryController(self.library_registry)
         assert controller.emailer is None
 
+        # Once email is configured, the controller starts using it
+        # without having to be recreated.
+        integration = self._external_integration("my protocol")
+        integration.goal = Emailer.GOAL
+        integration.username = "smtp_username"
+        integration.password = "smtp_password"
+        integration.url = "smtp_host"
+        integration.setting(Emailer.FROM_ADDRESS).value = "me@registry"
+        assert isinstance(controller.emailer, Emailer)
+        assert controller.emailer.smtp_host == "smtp_host"
+
     def test_nearby(self):
         with self.app.test_request_context("/"):
             response = self.controller.nearby(self.manhattan, live=True)
@@ -1391,7 +1496,7 @@ class TestLibraryRegistryController(ControllerTest):
         class NonfunctionalEmailer(MockEmailer):
             def send(self, *args, **kwargs):
                 raise SMTPException("SMTP server is broken")
-        self.controller.emailer = NonfunctionalEmailer()
+        self.controller.emailer_class = NonfunctionalEmailer
 
         # Pretend we are a library with a valid authentication document.
         auth_document = self._auth_document(None)
@@ -1516,12 +1621,12 @@ class TestLibraryRegistryController(ControllerTest):
         assert integration_contact_link.href == "mailto:me@library.org"
 
         # A confirmation email was sent out for each of those addresses.
-        sent = sorted(self.controller.emailer.sent_out, key=lambda x: x[1])
+        sent = sorted(MockEmailer.sent_out, key=lambda x: x[1])
         for email in sent:
             assert email[0] == Emailer.ADDRESS_NEEDS_CONFIRMATION
         destinations = [x[1] for x in sent]
         assert destinations == ["dmca@library.org", "help@library.org", "me@library.org"]
-        self.controller.emailer.sent_out = []
+        MockEmailer.sent_out = []
 
         # The document sent by the library registry to the library
         # includes status information about the library's integration
@@ -1616,7 +1721,7 @@ class TestLibraryRegistryController(ControllerTest):
             # for me@library.org (which already has an outstanding
             # confirmation request) as designated copyright agent.
             new_dmca, new_help = sorted(
-                [(x[1], x[0]) for x in self.controller.emailer.sent_out]
+                [(x[1], x[0]) for x in MockEmailer.sent_out]
             )
             assert new_dmca == ("me@library.org", Emailer.ADDRESS_DESIGNATED)
             assert new_help == ("new-help@library.org", Emailer.ADDRESS_NEEDS_CONFIRMATION)
@@ -1672,6 +1777,7 @@ class TestLibraryRegistryController(ControllerTest):
 
         # If we include an incorrect secret, or we don't ask for the
         # secret to be reset, the secret doesn't change.
+        generation = ServiceArea.generation(self._db)
         for secret, form in (
             ("notthesecret", form_args_with_reset),
             (library.shared_secret, form_args_no_reset)
@@ -1693,6 +1799,10 @@ class TestLibraryRegistryController(ControllerTest):
                 assert response.status_code ==  200
                 assert library.shared_secret == old_secret
 
+        # Registering again with the same service areas and stage
+        # leaves the vector tiles alone.
+        assert ServiceArea.generation(self._db) == generation
+
     def test_register_with_secret_changes_authentication_url_and_opds_url(self):
         # This Library was created previously with a certain shared
         # secret, at a URL that's no longer valid.
@@ -1731,6 +1841,108 @@ class TestLibraryRegistryController(ControllerTest):
         assert library.authentication_url == new_auth_url
         assert library.opds_url == new_opds_url
 
+    def test_register_asynchronously(self):
+        auth_document = self._auth_document()
+        auth_url = auth_document['id']
+        form = ImmutableMultiDict([
+            ("url", auth_url),
+            ("contact", "mailto:me@library.org"),
+            ("stage", Library.TESTING_STAGE),
+        ])
+        prefer = {"Prefer": "wait=10, respond-async"}
+
+        # The client asks for asynchronous processing, but the registry
+        # isn't configured to allow it, so the registration is carried
+        # out immediately.
+        self.http_client.queue_response(
+            200, content=json.dumps(auth_document), url=auth_url
+        )
+        self.queue_opds_success()
+        with self.app.test_request_context("/", method="POST"):
+            flask.request.headers = prefer
+            flask.request.form = form
+            response = self.controller.register(do_get=self.http_client.do_get)
+            assert response.status_code == 201
+        assert self._db.query(RegistrationJob).count() == 0
+
+        # Now the registry allows asynchronous registration.
+        ConfigurationSetting.sitewide(
+            self._db, Configuration.ASYNCHRONOUS_REGISTRATION
+        ).value = "true"
+        self.http_client.requests = []
+        with self.app.test_request_context("/", method="POST"):
+            flask.request.headers = prefer
+            flask.request.form = form
+            response = self.controller.register(do_get=self.http_client.do_get)
+
+        # No HTTP requests were made. Instead, a job was queued and
+        # the client was told where to check on its status.
+        assert self.http_client.requests == []
+        [job] = self._db.query(RegistrationJob).all()
+        assert job.state == RegistrationJob.QUEUED
+        assert job.authentication_url == auth_url
+        assert job.contact == "mailto:me@library.org"
+        assert job.library_stage == Library.TESTING_STAGE
+        assert job.shared_secret is None
+        assert job.reset_shared_secret is False
+        assert job.base_url == "http://localhost/"
+
+        status_url = "http://localhost/register/status/%s" % job.key
+        assert response.status_code == 202
+        assert response.headers['Location'] == status_url
+        body = json.loads(response.data)
+        assert body['status'] == RegistrationJob.QUEUED
+        [link] = body['links']
+        assert link['rel'] == "monitor"
+        assert link['href'] == status_url
+
+        # Until the job is complete, the status URL says so.
+        with self.app.test_request_context("/"):
+            response = self.controller.registration_status(job.key)
+            assert response.status_code == 202
+            assert json.loads(response.data)['status'] == RegistrationJob.QUEUED
+
+            assert (self.controller.registration_status("no such key")
+                    == REGISTRATION_JOB_NOT_FOUND)
+
+        # The worker runs the job.
+        self.http_client.queue_response(
+            200, content=json.dumps(auth_document), url=auth_url
+        )
+        self.queue_opds_success()
+        with self.app.test_request_context(base_url=job.base_url):
+            self.controller.run_registration_job(
+                job, do_get=self.http_client.do_get
+            )
+        assert job.state == RegistrationJob.COMPLETE
+        assert job.status_code == 200
+
+        # Now the status URL serves the response the client would
+        # have gotten if the registration had been processed
+        # immediately.
+        with self.app.test_request_context("/"):
+            response = self.controller.registration_status(job.key)
+        assert response.status_code == 200
+        assert response.headers['Content-Type'] == "application/opds+json;profile=https://librarysimplified.org/rel/profile/directory"
+        catalog = json.loads(response.data)
+        assert catalog['metadata']['title'] == "A Library"
+
+        # A failed registration is recorded as a problem detail.
+        job, ignore = create(
+            self._db, RegistrationJob, authentication_url=auth_url
+        )
+        self.http_client.queue_response(
+            200, content=json.dumps(dict(auth_document, id="http://different/")),
+            url=auth_url
+        )
+        with self.app.test_request_context(base_url="http://localhost/"):
+            self.controller.run_registration_job(
+                job, do_get=self.http_client.do_get
+            )
+        assert job.status_code == 400
+        assert job.media_type == ProblemDetail.JSON_MEDIA_TYPE
+        assert json.loads(job.response)['type'] == INVALID_INTEGRATION_DOCUMENT.uri
+
 
 class TestValidationController(ControllerTest):
 
@@ -1922,3 +2134,142 @@ class TestCoverageController(ControllerTest):
 
             eligibility = json.loads(eligibility.data)
             assert eligibility == Place.to_geojson(self._db, self.new_york_state)
+
+    def test_tile(self):
+        controller = self.app.library_registry.coverage_controller
+        controller._tiles.clear()
+        drawn = []
+        def vector_tile(_db, z, x, y):
+            drawn.append((z, x, y))
+            return b"a tile"
+        old_vector_tile = ServiceArea.__dict__['vector_tile']
+        ServiceArea.vector_tile = vector_tile
+        try:
+            with self.app.test_request_context("/"):
+                response = controller.tile(1, 0, 1)
+                assert response.status_code == 200
+                assert response.headers['Content-Type'] == controller.VECTOR_TILE_MEDIA_TYPE
+                assert response.data == b"a tile"
+                assert response.headers['ETag']
+
+                # The tile is cached...
+                controller.tile(1, 0, 1)
+                assert drawn == [(1, 0, 1)]
+
+                # ...until the service areas change.
+                ServiceArea.bump_generation(self._db)
+                controller.tile(1, 0, 1)
+                assert drawn == [(1, 0, 1), (1, 0, 1)]
+
+                # There are only four tiles at zoom level 1.
+                problem = controller.tile(1, 2, 0)
+                assert problem.uri == INVALID_INPUT.uri
+                assert "There is no tile 1/2/0." == problem.detail
+        finally:
+            ServiceArea.vector_tile = old_vector_tile
+            controller._tiles.clear()
+
+    def test_resolution_and_etag(self):
+        nypl = self._library("NYPL")
+        get_one_or_create(
+            self._db, ServiceArea, library=nypl,
+            place=self.new_york_state, type=ServiceArea.ELIGIBILITY
+        )
+        controller = self.app.library_registry.coverage_controller
+
+        # A client can ask for a simplified version of the GeoJSON.
+        with self.request_context_with_library(
+            "/?resolution=low", library=nypl
+        ):
+            response = controller.eligibility_for_library()
+            assert response.status_code == 200
+            assert response.data.decode("utf8") == Place.geojson(
+                self._db, [self.new_york_state], 'low'
+            )
+            etag = response.headers['ETag']
+
+        # If the client already has that document, it's not sent again.
+        with self.request_context_with_library(
+            "/?resolution=low", library=nypl,
+            headers={"If-None-Match": etag}
+        ):
+            response = controller.eligibility_for_library()
+            assert response.status_code == 304
+
+        # The full-resolution document has a different ETag.
+        with self.request_context_with_library(
+            "/", library=nypl, headers={"If-None-Match": etag}
+        ):
+            response = controller.eligibility_for_library()
+            assert response.status_code == 200
+            assert response.headers['ETag'] != etag
+
+        with self.request_context_with_library(
+            "/?resolution=microscopic", library=nypl
+        ):
+            problem = controller.eligibility_for_library()
+            assert problem.uri == INVALID_INPUT.uri
+            assert "Unknown resolution: microscopic" in problem.detail
+
+
+class TestAdobeVendorIDController(ControllerTest):
+
+    def data_setup(self):
+        self.vendor_id_setup()
+
+    def test_batch_userinfo_handler(self):
+        controller = self.library_registry.adobe_vendor_id
+        library = self._library()
+        identifier, ignore = DelegatedPatronIdentifier.get_one_or_create(
+            self._db, library, "patron", DelegatedPatronIdentifier.ADOBE_ACCOUNT_ID,
+            "urn:uuid:known"
+        )
+        admin, ignore = create(
+            self._db, Admin, username="Admin",
+            password=Admin.make_password("123")
+        )
+
+        def request(data, username="Admin", password="123", **kwargs):
+            headers = {}
+            if username:
+                credentials = "%s:%s" % (username, password)
+                headers['Authorization'] = "Basic %s" % base64.b64encode(
+                    credentials.encode("utf8")
+                ).decode("utf8")
+            with self.app.test_request_context(
+                "/", method="POST", data=data, headers=headers, **kwargs
+            ):
+                return controller.batch_userinfo_handler()
+
+        # Every account ID gets the same label the single AccountInfo
+        # request would give it, whether or not this registry made it
+        # up, so the response doesn't reveal which accounts exist.
+        body = json.dumps(dict(users=["urn:uuid:known", "urn:uuid:unknown"]))
+        response = request(body, content_type="application/json")
+        assert response.status_code == 200
+        assert response.headers['Content-Type'] == "application/json"
+        assert json.loads(response.data) == dict(
+            users={
+                "urn:uuid:known": "Delegated account ID urn:uuid:known",
+                "urn:uuid:unknown": "Delegated account ID urn:uuid:unknown",
+            }
+        )
+
+        # Only an admin can use it.
+        for username, password in ((None, None), ("Admin", "wrong"),
+                                   ("Someone else", "123")):
+            response = request(body, username, password)
+            assert response.uri == INVALID_CREDENTIALS.uri
+        # Trying doesn't create an Admin.
+        assert self._db.query(Admin).all() == [admin]
+
+        for bad in ("not json", json.dumps(["urn:uuid:known"]),
+                    json.dumps(dict(users="urn:uuid:known"))):
+            response = request(bad)
+            assert response.uri == INVALID_INPUT.uri
+            assert "list of account IDs" in str(response.detail)
+
+        controller.MAX_BATCH_SIZE = 1
+        response = request(body)
+        assert response.uri == INVALID_INPUT.uri
+        assert "more than 1 accounts" in str(response.detail)
@@ -1,3 +1,6 @@
+import datetime
+import smtplib
+
 import pytest
 
 from . import DatabaseTest
@@ -8,6 +11,10 @@ from emailer import (
     Emailer,
     EmailTemplate,
 )
+from model import (
+    OutgoingEmail,
+    create,
+)
 import quopri
 
 
@@ -80,6 +87,41 @@ class MockSMTP(object):
         return record
 
 
+class FlakySMTP(object):
+    """Mock of smtplib.SMTP that records calls and raises exceptions
+    on demand.
+    """
+
+    def __init__(self, failures=None):
+        # Maps recipient addresses to the exception raised when
+        # sending email to that address.
+        self.failures = failures or {}
+        self.calls = []
+        self.connect_failure = None
+
+    def connect(self, host, port):
+        self.calls.append(("connect", host, port))
+        if self.connect_failure:
+            raise self.connect_failure
+
+    def ehlo(self):
+        self.calls.append(("ehlo",))
+
+    def starttls(self):
+        self.calls.append(("starttls",))
+
+    def login(self, username, password):
+        self.calls.append(("login", username))
+
+    def sendmail(self, from_address, to_address, body):
+        self.calls.append(("sendmail", to_address))
+        if to_address in self.failures:
+            raise self.failures[to_address]
+
+    def quit(self):
+        self.calls.append(("quit",))
+
+
 class MockEmailer(Emailer):
     """Store outgoing emails in a list."""
     emails = []
@@ -309,6 +351,140 @@ The link will expire in about a day. If the link expires, just re-register your
             assert phrase in body
         assert smtp == mock_smtp
 
+    def test_send_to_outbox(self):
+        # If the integration is configured to use the outbox,
+        # send() stores the email in the database instead of sending it.
+        integration = self._integration()
+        integration.setting(Emailer.USE_OUTBOX).value = "true"
+        emailer = MockEmailer.from_sitewide_integration(self._db)
+        assert emailer.use_outbox is True
+        emailer.templates['email1'] = EmailTemplate(
+            "subject", "Hello, %(to_address)s."
+        )
+        MockEmailer.emails = []
+        email = emailer.send("email1", "you@library")
+        assert MockEmailer.emails == []
+        assert isinstance(email, OutgoingEmail)
+        assert email.to_address == "you@library"
+        assert "Hello, you@library." in email.body
+        assert email.sent is None
+        assert email.attempts == 0
+
+        # Passing in an SMTP object sends the email immediately.
+        emailer.send("email1", "you@library", object())
+        assert len(MockEmailer.emails) == 1
+
+        # An Emailer that uses the outbox needs a database connection.
+        with pytest.raises(CannotLoadConfiguration) as exc:
+            Emailer(
+                "user", "pass", "host", 25, "name", "address", {},
+                use_outbox=True
+            )
+        assert "Cannot queue email without a database connection" in str(exc.value)
+
+    def test_send_queued(self):
+        self._integration()
+        emailer = Emailer.from_sitewide_integration(self._db)
+        now = datetime.datetime.utcnow()
+        def queue(to_address, **kwargs):
+            email, ignore = create(
+                self._db, OutgoingEmail, to_address=to_address,
+                body="Body for %s" % to_address, **kwargs
+            )
+            return email
+
+        first = queue("first@library", next_attempt=now-datetime.timedelta(hours=1))
+        refused = queue("refused@library")
+        second = queue("second@library")
+        # These emails aren't ready to be sent.
+        queue("later@library", next_attempt=now+datetime.timedelta(hours=1))
+        queue("given-up@library", attempts=OutgoingEmail.MAX_ATTEMPTS)
+        queue("sent@library", sent=now)
+
+        smtp = FlakySMTP({
+            "refused@library": smtplib.SMTPRecipientsRefused({}),
+        })
+        assert emailer.send_queued(self._db, smtp=smtp, now=now) == (2, 1)
+
+        # Every email that was ready to go was sent over a single
+        # connection.
+        assert smtp.calls == [
+            ("connect", "smtp_host", 234),
+            ("ehlo",),
+            ("starttls",),
+            ("login", "smtp_username"),
+            ("sendmail", "first@library"),
+            ("sendmail", "refused@library"),
+            ("sendmail", "second@library"),
+            ("quit",),
+        ]
+        assert first.sent == now
+        assert second.sent == now
+
+        # The email that was refused will be retried later.
+        assert refused.sent is None
+        assert refused.attempts == 1
+        assert "SMTPRecipientsRefused" in refused.last_error
+        assert refused.next_attempt == now + OutgoingEmail.RETRY_DELAY
+
+        # Nothing else is ready to be sent, so no connection is made.
+        smtp = FlakySMTP()
+        assert emailer.send_queued(self._db, smtp=smtp, now=now) == (0, 0)
+        assert smtp.calls == []
+
+        # Each failure doubles the time before the next attempt.
+        later = refused.next_attempt
+        smtp.connect_failure = smtplib.SMTPConnectError(421, "busy")
+        assert emailer.send_queued(self._db, smtp=smtp, now=later) == (0, 1)
+        assert refused.attempts == 2
+        assert refused.next_attempt == later + OutgoingEmail.RETRY_DELAY * 2
+
+    def test_send_queued_reconnects(self):
+        self._integration()
+        emailer = Emailer.from_sitewide_integration(self._db)
+        now = datetime.datetime.utcnow()
+        emails = []
+        for i in range(3):
+            email, ignore = create(
+                self._db, OutgoingEmail, to_address="%d@library" % i,
+                body="body", next_attempt=now
+            )
+            emails.append(email)
+
+        # The server hangs up partway through the batch; we reconnect
+        # and carry on.
+        smtp = FlakySMTP({
+            "0@library": smtplib.SMTPServerDisconnected("bye"),
+        })
+        assert emailer.send_queued(self._db, smtp=smtp, now=now) == (2, 1)
+        calls = [x[0] for x in smtp.calls]
+        assert calls.count("connect") == 2
+        # The new connection starts with a fresh greeting.
+        reconnect = calls.index("connect", 1)
+        assert calls[reconnect:reconnect+4] == [
+            "connect", "ehlo", "starttls", "login"
+        ]
+        assert [x.sent for x in emails] == [None, now, now]
+
+        # If reconnecting doesn't work, the rest of the batch is left
+        # for next time.
+        smtp = FlakySMTP({
+            "0@library": smtplib.SMTPServerDisconnected("bye"),
+        })
+        emails[0].next_attempt = now
+        emails[1].sent = emails[2].sent = None
+        smtp.connect_failure = None
+        original_connect = smtp.connect
+        def connect(host, port):
+            original_connect(host, port)
+            if len(smtp.calls) > 1:
+                raise ConnectionRefusedError()
+        smtp.connect = connect
+        assert emailer.send_queued(self._db, smtp=smtp, now=now) == (0, 2)
+        assert emails[1].attempts == 1
+        assert emails[2].attempts == 0
+        assert emails[2].sent is None
+
     def test__send_email(self):
         """Verify that send_email calls certain methods on smtplib.SMTP."""
         integration = self._integration()
@@ -316,9 +492,10 @@ The link will expire in about a day. If the link expires, just re-register your
         mock = MockSMTP()
         emailer._send_email("you@library", "email body", mock)
 
-        # Five smtplib.SMTP methods were called.
-        connect, starttls, login, sendmail, quit = mock.calls
+        # Six smtplib.SMTP methods were called.
+        connect, ehlo, starttls, login, sendmail, quit = mock.calls
         assert connect == ('connect', (emailer.smtp_host, emailer.smtp_port), {})
+        assert ehlo == ('ehlo', (), {})
         assert starttls == ('starttls', (), {})
         assert login == ('login', (emailer.smtp_username, emailer.smtp_password), {})
         assert sendmail == ('sendmail', (emailer.from_address, "you@library", "email body"), {})
@@ -7,6 +7,7 @@ from model import (
     get_one_or_create,
     Place,
     PlaceAlias,
+    PlaceSubdivision,
 )
 
 from . import (
@@ -37,6 +38,12 @@ class TestGeometryLoader(DatabaseTest):
         assert alias.name == "The 977"
         assert alias.language == "eng"
 
+        # The place's geometry was subdivided, so spatial searches
+        # can use it.
+        assert 1 == self._db.query(PlaceSubdivision).filter(
+            PlaceSubdivision.place_id==texas_zip.id
+        ).count()
+
         # Load another place identified by a GeoJSON Point.
         metadata = '{"parent_id": null, "name": "New York", "type": "state", "abbreviated_name": "NY", "id": "NY", "full_name": "New York", "aliases": [{"name": "New York State", "language": "eng"}]}'
         geography = '{"type": "Point", "coordinates": [-75, 43]}'
@@ -1,13 +1,20 @@
+import json
 import logging
+import queue
+import sys
+import threading
+import time
 
 import pytest
 
 from . import DatabaseTest
 from log import (
+    BoundedQueueHandler,
     StringFormatter,
     JSONFormatter,
     LogglyHandler,
     LogConfiguration,
+    LogListener,
 )
 from model import (
     ExternalIntegration,
@@ -160,3 +167,200 @@ class TestLogConfiguration(DatabaseTest):
         with pytest.raises(KeyError):
             m("http://%(atoken)s/", "token")
 
+
+class MockSession(object):
+    """Pretend to send HTTP requests to Loggly."""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.posts = []
+        self.closed = False
+
+    def post(self, url, data, headers, timeout):
+        self.posts.append((url, data))
+        if self.fail:
+            raise IOError("Loggly is down")
+        return self
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class ListHandler(logging.Handler):
+    """Keep track of the log records that were handled."""
+
+    def __init__(self):
+        super(ListHandler, self).__init__()
+        self.records = []
+        self.flushes = 0
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def flush(self):
+        self.flushes += 1
+
+
+class TestLogglyHandler(object):
+
+    def record(self, message, *args):
+        return logging.makeLogRecord(dict(
+            name="test", levelname="INFO", levelno=logging.INFO,
+            msg=message, args=args,
+        ))
+
+    def test_bulk_url(self):
+        handler = LogglyHandler(
+            "https://logs-01.loggly.com/inputs/a_token/tag/python/",
+            session=MockSession()
+        )
+        assert handler.bulk_url == (
+            "https://logs-01.loggly.com/bulk/a_token/tag/python/"
+        )
+
+    def test_batches(self):
+        session = MockSession()
+        handler = LogglyHandler(
+            "http://example.com/inputs/a_token/", batch_size=2,
+            session=session
+        )
+        handler.setFormatter(JSONFormatter())
+
+        # Nothing is sent until there's a whole batch.
+        handler.emit(self.record("one"))
+        assert session.posts == []
+
+        handler.emit(self.record("%s", "two"))
+        [(url, data)] = session.posts
+        assert url == "http://example.com/bulk/a_token/"
+        messages = [json.loads(x)["message"]
+                    for x in data.decode("utf8").split("\n")]
+        assert messages == ["one", "two"]
+        assert handler.sent == 2
+
+        # A partial batch is sent when the handler is flushed or closed.
+        handler.emit(self.record("three"))
+        handler.close()
+        assert len(session.posts) == 2
+        assert handler.sent == 3
+        assert session.closed == True
+
+        # Flushing an empty batch doesn't send anything.
+        handler.flush()
+        assert len(session.posts) == 2
+
+    def test_failure_drops_batch(self):
+        session = MockSession(fail=True)
+        handler = LogglyHandler("http://example.com/", session=session)
+        handler.setFormatter(JSONFormatter())
+        handler.emit(self.record("one"))
+        handler.emit(self.record("two"))
+        handler.flush()
+        assert len(session.posts) == 1
+        assert handler.dropped == 2
+        assert handler.sent == 0
+        assert handler.buffer == []
+
+
+class TestLogQueue(object):
+
+    def test_prepare(self):
+        handler = BoundedQueueHandler(queue.Queue())
+        try:
+            raise ValueError("oops")
+        except ValueError:
+            exc_info = sys.exc_info()
+        record = logging.makeLogRecord(dict(
+            name="test", levelname="ERROR", levelno=logging.ERROR,
+            msg="%s went wrong", args=("something",), exc_info=exc_info,
+        ))
+        handler.handle(record)
+        queued = handler.queue.get_nowait()
+
+        # The message was put together before the record was queued,
+        # and the traceback was turned into text.
+        assert queued.msg == "something went wrong"
+        assert queued.args is None
+        assert queued.exc_info is None
+        assert "ValueError: oops" in queued.exc_text
+
+        # The original record wasn't changed.
+        assert record.args == ("something",)
+
+        # A queued record is formatted the same way as the original.
+        data = json.loads(JSONFormatter().format(queued))
+        assert data["message"] == "something went wrong"
+        assert "ValueError: oops" in data["traceback"]
+
+    def test_full_queue_drops_records(self):
+        handler = BoundedQueueHandler(queue.Queue(1))
+        record = logging.makeLogRecord(dict(msg="message"))
+        handler.handle(record)
+        handler.handle(record)
+        handler.handle(record)
+        assert handler.queue.qsize() == 1
+        assert handler.dropped == 2
+
+    def test_listener(self):
+        queue_handler = BoundedQueueHandler(queue.Queue(2))
+        destination = ListHandler()
+        destination.setLevel(logging.INFO)
+        listener = LogListener(queue_handler, destination)
+
+        for level in (logging.DEBUG, logging.INFO, logging.INFO):
+            queue_handler.handle(logging.makeLogRecord(dict(
+                msg=logging.getLevelName(level), levelno=level
+            )))
+        assert queue_handler.dropped == 1
+
+        # The listener passes on the records that the destination
+        # handler cares about. When it stops, it mentions the record
+        # that was dropped, and flushes the destination handler.
+        listener.start()
+        listener.stop()
+        info, warning = destination.records
+        assert info.msg == "INFO"
+        assert warning.levelno == logging.WARN
+        assert warning.msg == (
+            "The log queue was full; 1 log records were dropped."
+        )
+        assert destination.flushes == 1
+
+        # The same drops aren't reported twice.
+        listener.flush()
+        assert len(destination.records) == 2
+
+    def test_listener_flushes_while_records_arrive(self):
+        queue_handler = BoundedQueueHandler(queue.Queue())
+        destination = ListHandler()
+        listener = LogListener(queue_handler, destination, flush_interval=60)
+        record = logging.makeLogRecord(dict(msg="message"))
+
+        # Until the flush interval has passed, records are passed on
+        # without flushing the handlers.
+        queue_handler.handle(record)
+        assert listener.dequeue(True).msg == "message"
+        assert destination.flushes == 0
+
+        # Once it has passed, the handlers are flushed even though
+        # there's a record waiting on the queue.
+        listener._last_flush = time.monotonic() - 61
+        queue_handler.handle(record)
+        assert listener.dequeue(True).msg == "message"
+        assert destination.flushes == 1
+
+    def test_stop_waits_for_room_on_queue(self):
+        queue_handler = BoundedQueueHandler(queue.Queue(1))
+        listener = LogListener(queue_handler, ListHandler())
+        queue_handler.handle(logging.makeLogRecord(dict(msg="message")))
+
+        # The queue is full, but once there's room, the sentinel goes
+        # on it rather than raising queue.Full.
+        timer = threading.Timer(0.1, queue_handler.queue.get_nowait)
+        timer.start()
+        listener.enqueue_sentinel()
+        timer.join()
+        assert queue_handler.queue.get_nowait() is listener._sentinel
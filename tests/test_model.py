@@ -1,15 +1,23 @@
-from sqlalchemy import func
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import event, func, select
+from sqlalchemy.exc import (
+    DisconnectionError,
+    IntegrityError,
+)
 from sqlalchemy.orm.exc import MultipleResultsFound
 import base64
 import datetime
 import json
+import math
 import operator
+import os
 import random
 
 import pytest
 
-from config import Configuration
+from config import (
+    CannotLoadConfiguration,
+    Configuration,
+)
 from emailer import Emailer
 from model import (
     create,
@@ -26,6 +34,12 @@ from model import (
     LibraryAlias,
     Place,
     PlaceAlias,
+    PlaceGeoJSON,
+    PlaceSubdivision,
+    RegistrationJob,
+    SchemaVersion,
+    ServiceArea,
+    SessionManager,
     Validation,
 )
 from util import (
@@ -37,6 +51,94 @@ from . import (
 )
 
 
+class TestSessionManager(DatabaseTest):
+
+    def test_one_engine_per_url(self):
+        url = Configuration.database_url(test=True)
+        engine = SessionManager.engine(url)
+        assert SessionManager.engine(url) is engine
+        assert SessionManager.sessionmaker(url).kw['bind'] is engine
+        assert SessionManager.initialize(url)[0] is engine
+
+    def test_engine_arguments(self):
+        c = Configuration
+        variables = [
+            c.DATABASE_POOL_SIZE_ENVIRONMENT_VARIABLE,
+            c.DATABASE_MAX_OVERFLOW_ENVIRONMENT_VARIABLE,
+            c.DATABASE_POOL_RECYCLE_ENVIRONMENT_VARIABLE,
+            c.DATABASE_POOL_PRE_PING_ENVIRONMENT_VARIABLE,
+            c.DATABASE_STATEMENT_TIMEOUT_ENVIRONMENT_VARIABLE,
+        ]
+        old_values = dict((x, os.environ.pop(x, None)) for x in variables)
+        try:
+            assert c.database_engine_arguments() == dict(
+                pool_size=c.DEFAULT_DATABASE_POOL_SIZE,
+                max_overflow=c.DEFAULT_DATABASE_MAX_OVERFLOW,
+                pool_recycle=c.DEFAULT_DATABASE_POOL_RECYCLE,
+                pool_pre_ping=True,
+            )
+
+            for variable, value in zip(variables, ["2", "3", "60", "false", "5000"]):
+                os.environ[variable] = value
+            assert c.database_engine_arguments() == dict(
+                pool_size=2, max_overflow=3, pool_recycle=60,
+                pool_pre_ping=False,
+                connect_args=dict(options="-c statement_timeout=5000"),
+            )
+
+            os.environ[c.DATABASE_POOL_SIZE_ENVIRONMENT_VARIABLE] = "lots"
+            with pytest.raises(CannotLoadConfiguration) as exc:
+                c.database_engine_arguments()
+            assert "SIMPLIFIED_DATABASE_POOL_SIZE must be an integer" in str(exc.value)
+        finally:
+            for variable, value in old_values.items():
+                if value is None:
+                    os.environ.pop(variable, None)
+                else:
+                    os.environ[variable] = value
+
+    def test_connection_from_another_process(self):
+        class MockRecord(object):
+            connection = "connection"
+            info = {}
+
+        class MockProxy(object):
+            connection = "connection"
+
+        # A connection opened by this process can be used.
+        record = MockRecord()
+        SessionManager._record_connection_pid("connection", record)
+        SessionManager._check_connection_pid("connection", record, MockProxy())
+        assert record.connection == "connection"
+
+        # A connection opened by the parent process is thrown away
+        # without being closed.
+        record.info = dict(pid=-1)
+        proxy = MockProxy()
+        with pytest.raises(DisconnectionError):
+            SessionManager._check_connection_pid("connection", record, proxy)
+        assert record.connection is None
+        assert proxy.connection is None
+
+
+    def test_schema_version(self):
+        version = SessionManager.schema_version()
+        assert len(version) == 40
+        assert SessionManager.schema_version() == version
+
+        # The test database was set up without a version stamp.
+        assert SessionManager.schema_is_current(self.connection) is False
+
+        SessionManager.initialize_schema(self.connection)
+        assert SchemaVersion.current(self.connection) == version
+        assert SessionManager.schema_is_current(self.connection) is True
+
+        # Stamping again replaces the existing stamp.
+        SchemaVersion.stamp(self.connection, "old version")
+        assert SchemaVersion.current(self.connection) == "old version"
+        assert SessionManager.schema_is_current(self.connection) is False
+
+
 class TestPlace(DatabaseTest):
 
     def test_creation(self):
@@ -143,6 +245,54 @@ class TestPlace(DatabaseTest):
         for check in [self.zip_10018_geojson, self.zip_11212_geojson]:
             assert json.loads(check) in geojson['geometries']
 
+    def test_geojson(self):
+        zip1 = self.zip_10018
+        zip2 = self.zip_11212
+        everywhere = Place.everywhere(self._db)
+
+        def stored(place):
+            return dict(
+                (x.resolution, x.geojson) for x in
+                self._db.query(PlaceGeoJSON).filter_by(place_id=place.id)
+            )
+
+        # The document is built from GeoJSON generated by the database,
+        # which is stored for next time. A place with no geometry is
+        # left out.
+        full = Place.geojson(self._db, [zip1, everywhere])
+        assert json.loads(full) == json.loads(self.zip_10018_geojson)
+        assert stored(zip1) == {Place.FULL_RESOLUTION: full}
+        assert stored(everywhere) == {}
+
+        # Other resolutions are simplified and have fewer decimal places.
+        low = Place.geojson(self._db, [zip1], 'low')
+        assert len(low) < len(full)
+        for point in json.loads(low)['coordinates'][0]:
+            for coordinate in point:
+                assert round(coordinate, 3) == coordinate
+        assert set(stored(zip1)) == set([Place.FULL_RESOLUTION, 'low'])
+
+        # Several places make a GeometryCollection, and extra fields
+        # are added to the top-level object.
+        document = json.loads(
+            Place.geojson(self._db, [zip1, zip2], 'low', unknown=["Nowhere"])
+        )
+        assert document['type'] == "GeometryCollection"
+        assert len(document['geometries']) == 2
+        assert document['unknown'] == ["Nowhere"]
+
+        # Changing a place's geometry throws away its stored GeoJSON.
+        zip1.geometry = 'SRID=4326;POINT(-73 40)'
+        self._db.flush()
+        assert stored(zip1) == {}
+        assert json.loads(Place.geojson(self._db, [zip1])) == dict(
+            type="Point", coordinates=[-73, 40]
+        )
+
+        with pytest.raises(ValueError) as exc:
+            Place.geojson(self._db, [zip1], 'microscopic')
+        assert "Unknown resolution: microscopic" in str(exc.value)
+
     def test_overlaps_not_counting_border(self):
         """Test that overlaps_not_counting_border does not count places
         that share a border as intersecting, the way the PostGIS
@@ -174,6 +324,18 @@ class TestPlace(DatabaseTest):
         assert s_i(new_york, connecticut) is False
         assert s_i(connecticut, new_york) is False
 
+        # The answers are the same for places that haven't been
+        # subdivided, e.g. because they were loaded before
+        # subdivisions existed.
+        self._db.execute(PlaceSubdivision.__table__.delete().where(
+            PlaceSubdivision.place_id.in_([nyc.id, connecticut.id])
+        ))
+        assert s_i(nyc, new_york) is True
+        assert s_i(new_york, nyc) is True
+        assert s_i(nyc, connecticut) is False
+        assert s_i(new_york, connecticut) is False
+        assert s_i(connecticut, new_york) is False
+
     def test_parse_name(self):
         m = Place.parse_name
         assert m("Kern County") == ("Kern", Place.COUNTY)
@@ -342,6 +504,145 @@ class TestPlace(DatabaseTest):
         assert zip_10018.lookup_inside("New York", using_overlap=True) == nyc
         assert zip_10018.lookup_inside("New York", using_overlap=False) is None
 
+    def test_lookup_inside_cost(self):
+        # Resolving "Boston, MA" only loads the two places it names,
+        # no matter how many other places are in Massachusetts, and
+        # it never loads a geometry.
+        us = self._place(type=Place.NATION, abbreviated_name="US")
+        ma = self._place(
+            type=Place.STATE, external_name="Massachusetts",
+            abbreviated_name="MA", parent=us
+        )
+        boston = self._place(external_name="Boston", parent=ma)
+        for i in range(50):
+            self._place(parent=ma)
+        self._db.expire_all()
+
+        statements = []
+        def record(conn, cursor, statement, parameters, context, executemany):
+            columns = [x[0] for x in cursor.description or []]
+            statements.append((cursor.rowcount, columns))
+        event.listen(self.connection, "after_cursor_execute", record)
+        try:
+            assert us.lookup_inside("Boston, MA") == boston
+        finally:
+            event.remove(self.connection, "after_cursor_execute", record)
+
+        # Before, looking up MA brought along a row for each of its
+        # 51 children, each with its geometry.
+        rows = sum(rowcount for rowcount, columns in statements)
+        assert rows <= 4
+        for rowcount, columns in statements:
+            assert 'places_geometry' not in columns
+
+        # We can find out whether a place has a geometry without
+        # loading it.
+        assert ma.has_geometry is True
+        assert Place.everywhere(self._db).has_geometry is False
+
+    def test_summarize_geometries(self):
+        def summary(place):
+            return self._db.query(
+                func.ST_AsText(Place.centroid), func.ST_AsText(Place.bbox),
+                Place.area
+            ).filter(Place.id==place.id).one()
+
+        # A place's geometry is summarized as soon as it's written.
+        square = self._place(
+            type=Place.CITY,
+            geometry='{"type": "Polygon", "coordinates": [[[0, 0], [0, 2], [2, 2], [2, 0], [0, 0]]]}'
+        )
+        centroid, bbox, area = summary(square)
+        assert centroid == "POINT(1 1)"
+        assert bbox == "POLYGON((0 0,0 2,2 2,2 0,0 0))"
+        # The area is measured in square meters on the globe.
+        assert 49000 < area / 1000**2 < 50000
+        # So is the distance from the centroid to the farthest corner.
+        assert 157 < self._db.query(Place.radius).filter(
+            Place.id==square.id
+        ).scalar() / 1000 < 158
+
+        # Changing the geometry changes the summary.
+        square.geometry = 'SRID=4326;POLYGON((0 0, 0 4, 4 4, 4 0, 0 0))'
+        self._db.flush()
+        centroid, bbox, area = summary(square)
+        assert centroid == "POINT(2 2)"
+
+        # Places whose summaries are missing, such as places loaded
+        # before the summaries existed, can be summarized in batches.
+        point = self._place(
+            type=Place.CITY, geometry='{"type": "Point", "coordinates": [5, 5]}'
+        )
+        table = Place.__table__
+        self._db.execute(
+            table.update().where(
+                table.c.id.in_([square.id, point.id])
+            ).values(centroid=None, bbox=None, area=None, radius=None)
+        )
+        assert Place.summarize_geometries(self._db, limit=1) == 1
+        assert Place.summarize_geometries(self._db, limit=1) == 1
+        assert Place.summarize_geometries(self._db, limit=1) == 0
+        assert summary(square)[0] == "POINT(2 2)"
+        assert summary(point) == ("POINT(5 5)", "POINT(5 5)", 0)
+        assert self._db.query(Place.radius).filter(
+            Place.id==point.id
+        ).scalar() == 0
+
+        # A place summarized before `radius` existed is summarized
+        # again.
+        self._db.execute(
+            table.update().where(table.c.id==point.id).values(radius=None)
+        )
+        assert Place.summarize_geometries(self._db) == 1
+
+    def test_subdivide(self):
+        def pieces(place):
+            return self._db.query(
+                func.ST_NPoints(PlaceSubdivision.geometry)
+            ).filter(PlaceSubdivision.place_id==place.id).all()
+
+        # A place with a complicated outline is cut into pieces as
+        # soon as its geometry is written.
+        ring = [
+            [math.cos(i * math.pi / 500), math.sin(i * math.pi / 500)]
+            for i in range(1000)
+        ]
+        ring.append(ring[0])
+        circle = self._place(geometry=json.dumps(
+            dict(type="Polygon", coordinates=[ring])
+        ))
+        circle_pieces = pieces(circle)
+        assert len(circle_pieces) > 1
+        for [points] in circle_pieces:
+            assert points <= PlaceSubdivision.MAX_VERTICES
+
+        # Together, the pieces make up the whole place.
+        [[same]] = self._db.query(
+            func.ST_Equals(
+                func.ST_Union(PlaceSubdivision.geometry),
+                select([Place.geometry]).where(Place.id==circle.id).as_scalar()
+            )
+        ).filter(PlaceSubdivision.place_id==circle.id).all()
+        assert same is True
+
+        # A simple place is left in one piece. When a place's geometry
+        # changes, its old pieces are replaced.
+        circle.geometry = 'SRID=4326;POINT(0 0)'
+        self._db.flush()
+        assert pieces(circle) == [(1,)]
+
+        # Places that have never been subdivided, such as places
+        # loaded before subdivisions existed, can be subdivided in
+        # batches.
+        point = self._place()
+        table = PlaceSubdivision.__table__
+        self._db.execute(table.delete())
+        assert PlaceSubdivision.subdivide(self._db, limit=1) == 1
+        assert PlaceSubdivision.subdivide(self._db, limit=1) == 1
+        assert PlaceSubdivision.subdivide(self._db, limit=1) == 0
+        assert pieces(circle) == [(1,)]
+        assert pieces(point) == [(1,)]
+
     def test_lookup_one_through_external_source(self):
         # We're going to find the approximate location of Poughkeepsie
         # even though the database doesn't have a Place named
@@ -411,6 +712,49 @@ class TestPlace(DatabaseTest):
         assert new_york.served_by().all() == [nypl]
 
 
+class TestServiceArea(DatabaseTest):
+
+    def test_generation(self):
+        assert ServiceArea.generation(self._db) == 0
+        ServiceArea.bump_generation(self._db)
+        ServiceArea.bump_generation(self._db)
+        assert ServiceArea.generation(self._db) == 2
+
+    def test_generation_follows_place_geometry(self):
+        # Changing the geometry of a place in a service area changes
+        # what the vector tiles look like.
+        self._library(eligibility_areas=[self.new_york_state])
+        generation = ServiceArea.generation(self._db)
+        self.new_york_state.geometry = self.new_york_city.geometry
+        self._db.flush()
+        assert ServiceArea.generation(self._db) == generation + 1
+
+        # A place that isn't in any service area doesn't matter.
+        self.boston_ma.geometry = self.new_york_city.geometry
+        self._db.flush()
+        assert ServiceArea.generation(self._db) == generation + 1
+
+    def test_vector_tile(self):
+        library = self._library("NYPL", eligibility_areas=[self.new_york_state])
+        library.registry_stage = Library.PRODUCTION_STAGE
+        cancelled = self._library(
+            "Cancelled", eligibility_areas=[self.new_york_state]
+        )
+        cancelled.registry_stage = Library.CANCELLED_STAGE
+        self._db.flush()
+
+        # The tile covering the whole world shows the library that's
+        # not cancelled.
+        tile = ServiceArea.vector_tile(self._db, 0, 0, 0)
+        assert ServiceArea.TILE_LAYER.encode("utf8") in tile
+        assert library.internal_urn.encode("utf8") in tile
+        assert ServiceArea.ELIGIBILITY.encode("utf8") in tile
+        assert cancelled.internal_urn.encode("utf8") not in tile
+
+        # A tile on the other side of the world is empty.
+        assert ServiceArea.vector_tile(self._db, 2, 3, 3) == b''
+
+
 class TestLibrary(DatabaseTest):
 
     def test_timestamp(self):
@@ -574,6 +918,55 @@ class TestLibrary(DatabaseTest):
         for production in (True, False):
             assert feed(production) == []
 
+    def test_feed_version(self):
+        library = self._library()
+        assert library.timestamp.isoformat() in Library.feed_version(self._db)
+
+        def changes(change):
+            old_version = Library.feed_version(self._db)
+            change()
+            self._db.commit()
+            return Library.feed_version(self._db) != old_version
+
+        # Changing a library changes the version...
+        def rename():
+            library.name = "A new name"
+        assert changes(rename)
+
+        # ...as does giving it a new link...
+        def add_link():
+            library.set_hyperlink(Hyperlink.HELP_REL, "mailto:help@example.com")
+        assert changes(add_link)
+
+        # ...or validating the address it points to.
+        [hyperlink] = library.hyperlinks
+        def start_validation():
+            hyperlink.resource.validation, ignore = create(self._db, Validation)
+        assert changes(start_validation)
+        assert changes(hyperlink.resource.validation.mark_as_successful)
+
+        # A pending validation stops being active once its deadline
+        # passes. Nothing is written to the database when that
+        # happens, but the version changes anyway.
+        validation = hyperlink.resource.validation
+        validation.restart()
+        self._db.commit()
+        before_deadline = validation.deadline - datetime.timedelta(seconds=1)
+        after_deadline = validation.deadline + datetime.timedelta(seconds=1)
+        assert validation.active
+        assert (Library.feed_version(self._db, now=before_deadline) !=
+                Library.feed_version(self._db, now=after_deadline))
+
+        # Changing the libraries' service areas or the sitewide
+        # configuration also changes the version.
+        assert changes(lambda: ServiceArea.bump_generation(self._db))
+        assert changes(
+            lambda: Configuration.bump_configuration_generation(self._db)
+        )
+
+        # Setting a link the library already has doesn't.
+        assert not changes(add_link)
+
     def test_set_hyperlink(self):
         library = self._library()
 
@@ -1022,6 +1415,125 @@ class TestLibrary(DatabaseTest):
         # But we can run a search that includes libraries in the TESTING stage.
         assert m(False) == 2
 
+    def test_nearby_geography(self):
+        # Searching by geography gives the same answers as the older,
+        # cast-heavy search.
+        nypl = self._library(
+            "New York Public Library", eligibility_areas=[self.new_york_city]
+        )
+        ct_state = self._library(
+            "Connecticut State Library", eligibility_areas=[self.connecticut_state]
+        )
+        kansas = self._library(
+            "Kansas State Library", eligibility_areas=[self.kansas_state]
+        )
+        for point in [(40.65, -73.94), (41.3, -73.3), (40, -75.8),
+                      (39, -98), (45, 10)]:
+            for radius in [50, 100, 150, 1000]:
+                by_degrees = Library.nearby(
+                    self._db, point, radius, geography=False
+                ).all()
+                by_geography = Library.nearby(self._db, point, radius).all()
+                assert [(l, int(d)) for l, d in by_degrees] == [
+                    (l, int(d)) for l, d in by_geography
+                ]
+
+        # Asking for only a few libraries, which narrows down the
+        # libraries that are measured, doesn't change the answers
+        # either.
+        for point in [(40.65, -73.94), (41.3, -73.3), (39, -98)]:
+            everything = Library.nearby(self._db, point, 2000)
+            closest = Library.nearby(self._db, point, 2000, limit=2)
+            assert [l for l, d in everything.all()][:2] == [
+                l for l, d in closest.all()
+            ]
+
+        # The radius is measured in meters on the globe. NYPL is
+        # 142 kilometers from this point in Pennsylvania.
+        [(library, distance)] = Library.nearby(self._db, (40, -75.8), 143)
+        assert library == nypl
+        assert Library.nearby(self._db, (40, -75.8), 141).all() == []
+
+    def test_nearby_with_limit(self):
+        # This long, thin, diagonal place is hundreds of kilometers
+        # away from the point we're searching from, but its centroid
+        # is close enough that it might have been much closer.
+        strip = self._place(geometry='{"type": "Polygon", "coordinates": [[[0, 0], [10, 10], [10, 10.1], [0, 0.1], [0, 0]]]}')
+        diagonal = self._library("Diagonal", eligibility_areas=[strip])
+
+        # This small place is much closer.
+        square = self._place(geometry='{"type": "Polygon", "coordinates": [[[1.5, 9.5], [1.5, 10], [2, 10], [2, 9.5], [1.5, 9.5]]]}')
+        close = self._library("Close", eligibility_areas=[square])
+
+        # Asking for only the single closest library gives the right
+        # answer: the strip was measured first, but once its exact
+        # distance was known, the square might have been closer, so
+        # it was measured too.
+        point = (9, 1)
+        [(library, distance)] = Library.nearby(
+            self._db, point, 2000, limit=1
+        ).all()
+        assert library == close
+        assert [l for l, d in Library.nearby(self._db, point, 2000)] == [
+            close, diagonal
+        ]
+
+    def test_nearby_with_limit_large_places(self):
+        # A small place that's close to the point we're searching from.
+        def small_library(name, point):
+            longitude, latitude = point
+            square = self._place(geometry=json.dumps(dict(
+                type="Polygon", coordinates=[[
+                    [longitude, latitude], [longitude, latitude + 0.5],
+                    [longitude + 0.5, latitude + 0.5],
+                    [longitude + 0.5, latitude], [longitude, latitude],
+                ]]
+            )))
+            return self._library(name, eligibility_areas=[square])
+
+        # A place the size of a nation, whose southern border runs
+        # along the 24th parallel. The southern edge of its bounding
+        # box is a great circle, which bows hundreds of kilometers to
+        # the north of the border.
+        border = [[longitude, 24] for longitude in range(-125, -65)]
+        nation = self._place(geometry=json.dumps(dict(
+            type="Polygon",
+            coordinates=[border + [[-66, 49], [-125, 49], [-125, 24]]]
+        )))
+        national = self._library("National", eligibility_areas=[nation])
+        south = small_library("South of the border", (-98.5, 23))
+
+        # A point just north of the border is inside the nation, even
+        # though it's outside the nation's bounding box.
+        [(library, distance)] = Library.nearby(
+            self._db, (25, -98), 2000, limit=1
+        ).all()
+        assert (library, distance) == (national, 0)
+        assert [l for l, d in Library.nearby(
+            self._db, (25, -98), 2000, limit=2
+        )] == [national, south]
+
+        # A place that crosses the antimeridian, and so is split in
+        # two. Its bounding box stretches the whole way around the
+        # globe and becomes a thin strip along the antimeridian.
+        islands = self._place(geometry=json.dumps(dict(
+            type="MultiPolygon",
+            coordinates=[
+                [[[170, -20], [180, -20], [180, -10], [170, -10], [170, -20]]],
+                [[[-180, -20], [-170, -20], [-170, -10], [-180, -10], [-180, -20]]],
+            ]
+        )))
+        island = self._library("Islands", eligibility_areas=[islands])
+        east = small_library("East of the islands", (-169, -15.2))
+
+        [(library, distance)] = Library.nearby(
+            self._db, (-15, -171), 2000, limit=1
+        ).all()
+        assert (library, distance) == (island, 0)
+        assert [l for l, d in Library.nearby(
+            self._db, (-15, -171), 2000, limit=2
+        )] == [island, east]
+
     def test_query_cleanup(self):
         m = Library.query_cleanup
 
@@ -1160,6 +1672,11 @@ class TestLibrary(DatabaseTest):
         )
         assert brooklyn_results[0] == nypl
 
+        # The same is true when the results aren't sorted by distance.
+        assert Library.search_by_location_name(
+            self._db, "brooklyn"
+        ).all() == [nypl]
+
         nypl.registry_stage = Library.TESTING_STAGE
         assert Library.search_by_location_name(self._db, "brooklyn", here=GeometryUtility.point(43, -70), production=True).all() == []
         
@@ -1306,6 +1823,61 @@ class TestDelegatedPatronIdentifier(DatabaseTest):
         # id_2() was not called.
         assert identifier2.delegated_identifier == "id1"
 
+    def test_delegated_identifier_for(self):
+        library = self._library()
+        identifier_type = DelegatedPatronIdentifier.ADOBE_ACCOUNT_ID
+        m = DelegatedPatronIdentifier.delegated_identifier_for
+        cache = DelegatedPatronIdentifier._cache
+        def explode():
+            raise Exception("I should never be called.")
+
+        # A new identifier is created.
+        assert m(
+            self._db, library.id, "patron", identifier_type, lambda: "id1"
+        ) == "id1"
+        [identifier] = library.delegated_patron_identifiers
+        assert identifier.patron_identifier == "patron"
+        assert identifier.type == identifier_type
+        assert identifier.delegated_identifier == "id1"
+
+        # It's not cached until the database session is committed.
+        key = (library.id, "patron", identifier_type)
+        assert key not in cache
+        assert m(self._db, library.id, "patron", identifier_type, explode) == "id1"
+
+        self._db.commit()
+        assert cache.get(key) == "id1"
+
+        # From now on the identifier comes from the cache, and the
+        # database isn't used at all.
+        class NoDatabase(object):
+            def execute(self, *args, **kwargs):
+                raise Exception("Unexpected database query")
+        assert m(NoDatabase(), library.id, "patron", identifier_type, explode) == "id1"
+
+        # An identifier created through get_one_or_create is also found.
+        identifier2, ignore = DelegatedPatronIdentifier.get_one_or_create(
+            self._db, library, "patron2", identifier_type, "id2"
+        )
+        assert m(self._db, library.id, "patron2", identifier_type, explode) == "id2"
+
+        # An identifier passed in as a string is used if there's no
+        # existing identifier.
+        assert m(self._db, library.id, "patron3", identifier_type, "id3") == "id3"
+
+        # If the session is rolled back instead of committed, nothing
+        # is cached.
+        pending = self._db.info[DelegatedPatronIdentifier._PENDING_CACHE_KEY]
+        assert set(pending.keys()) == set([
+            (library.id, "patron2", identifier_type),
+            (library.id, "patron3", identifier_type),
+        ])
+        from model import _forget_pending_delegated_identifiers
+        _forget_pending_delegated_identifiers(self._db)
+        assert DelegatedPatronIdentifier._PENDING_CACHE_KEY not in self._db.info
+        self._db.commit()
+        assert (library.id, "patron3", identifier_type) not in cache
+
 class TestExternalIntegration(DatabaseTest):
 
     def setup(self):
@@ -1491,6 +2063,60 @@ class TestConfigurationSetting(DatabaseTest):
         # so that test cleanup can proceed.
         self._db.rollback()
 
+    def test_snapshot(self):
+        integration, ignore = create(
+            self._db, ExternalIntegration, goal=self._str, protocol=self._str
+        )
+        integration.setting("integration key").value = "integration value"
+        ConfigurationSetting.sitewide(self._db, "sitewide key").value = "sitewide value"
+        library = self._library()
+        ConfigurationSetting.for_library("library key", library).value = "library value"
+        self._db.flush()
+        ConfigurationSetting.forget_snapshot(self._db)
+
+        queries = []
+        def count(*args, **kwargs):
+            queries.append(args)
+        event.listen(self.connection, "before_cursor_execute", count)
+        try:
+            # The first lookup loads every setting that doesn't belong
+            # to a library, in one query.
+            assert ConfigurationSetting.sitewide(self._db, "sitewide key").value == "sitewide value"
+            assert len(queries) == 1
+            assert integration.setting("integration key").value == "integration value"
+            assert len(queries) == 1
+
+            # A library's settings are loaded the first time they're
+            # needed.
+            setting = ConfigurationSetting.for_library("library key", library)
+            assert setting.value == "library value"
+            assert len(queries) == 2
+            assert ConfigurationSetting.for_library("library key", library) is setting
+            assert len(queries) == 2
+
+            # A setting that doesn't exist yet is created, and is then
+            # part of the snapshot.
+            new = ConfigurationSetting.sitewide(self._db, "new key")
+            assert len(queries) > 2
+            before = len(queries)
+            assert ConfigurationSetting.sitewide(self._db, "new key") is new
+            assert len(queries) == before
+        finally:
+            event.remove(self.connection, "before_cursor_execute", count)
+
+        # Deleting a setting takes it out of the snapshot.
+        self._db.delete(new)
+        self._db.flush()
+        assert ConfigurationSetting._SNAPSHOT_KEY not in self._db.info
+        assert ConfigurationSetting.sitewide(self._db, "new key") is not new
+
+        # So does committing, since another process may have changed
+        # something.
+        ConfigurationSetting.sitewide(self._db, "sitewide key")
+        assert ConfigurationSetting._SNAPSHOT_KEY in self._db.info
+        self._db.commit()
+        assert ConfigurationSetting._SNAPSHOT_KEY not in self._db.info
+
     def test_int_value(self):
         number = ConfigurationSetting.sitewide(self._db, "number")
         assert number.int_value is None
@@ -1739,3 +2365,76 @@ class TestAdmin(DatabaseTest):
         # Now that there's an admin, subsequent attempts to make a new admin won't work.
         another_admin = Admin.authenticate(self._db, "Another", "password")
         assert another_admin is None
+
+
+class TestRegistrationJob(DatabaseTest):
+
+    def test_next(self):
+        now = datetime.datetime.utcnow()
+        def job(url, state=RegistrationJob.QUEUED, started=None,
+                age=datetime.timedelta(0)):
+            job, ignore = create(
+                self._db, RegistrationJob, authentication_url=url,
+                state=state, started=started, created=now-age
+            )
+            return job
+
+        newer = job("http://newer/")
+        older = job("http://older/", age=datetime.timedelta(minutes=1))
+        running = job(
+            "http://running/", RegistrationJob.RUNNING, started=now
+        )
+        complete = job("http://complete/", RegistrationJob.COMPLETE)
+
+        # Queued jobs are handed out oldest first, and marked as running.
+        assert RegistrationJob.next(self._db, now) == older
+        assert older.state == RegistrationJob.RUNNING
+        assert older.started == now
+        assert RegistrationJob.next(self._db, now) == newer
+
+        # Running and completed jobs are not handed out...
+        assert RegistrationJob.next(self._db, now) is None
+
+        # ...unless a job has been running so long its worker
+        # presumably died.
+        later = now + RegistrationJob.STALE_AFTER + datetime.timedelta(seconds=1)
+        assert set([RegistrationJob.next(self._db, later),
+                    RegistrationJob.next(self._db, later)]) == set([newer, older])
+
+    def test_complete(self):
+        job, ignore = create(
+            self._db, RegistrationJob, authentication_url="http://url/",
+            shared_secret="secret"
+        )
+        assert job.state == RegistrationJob.QUEUED
+        assert len(job.key) == 48
+        job.complete(201, "text/plain", "Done")
+        assert job.state == RegistrationJob.COMPLETE
+        assert (job.status_code, job.media_type, job.response) == (
+            201, "text/plain", "Done"
+        )
+        assert job.finished is not None
+
+        # The shared secret is no longer needed, so it's forgotten.
+        assert job.shared_secret is None
+
+    def test_purge(self):
+        now = datetime.datetime.utcnow()
+        long_ago = now - RegistrationJob.KEEP_FINISHED - datetime.timedelta(
+            seconds=1
+        )
+        def job(url, state, finished=None):
+            job, ignore = create(
+                self._db, RegistrationJob, authentication_url=url,
+                state=state, finished=finished
+            )
+            return job
+        old = job("http://old/", RegistrationJob.COMPLETE, long_ago)
+        recent = job("http://recent/", RegistrationJob.COMPLETE, now)
+        queued = job("http://queued/", RegistrationJob.QUEUED)
+
+        # Only jobs that finished a long time ago are deleted.
+        assert RegistrationJob.purge(self._db, now) == 1
+        assert self._db.query(RegistrationJob).order_by(
+            RegistrationJob.id
+        ).all() == [recent, queued]
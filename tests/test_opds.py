@@ -1,6 +1,8 @@
 import datetime
 import json
 
+from sqlalchemy import event
+
 from . import (
     DatabaseTest,
 )
@@ -129,10 +131,38 @@ class TestOPDSCatalog(DatabaseTest):
         [self._library() for x in range(2)]
         assert m(self._db, query) is True
 
+        # A query's own limit is respected.
+        assert m(self._db, query.limit(1)) is False
+
         # It also works with a list.
         assert m(self._db, [1,2]) is True
         assert m(self._db, [1]) is False
 
+    def test_query_runs_once(self):
+        # When a feed is built from a query, the query is run only
+        # once, even if the feed's size matters.
+        ConfigurationSetting.sitewide(
+            self._db, Configuration.LARGE_FEED_SIZE
+        ).value = 2
+        [self._library() for x in range(3)]
+        self._db.commit()
+
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(self.connection, "before_cursor_execute", record)
+        try:
+            catalog = OPDSCatalog(
+                self._db, "title", "url", self._db.query(Library),
+                url_for=self.mock_url_for
+            )
+        finally:
+            event.remove(self.connection, "before_cursor_execute", record)
+        assert len(catalog.catalog['catalogs']) == 3
+        assert 1 == len(
+            [x for x in statements if "FROM libraries" in x]
+        )
+
     def test_library_catalog(self):
 
         class Mock(OPDSCatalog):
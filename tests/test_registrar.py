@@ -1,5 +1,7 @@
 import json
 
+import pytest
+
 from authentication_document import AuthenticationDocument
 from opds import OPDSCatalog
 from problem_details import *
@@ -8,6 +10,10 @@ from testing import (
     DatabaseTest,
     DummyHTTPResponse,
 )
+from util.http import (
+    PrefetchedGet,
+    RequestTimedOut,
+)
 from util.problem_detail import ProblemDetail
 
 
@@ -40,6 +46,67 @@ class TestRegistrar(DatabaseTest):
         result = registrar.reregister(library)
         assert result is None
 
+    def test_prefetch(self):
+        auth_document = json.dumps(dict(links=[dict(
+            rel="start", href="http://library1/opds",
+            type="application/atom+xml;profile=opds-catalog"
+        )]))
+        responses = {
+            "http://library1/auth": DummyHTTPResponse(200, {}, auth_document),
+            "http://library1/opds": DummyHTTPResponse(401, {}, "login first"),
+        }
+        calls = []
+        def do_get(url, allowed_response_codes=None, **kwargs):
+            calls.append((url, allowed_response_codes))
+            if url in responses:
+                return responses[url]
+            raise RequestTimedOut(url, "too slow")
+
+        library1 = self._library()
+        library1.authentication_url = "http://library1/auth"
+        library2 = self._library()
+        library2.authentication_url = "http://library2/auth"
+        registrar = LibraryRegistrar(self._db, do_get=do_get)
+        prefetched = registrar.prefetch([library1, library2], concurrency=2)
+
+        # Both authentication documents were requested, and so was
+        # the OPDS document linked from the one that was retrieved.
+        auth_codes = LibraryRegistrar.allowed_response_codes()
+        opds_codes = LibraryRegistrar.allowed_response_codes(allow_401=True)
+        assert sorted(calls) == [
+            ("http://library1/auth", auth_codes),
+            ("http://library1/opds", opds_codes),
+            ("http://library2/auth", auth_codes),
+        ]
+
+        # From now on, register() will use the documents that were
+        # already retrieved.
+        assert isinstance(registrar.do_get, PrefetchedGet)
+        assert registrar.do_get == prefetched
+        calls[:] = []
+        assert registrar.do_get(
+            "http://library1/opds", allowed_response_codes=opds_codes
+        ) == responses["http://library1/opds"]
+        with pytest.raises(RequestTimedOut):
+            registrar.do_get(
+                "http://library2/auth", allowed_response_codes=auth_codes
+            )
+        assert calls == []
+
+    def test__root_url(self):
+        m = LibraryRegistrar._root_url
+        link = dict(rel="start", href="http://opds/",
+                    type="application/atom+xml;profile=opds-catalog")
+        document = json.dumps(dict(links=[link]))
+        assert m(DummyHTTPResponse(200, {}, document)) == "http://opds/"
+
+        # Anything other than a successful response with a usable
+        # authentication document gives no URL.
+        assert m(DummyHTTPResponse(404, {}, document)) is None
+        assert m(DummyHTTPResponse(200, {}, "not json")) is None
+        assert m(DummyHTTPResponse(200, {}, json.dumps(dict(links=[])))) is None
+        assert m(RequestTimedOut("http://auth/", "too slow")) is None
+
     def test_opds_response_links(self):
         """Test the opds_response_links method.
 
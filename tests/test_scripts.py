@@ -1,15 +1,23 @@
+import datetime
 import json
 import pytest
 from io import StringIO
 
+import flask
+
 from config import Configuration
 from emailer import Emailer
 from model import (
     ConfigurationSetting,
+    DelegatedPatronIdentifier,
     ExternalIntegration,
     Library,
     Place,
+    PlaceSubdivision,
+    RegistrationJob,
+    SchemaVersion,
     ServiceArea,
+    SessionManager,
     create,
     get_one,
 )
@@ -21,13 +29,19 @@ from scripts import (
     ConfigureIntegrationScript,
     ConfigureSiteScript,
     ConfigureVendorIDScript,
+    ImportDelegatedPatronIdentifiersScript,
+    InitializeDatabaseScript,
     LibraryScript,
     LoadPlacesScript,
     RegistrationRefreshScript,
+    RegistrationWorkerScript,
     SearchLibraryScript,
     SearchPlacesScript,
+    SendQueuedEmailScript,
     SetCoverageAreaScript,
     ShowIntegrationsScript,
+    SubdividePlacesScript,
+    SummarizePlaceGeometriesScript,
 )
 from testing import MockPlace
 from . import (
@@ -74,6 +88,29 @@ class TestLibraryScript(DatabaseTest):
         assert set(script.all_libraries) == set([production, testing])
 
 
+class TestInitializeDatabaseScript(DatabaseTest):
+
+    def test_run(self):
+        connection = self._db.connection()
+        assert SessionManager.schema_is_current(connection) is False
+
+        InitializeDatabaseScript(self._db).run(cmd_args=[])
+        assert SchemaVersion.current(connection) == SessionManager.schema_version()
+        assert SessionManager.schema_is_current(connection) is True
+
+        # Places that were loaded before their geometries were
+        # summarized are summarized along the way.
+        self._place()
+        self._db.execute(Place.__table__.update().values(centroid=None))
+        InitializeDatabaseScript(self._db).run(cmd_args=[])
+        assert 0 == self._db.query(Place).filter(Place.centroid==None).count()
+
+        # The same goes for places that haven't been subdivided.
+        self._db.execute(PlaceSubdivision.__table__.delete())
+        InitializeDatabaseScript(self._db).run(cmd_args=[])
+        assert self._db.query(PlaceSubdivision).count() > 0
+
+
 class TestLoadPlacesScript(DatabaseTest):
 
     def test_run(self):
@@ -94,6 +131,97 @@ class TestLoadPlacesScript(DatabaseTest):
         assert set([x.external_id for x in places]) == set(["US", "01", "0151000"])
 
 
+class TestSummarizePlaceGeometriesScript(DatabaseTest):
+
+    def test_run(self):
+        places = [self._place() for i in range(3)]
+        table = Place.__table__
+        self._db.execute(table.update().values(centroid=None))
+
+        stdout = StringIO()
+        SummarizePlaceGeometriesScript(self._db).run(
+            cmd_args=["--batch-size=2"], stdout=stdout
+        )
+        assert "Summarized %d places.\n" % len(places) == stdout.getvalue()
+        assert 0 == self._db.query(Place).filter(Place.centroid==None).count()
+
+
+class TestSubdividePlacesScript(DatabaseTest):
+
+    def test_run(self):
+        places = [self._place() for i in range(3)]
+        self._db.execute(PlaceSubdivision.__table__.delete())
+
+        stdout = StringIO()
+        SubdividePlacesScript(self._db).run(
+            cmd_args=["--batch-size=2"], stdout=stdout
+        )
+        assert "Subdivided %d places.\n" % len(places) == stdout.getvalue()
+        assert len(places) == self._db.query(PlaceSubdivision).count()
+
+
+class TestImportDelegatedPatronIdentifiersScript(DatabaseTest):
+
+    def test_run(self, tmpdir):
+        library = self._library(short_name="LIB1")
+        adobe = DelegatedPatronIdentifier.ADOBE_ACCOUNT_ID
+
+        # This patron already has an Adobe Account ID.
+        existing, ignore = DelegatedPatronIdentifier.get_one_or_create(
+            self._db, library, "patron1", adobe, "urn:uuid:existing"
+        )
+
+        csv_file = tmpdir.join("identifiers.csv")
+        csv_file.write(
+            "library,patron_identifier,delegated_identifier\n"
+            "lib1,patron1,urn:uuid:1\n"
+            "LIB1,patron2,urn:uuid:2\n"
+            "LIB1,patron2,urn:uuid:duplicate\n"
+            "UNKNOWN,patron3,urn:uuid:3\n"
+            "LIB1,,urn:uuid:4\n"
+        )
+        ndjson = '\n'.join([
+            json.dumps(dict(library="LIB1", patron_identifier="patron5",
+                            delegated_identifier="urn:uuid:5")),
+            "",
+            json.dumps(dict(library="LIB1", patron_identifier="patron6",
+                            delegated_identifier="urn:uuid:6")),
+        ])
+
+        output = StringIO()
+        script = ImportDelegatedPatronIdentifiersScript(self._db)
+        script.run(
+            [str(csv_file), "--batch-size=2"], stdout=output
+        )
+        script.run([], stdin=StringIO(ndjson), stdout=output)
+
+        identifiers = dict(
+            (x.patron_identifier, x.delegated_identifier)
+            for x in self._db.query(DelegatedPatronIdentifier)
+        )
+        assert identifiers == {
+            # The existing Adobe Account ID was left alone.
+            "patron1": "urn:uuid:existing",
+            # For a duplicate record, the first one wins.
+            "patron2": "urn:uuid:2",
+            "patron5": "urn:uuid:5",
+            "patron6": "urn:uuid:6",
+        }
+        assert all(
+            x.library == library and x.type == adobe
+            for x in self._db.query(DelegatedPatronIdentifier)
+        )
+
+        csv_report, ndjson_report = output.getvalue().splitlines()
+        assert csv_report.startswith("Read 5 records in")
+        assert "rows/sec" in csv_report
+        assert csv_report.endswith(
+            "Created 1 delegated identifiers. Skipped 2 records with an unknown library or missing data."
+        )
+        assert "Read 2 records" in ndjson_report
+        assert "Created 2 delegated identifiers" in ndjson_report
+
+
 class TestSearchPlacesScript(DatabaseTest):
 
     def test_run(self):
@@ -193,6 +321,9 @@ class TestConfigureSiteScript(DatabaseTest):
         assert ConfigurationSetting.sitewide(self._db, "setting2").value == '[1,2,"3"]'
         assert ConfigurationSetting.sitewide(self._db, "secret_setting").value == "secretvalue"
 
+        # Other processes were told that the configuration changed.
+        assert Configuration.configuration_generation(self._db) == 1
+
         # If we run again with --show-secrets, the secret is shown.
         output = StringIO()
         script.do_run(self._db, ["--show-secrets"], output)
@@ -201,6 +332,9 @@ class TestConfigureSiteScript(DatabaseTest):
         assert "setting1='value1'" in actual
         assert """setting2='[1,2,"3"]'""" in actual
 
+        # Nothing changed that time.
+        assert Configuration.configuration_generation(self._db) == 1
+
 
 class TestShowIntegrationsScript(DatabaseTest):
 
@@ -366,6 +500,20 @@ class TestRegistrationRefreshScript(DatabaseTest):
         script.run(cmd_args=["--library=Library1"])
         assert script.libraries_called_with == "Library1"
 
+        # By default, documents are fetched one at a time as each
+        # library is reregistered.
+        assert not hasattr(mock_registrar, 'prefetched')
+
+        # With --concurrency, the registrar is asked to fetch
+        # everything ahead of time.
+        def prefetch(libraries, concurrency):
+            mock_registrar.prefetched = (libraries, concurrency)
+        mock_registrar.prefetch = prefetch
+        script.run(cmd_args=["--concurrency=10"])
+        assert mock_registrar.prefetched == (
+            [success_library, failure_library], 10
+        )
+
     def test_registrar(self):
         # Verify that the normal, non-mocked value of script.registrar
         # is a LibraryRegistrar.
@@ -374,6 +522,56 @@ class TestRegistrationRefreshScript(DatabaseTest):
         assert isinstance(registrar, LibraryRegistrar)
         assert registrar._db == self._db
 
+class TestRegistrationWorkerScript(DatabaseTest):
+
+    def test_run(self):
+        class MockController(object):
+            processed = []
+            def run_registration_job(self, job):
+                # The job is run in a request context that looks like
+                # the one in which it was queued.
+                self.processed.append((job, flask.request.url_root))
+                job.complete(201, "text/plain", "done")
+
+        app = flask.Flask("test")
+        class MockRegistry(object):
+            registry_controller = MockController()
+            _db = self._db
+        app.library_registry = MockRegistry()
+
+        first, ignore = create(
+            self._db, RegistrationJob, authentication_url="http://first/",
+            base_url="http://registry/", shared_secret="secret"
+        )
+        second, ignore = create(
+            self._db, RegistrationJob, authentication_url="http://second/",
+            base_url="https://registry/"
+        )
+        script = RegistrationWorkerScript(app=app)
+
+        # The script uses the web application's database session.
+        assert script._db == self._db
+
+        # With --once, every queued job is processed and then the
+        # script exits.
+        script.run(["--once"])
+        assert MockController.processed == [
+            (first, "http://registry/"), (second, "https://registry/")
+        ]
+        assert first.state == RegistrationJob.COMPLETE
+        assert first.shared_secret is None
+        assert second.status_code == 201
+
+        # Once the queue is empty, jobs that finished long ago are
+        # deleted.
+        first.finished = (
+            first.finished - RegistrationJob.KEEP_FINISHED
+            - datetime.timedelta(seconds=1)
+        )
+        script.run(["--once"])
+        assert self._db.query(RegistrationJob).all() == [second]
+
+
 class TestSetCoverageAreaScript(DatabaseTest):
 
     def test_argument_parsing(self):
@@ -499,6 +697,47 @@ class TestConfigureEmailerScript(DatabaseTest):
         assert template == "test"
         assert to == "you@example.com"
 
+        # By default, email is sent immediately.
+        assert emailer.setting(Emailer.USE_OUTBOX).bool_value is False
+
+        # The emailer can be configured to queue email instead, but
+        # the test email is still sent immediately.
+        Mock.sent = None
+        script.do_run(
+            self._db, cmd_args=cmd_args + ["--use-outbox"],
+            emailer_class=Mock
+        )
+        assert emailer.setting(Emailer.USE_OUTBOX).bool_value is True
+        assert Mock.sent == ("test", "you@example.com")
+
+
+class TestSendQueuedEmailScript(DatabaseTest):
+
+    def test_run(self):
+        class MockEmailer(object):
+            calls = []
+
+            @classmethod
+            def from_sitewide_integration(cls, _db):
+                return cls()
+
+            def send_queued(self, _db, batch_size, smtp=None):
+                # Pretend there are five emails waiting to be sent.
+                self.calls.append((batch_size, smtp))
+                return min(batch_size, 5 - 2*(len(self.calls)-1)), 0
+
+        smtp = object()
+        script = SendQueuedEmailScript(self._db)
+        script.run(
+            ["--once", "--batch-size=2"], emailer_class=MockEmailer,
+            smtp=smtp
+        )
+
+        # As long as full batches were being sent, the script kept
+        # going. Once a partial batch was sent, the queue was presumed
+        # empty and the script stopped.
+        assert MockEmailer.calls == [(2, smtp), (2, smtp), (2, smtp)]
+
 
 class TestConfigureVendorIDScript(DatabaseTest):
 
@@ -521,6 +760,9 @@ class TestConfigureVendorIDScript(DatabaseTest):
         assert integration.setting(Configuration.ADOBE_VENDOR_ID_NODE_VALUE).value == "abc12"
         assert integration.setting(Configuration.ADOBE_VENDOR_ID_DELEGATE_URL).json_value == ["http://server1/AdobeAuth/", "http://server2/AdobeAuth/"]
 
+        # Other processes were told that the configuration changed.
+        assert Configuration.configuration_generation(self._db) == 1
+
         # The script won't run if --node-value or --delegate have obviously
         # wrong values.
         cmd_args = [
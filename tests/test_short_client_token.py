@@ -1,5 +1,6 @@
 import base64
 import logging
+import threading
 
 import pytest
 
@@ -144,6 +145,29 @@ class TestShortClientTokenDecoder(DatabaseTest):
         identifier2 = self.decoder.decode(self._db, short_client_token)
         assert identifier2 == identifier
 
+    def test_decode_to_account_id(self):
+        # Decoding a token straight to an account ID gives the same
+        # result as looking up the DelegatedPatronIdentifier.
+        short_client_token = self.encoder.encode(
+            self.library.short_name, self.library.shared_secret,
+            "Foreign Patron"
+        )
+        account_id = self.decoder.decode_to_account_id(
+            self._db, short_client_token
+        )
+        assert account_id.startswith('urn:uuid:0')
+        identifier = self.decoder.decode(self._db, short_client_token)
+        assert identifier.delegated_identifier == account_id
+
+        username, password = short_client_token.rsplit('|', 1)
+        assert self.decoder.decode_two_part_to_account_id(
+            self._db, username, password
+        ) == account_id
+
+        with pytest.raises(ValueError) as exc:
+            self.decoder.decode_to_account_id(self._db, "no pipes")
+        assert 'does not contain a pipe' in str(exc.value)
+
     def test_short_client_token_lookup_delegated_patron_identifier_failure(self):
         """Test various token decoding errors"""
         m = self.decoder._decode
@@ -209,11 +233,11 @@ class TestShortClientTokenDecoder(DatabaseTest):
 
         # Make sure that decode properly reverses that change when
         # decoding the 'password'.
-        def _decode(_db, token, supposed_signature):
+        def _verify(_db, token, parsed, supposed_signature):
             assert supposed_signature == signature
             self.decoder.test_code_ran = True
             return "identifier", "uuid"
-        self.decoder._decode = _decode
+        self.decoder._verify = _verify
 
         self.decoder.test_code_ran = False
 
@@ -224,10 +248,187 @@ class TestShortClientTokenDecoder(DatabaseTest):
             self._db, fake_username, encoded_signature
         )
 
-        # The code in _decode_short_client_token ran. Since there was no
+        # The code in _verify ran. Since there was no
         # test failure, it ran successfully.
         assert self.decoder.test_code_ran is True
 
         with pytest.raises(ValueError) as exc:
             self.decoder.decode_two_part(self._db, fake_username, "I am not a real encoded signature")
         assert "Invalid password" in str(exc.value)
+
+    def test_library_key_cache(self):
+        short_client_token = self.encoder.encode(
+            self.library.short_name, self.library.shared_secret, "patron"
+        )
+        cache = ShortClientTokenDecoder._library_keys
+        self.decoder.decode(self._db, short_client_token)
+
+        # The library's signing key was cached.
+        key = cache['LIBRARY']
+        assert key.library_id == self.library.id
+        assert key.signing_key == self.decoder.signer.prepare_key(
+            "My shared secret"
+        )
+
+        # As long as the cached key is valid, the Library is not looked
+        # up again. The key generation comes from the session's
+        # snapshot of the sitewide settings.
+        assert key.generation == ShortClientTokenDecoder.generation(self._db)
+        class NoDatabase(object):
+            info = self._db.info
+            def query(self, *args, **kwargs):
+                raise Exception("Unexpected database query")
+        parsed = self.decoder._split_token(
+            NoDatabase(), short_client_token.rsplit('|', 1)[0]
+        )
+        assert parsed[0] == key
+
+        # Changing the library's shared secret removes it from the
+        # cache. Tokens signed with the old secret stop working.
+        self.library.shared_secret = "A new secret"
+        assert 'LIBRARY' not in cache
+        with pytest.raises(ValueError) as exc:
+            self.decoder.decode(self._db, short_client_token)
+        assert "Invalid signature" in str(exc.value)
+        new_token = self.encoder.encode(
+            self.library.short_name, "A new secret", "patron"
+        )
+        assert self.decoder.decode(self._db, new_token).patron_identifier == "patron"
+
+        # So does changing its short name.
+        self.library.short_name = "NEWNAME"
+        assert 'LIBRARY' not in cache
+        with pytest.raises(ValueError) as exc:
+            self.decoder.decode(self._db, new_token)
+        assert 'I don\'t know how to handle tokens from library "LIBRARY"' in str(exc.value)
+
+    def test_library_key_cache_refresh(self):
+        # Simulate a secret that was changed by another process after
+        # this process cached the old one.
+        m = ShortClientTokenDecoder.LibraryKey
+        generation = ShortClientTokenDecoder.generation(self._db)
+        ShortClientTokenDecoder._library_keys['LIBRARY'] = m(
+            self.library.id, self.decoder.signer.prepare_key("old secret"),
+            generation
+        )
+
+        # A token signed with the current secret doesn't match the
+        # cached key, so the key is reloaded and the token is accepted.
+        token = self.encoder.encode(
+            self.library.short_name, self.library.shared_secret, "patron"
+        )
+        identifier = self.decoder.decode(self._db, token)
+        assert identifier.library == self.library
+        key = ShortClientTokenDecoder._library_keys['LIBRARY']
+        assert key.signing_key == self.decoder.signer.prepare_key(
+            self.library.shared_secret
+        )
+
+        # A cached key is also reloaded once the key generation goes
+        # up, even if this process never heard about the change.
+        ShortClientTokenDecoder._library_keys['LIBRARY'] = m(
+            -1, None, generation - 1
+        )
+        key = self.decoder._library_key(self._db, 'LIBRARY')
+        assert key.library_id == self.library.id
+        assert key.generation == generation
+
+    def test_generation(self):
+        # Changing a library's shared secret or short name, or
+        # deleting it, tells every process to reload its keys.
+        before = ShortClientTokenDecoder.generation(self._db)
+        self.library.shared_secret = "A new secret"
+        self._db.flush()
+        after_secret = ShortClientTokenDecoder.generation(self._db)
+        assert after_secret == before + 1
+
+        self.library.short_name = "NEWNAME"
+        self._db.flush()
+        after_name = ShortClientTokenDecoder.generation(self._db)
+        assert after_name == after_secret + 1
+
+        # Other changes to a library don't matter.
+        self.library.name = "A new name"
+        self._db.flush()
+        assert ShortClientTokenDecoder.generation(self._db) == after_name
+
+        self._db.delete(self.library)
+        self._db.flush()
+        assert ShortClientTokenDecoder.generation(self._db) == after_name + 1
+
+    def test_ask_delegates(self):
+        # Delegates are asked at once, and the first one to answer
+        # wins, even if it's not the first delegate on the list.
+        release = threading.Event()
+
+        class Slow(object):
+            def sign_in_standard(self, username, password):
+                release.wait(5)
+                return ("slow", "label", "content")
+
+        class Fast(object):
+            def sign_in_standard(self, username, password):
+                return ("fast", "label", "content")
+
+        class Broken(object):
+            def sign_in_standard(self, username, password):
+                raise Exception("Nope")
+
+        ask = lambda delegate: delegate.sign_in_standard("user", "pass")
+        decoder = ShortClientTokenDecoder(
+            self.TEST_NODE_VALUE, [Broken(), Slow(), Fast()]
+        )
+        try:
+            assert decoder.ask_delegates(ask)[0] == "fast"
+        finally:
+            release.set()
+
+        # If no delegate can help, the answer is None.
+        decoder.delegates = [Broken(), Broken()]
+        assert decoder.ask_delegates(ask) is None
+
+        decoder.delegates = []
+        assert decoder.ask_delegates(ask) is None
+
+    def test_delegates_consulted_after_local_verification(self):
+        class Delegate(object):
+            calls = 0
+            answer = ("delegated id", "label", "content")
+            def sign_in_standard(self, username, password):
+                self.calls += 1
+                if isinstance(self.answer, Exception):
+                    raise self.answer
+                return self.answer
+
+        delegate = Delegate()
+        decoder = ShortClientTokenDecoder(self.TEST_NODE_VALUE, [delegate])
+        token = self.encoder.encode(
+            self.library.short_name, self.library.shared_secret, "patron"
+        )
+
+        # The token is good, but the patron is new, so we check whether
+        # a delegate already knows them.
+        assert decoder.decode_to_account_id(self._db, token) == "delegated id"
+        assert delegate.calls == 1
+
+        # Once the patron has an identifier, a good token is verified
+        # without bothering the delegates.
+        assert decoder.decode_to_account_id(self._db, token) == "delegated id"
+        assert delegate.calls == 1
+
+        # A token we can't verify goes to the delegates.
+        bad_token = self.encoder.encode(
+            self.library.short_name, "wrong secret", "patron"
+        )
+        assert (
+            decoder.decode_to_account_id(self._db, bad_token)
+            == "delegated id"
+        )
+        assert delegate.calls == 2
+
+        # If they can't verify it either, the token is rejected.
+        delegate.answer = Exception("Nope")
+        with pytest.raises(ShortClientTokenDecoder.TokenRejected) as exc:
+            decoder.decode_to_account_id(self._db, bad_token)
+        assert 'Invalid signature for' in str(exc.value)
+        assert delegate.calls == 3
@@ -13,6 +13,11 @@ class TestGeometryUtility(object):
         point = GeometryUtility.point_from_ip("127.0.0.1")
         assert point is None
 
+        assert GeometryUtility.point_from_ip(None) is None
+
+        # The GeoIP database is only opened once.
+        assert GeometryUtility.ip_database() is GeometryUtility.ip_database()
+
     def test_point_from_string(self):
         m = GeometryUtility.point_from_string
 
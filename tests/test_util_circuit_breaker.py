@@ -0,0 +1,88 @@
+# Test the helper objects in util.circuit_breaker.
+from util.circuit_breaker import CircuitBreaker
+
+
+class MockClock(object):
+
+    def __init__(self):
+        self.time = 0
+
+    def __call__(self):
+        return self.time
+
+
+class TestCircuitBreaker(object):
+
+    def setup(self):
+        self.clock = MockClock()
+        self.healthy = False
+        self.probes = 0
+        self.breaker = CircuitBreaker(
+            "test service", window=4, minimum_calls=4, failure_rate=0.5,
+            reset_after=30, probe=self.probe, clock=self.clock
+        )
+
+    def probe(self):
+        self.probes += 1
+        return self.healthy
+
+    def test_opens_on_failure_rate(self):
+        b = self.breaker
+        assert b.state == CircuitBreaker.CLOSED
+
+        # Failures don't open the circuit until there are enough
+        # outcomes to judge by.
+        b.record_failure()
+        b.record_failure()
+        b.record_failure()
+        assert b.allow() is True
+        assert b.current_failure_rate == 1
+
+        # Only the last four outcomes count.
+        for i in range(3):
+            b.record_success()
+        b.record_failure()
+        assert b.state == CircuitBreaker.CLOSED
+        assert b.current_failure_rate == 0.25
+
+        b.record_failure()
+        assert b.state == CircuitBreaker.OPEN
+        assert b.allow() is False
+        assert self.probes == 0
+
+    def test_half_open_probe(self):
+        b = self.breaker
+        for i in range(4):
+            b.record_failure()
+        assert b.allow() is False
+
+        # After a while we check whether the service has recovered.
+        # It hasn't, so the circuit stays open for another while.
+        self.clock.time = 30
+        assert b.state == CircuitBreaker.HALF_OPEN
+        assert b.allow() is False
+        assert self.probes == 1
+        assert b.state == CircuitBreaker.OPEN
+
+        self.clock.time = 45
+        assert b.allow() is False
+        assert self.probes == 1
+
+        # Now it has recovered, and the circuit closes.
+        self.clock.time = 60
+        self.healthy = True
+        assert b.allow() is True
+        assert self.probes == 1 + 1
+        assert b.state == CircuitBreaker.CLOSED
+        assert b.current_failure_rate == 0
+
+    def test_probe_exception(self):
+        def probe():
+            raise Exception("Still down")
+        b = CircuitBreaker(
+            "test service", minimum_calls=1, probe=probe, clock=self.clock
+        )
+        b.record_failure()
+        self.clock.time = 100
+        assert b.allow() is False
+        assert b.state == CircuitBreaker.OPEN
@@ -0,0 +1,123 @@
+# Test the helper objects in util.compression.
+import gzip
+import os
+
+import pytest
+
+from config import (
+    CannotLoadConfiguration,
+    Configuration,
+)
+from util.compression import (
+    BrotliEncoding,
+    GzipEncoding,
+    ZstdEncoding,
+    brotli,
+    encodings,
+    negotiate,
+    zstandard,
+)
+
+
+class TestEncodings(object):
+
+    def test_gzip(self):
+        value = b"Compress me! " * 100
+        encoding = GzipEncoding()
+        assert encoding.level == GzipEncoding.default_level
+
+        compressed = encoding.compress(value)
+        assert gzip.decompress(compressed) == value
+        assert len(compressed) < len(value)
+
+        # A body can be compressed as it's generated, one chunk at a
+        # time. Strings are encoded as UTF-8.
+        chunks = list(encoding.stream([value, "and me!"]))
+        assert gzip.decompress(b"".join(chunks)) == value + b"and me!"
+
+        # A higher level makes a smaller body.
+        value = os.urandom(1000).hex().encode("ascii")
+        assert (len(GzipEncoding(9).compress(value))
+                < len(GzipEncoding(1).compress(value)))
+
+    @pytest.mark.skipif(brotli is None, reason="brotli is not installed")
+    def test_brotli(self):
+        value = b"Compress me! " * 100
+        encoding = BrotliEncoding(11)
+        compressed = b"".join(encoding.stream([value, b"and me!"]))
+        assert brotli.decompress(compressed) == value + b"and me!"
+
+    @pytest.mark.skipif(zstandard is None, reason="zstandard is not installed")
+    def test_zstd(self):
+        value = b"Compress me! " * 100
+        encoding = ZstdEncoding(10)
+        compressed = b"".join(encoding.stream([value, b"and me!"]))
+        decompressor = zstandard.ZstdDecompressor()
+        assert decompressor.decompressobj().decompress(compressed) == (
+            value + b"and me!"
+        )
+
+    def test_encodings(self):
+        available = encodings(dict(gzip=2))
+        assert available[-1].name == "gzip"
+        assert available[-1].level == 2
+        assert [x.name for x in available if x.name != "gzip"] == (
+            (["br"] if brotli else []) + (["zstd"] if zstandard else [])
+        )
+
+    def test_negotiate(self):
+        br = BrotliEncoding()
+        zstd = ZstdEncoding()
+        gz = GzipEncoding()
+        available = [br, zstd, gz]
+
+        # If the client doesn't say, the response isn't compressed.
+        assert negotiate(None, available) is None
+        assert negotiate("", available) is None
+        assert negotiate("compress", available) is None
+
+        # Otherwise the server's preference breaks ties.
+        assert negotiate("gzip", available) == gz
+        assert negotiate("GZIP, zstd", available) == zstd
+        assert negotiate("gzip, deflate, br", available) == br
+        assert negotiate("*", available) == br
+
+        # But the client's preference wins.
+        assert negotiate("br;q=0.5, gzip", available) == gz
+        assert negotiate("*;q=0.1, zstd;q=0.2", available) == zstd
+
+        # An encoding with a quality of zero is refused.
+        assert negotiate("gzip;q=0", available) is None
+        assert negotiate("*, br;q=0, zstd;q=0", available) == gz
+
+        # An encoding we can't use isn't chosen.
+        assert negotiate("br", [gz]) is None
+
+    def test_compression_levels(self):
+        c = Configuration
+        variables = [
+            c.GZIP_LEVEL_ENVIRONMENT_VARIABLE,
+            c.BROTLI_LEVEL_ENVIRONMENT_VARIABLE,
+            c.ZSTD_LEVEL_ENVIRONMENT_VARIABLE,
+        ]
+        old_values = dict((x, os.environ.pop(x, None)) for x in variables)
+        try:
+            assert c.compression_levels() == dict(
+                gzip=c.DEFAULT_GZIP_LEVEL, br=c.DEFAULT_BROTLI_LEVEL,
+                zstd=c.DEFAULT_ZSTD_LEVEL
+            )
+
+            for variable, value in zip(variables, ["9", "11", "19"]):
+                os.environ[variable] = value
+            assert c.compression_levels() == dict(gzip=9, br=11, zstd=19)
+
+            os.environ[c.GZIP_LEVEL_ENVIRONMENT_VARIABLE] = "max"
+            with pytest.raises(CannotLoadConfiguration) as exc:
+                c.compression_levels()
+            assert "SIMPLIFIED_GZIP_LEVEL must be an integer" in str(exc.value)
+        finally:
+            for variable, value in old_values.items():
+                if value is None:
+                    os.environ.pop(variable, None)
+                else:
+                    os.environ[variable] = value
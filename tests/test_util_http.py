@@ -1,15 +1,23 @@
 import requests
 import json
+import threading
+from http.server import (
+    BaseHTTPRequestHandler,
+    ThreadingHTTPServer,
+)
 
 import pytest
 
 from util.http import (
     HTTP,
+    AsyncHTTP,
     BadResponseException,
+    PrefetchedGet,
     RemoteIntegrationException,
     RequestNetworkException,
     RequestTimedOut,
 )
+from util.problem_detail import ProblemDetail
 from testing import MockRequestsResponse
 
 
@@ -256,3 +264,128 @@ class TestRequestNetworkException(object):
         # The status code corresponding to an upstream timeout is 502.
         document, status_code, headers = standard_detail.response
         assert status_code == 502
+
+
+class StubServer(object):
+    """A real HTTP server, running on localhost in a background thread,
+    that serves canned responses.
+    """
+
+    def __init__(self, barrier=None):
+        # If a Barrier is provided, a request to /together won't be
+        # answered until enough requests are waiting at the barrier.
+        self.barrier = barrier
+
+        stub = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.startswith('/together'):
+                    stub.barrier.wait(timeout=5)
+                if self.path == '/missing':
+                    status, body = 404, b"Not here."
+                else:
+                    status, body = 200, self.path.encode("utf8")
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestAsyncHTTP(object):
+
+    def test_get_many_against_stub_server(self):
+        with StubServer() as server:
+            ok = server.url + "/ok"
+            missing = server.url + "/missing"
+            outcomes = AsyncHTTP().get_many([ok, missing, ok], timeout=5)
+
+        # Duplicate URLs are only requested once.
+        assert set(outcomes.keys()) == set([ok, missing])
+
+        # The outcomes are exactly what HTTP.debuggable_get would
+        # have returned.
+        assert outcomes[ok].status_code == 200
+        assert outcomes[ok].content == b"/ok"
+        assert isinstance(outcomes[missing], ProblemDetail)
+
+    def test_requests_are_made_concurrently(self):
+        # The stub server won't answer any of these requests until
+        # all three of them have been received, so this can only
+        # succeed if the requests are actually made at the same time.
+        with StubServer(threading.Barrier(3)) as server:
+            urls = ["%s/together?%d" % (server.url, i) for i in range(3)]
+            outcomes = AsyncHTTP(concurrency=3).get_many(urls, timeout=10)
+        assert all(x.status_code == 200 for x in outcomes.values())
+
+    def test_do_get_contract(self):
+        # Arguments are passed into the `do_get` function, and
+        # exceptions are returned rather than raised.
+        calls = []
+        def do_get(url, **kwargs):
+            calls.append((url, kwargs))
+            if url == "http://timeout/":
+                raise RequestTimedOut(url, "too slow")
+            return MockRequestsResponse(200, content=url)
+
+        fetcher = AsyncHTTP(do_get)
+        outcomes = fetcher.get_many(
+            ["http://ok/", "http://timeout/", None],
+            allowed_response_codes=["2xx"], timeout=30
+        )
+        assert sorted(calls) == [
+            ("http://ok/", dict(allowed_response_codes=["2xx"], timeout=30)),
+            ("http://timeout/", dict(allowed_response_codes=["2xx"], timeout=30)),
+        ]
+        assert outcomes["http://ok/"].content == "http://ok/"
+        assert isinstance(outcomes["http://timeout/"], RequestTimedOut)
+
+        # No URLs, no requests.
+        assert fetcher.get_many([]) == {}
+
+
+class TestPrefetchedGet(object):
+
+    def test_replay(self):
+        live = []
+        def do_get(url, **kwargs):
+            live.append((url, kwargs))
+            return "live response"
+
+        get = PrefetchedGet(do_get)
+        timeout = RequestTimedOut("http://timeout/", "too slow")
+        get.add(
+            {"http://ok/": "prefetched response", "http://timeout/": timeout},
+            ["2xx", 404]
+        )
+
+        # A request that was made ahead of time is replayed, as long
+        # as it uses the same allowed_response_codes.
+        assert get("http://ok/", allowed_response_codes=[404, "2xx"],
+                   timeout=30) == "prefetched response"
+        with pytest.raises(RequestTimedOut):
+            get("http://timeout/", allowed_response_codes=["2xx", 404])
+        assert live == []
+
+        # Otherwise the request is made for real.
+        assert get("http://ok/", allowed_response_codes=["2xx"]) == "live response"
+        assert get("http://other/", stream=True) == "live response"
+        assert live == [
+            ("http://ok/", dict(allowed_response_codes=["2xx"])),
+            ("http://other/", dict(allowed_response_codes=None, stream=True)),
+        ]
@@ -0,0 +1,80 @@
+# Test the helper objects in util.lru.
+import pytest
+
+from util.lru import LRUCache
+
+
+class TestLRUCache(object):
+
+    def test_capacity(self):
+        with pytest.raises(ValueError) as exc:
+            LRUCache(0)
+        assert "Cache capacity must be positive." in str(exc.value)
+
+    def test_get_and_set(self):
+        cache = LRUCache(2)
+        assert cache.get("a") is None
+        assert cache.get("a", "default") == "default"
+        assert cache.misses == 2
+
+        cache.set("a", 1)
+        cache.set("b", 2)
+        assert cache.get("a") == 1
+        assert cache.hits == 1
+        assert len(cache) == 2
+
+        # "b" is now the least recently used item, so adding a third
+        # item evicts it.
+        cache.set("c", 3)
+        assert "b" not in cache
+        assert "a" in cache
+        assert "c" in cache
+        assert len(cache) == 2
+
+        # Replacing an item also counts as using it.
+        cache.set("a", 10)
+        cache.set("d", 4)
+        assert cache.get("a") == 10
+        assert "c" not in cache
+
+    def test_pop_and_clear(self):
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        assert cache.pop("a") == 1
+        assert cache.pop("a", "gone") == "gone"
+        assert "a" not in cache
+
+        cache.clear()
+        assert len(cache) == 0
+
+    def test_sizeof(self):
+        # The cache can be limited by the total size of its values
+        # rather than the number of items.
+        cache = LRUCache(10, sizeof=len)
+        cache.set("a", b"12345")
+        cache.set("b", b"1234")
+        assert cache.size == 9
+
+        # Adding a value that doesn't fit evicts as many of the least
+        # recently used items as necessary.
+        cache.get("a")
+        cache.set("c", b"123")
+        assert "b" not in cache
+        assert cache.size == 8
+        cache.set("d", b"123456789")
+        assert list(cache._items) == ["d"]
+        assert cache.size == 9
+
+        # Replacing a value replaces its size.
+        cache.set("d", b"1")
+        assert cache.size == 1
+
+        # A value bigger than the whole cache isn't kept, rather than
+        # evicting everything else.
+        cache.set("e", b"12345678901")
+        assert "e" not in cache
+        assert "d" in cache
+
+        assert cache.pop("d") == b"1"
+        assert cache.size == 0
@@ -27,17 +27,26 @@ class GeometryUtility():
 
                 'SRID=4326;POINT({longitude} {latitude})'
         """
-        reader = geolite2.reader()  # TODO: Move this instantiation after None check
         if not ip_address:
             return None
 
-        match = reader.get(ip_address)
+        match = cls.ip_database().get(ip_address)
         if match is None:
             return None
 
         latitude, longitude = [match['location'][x] for x in ('latitude', 'longitude')]
         return cls.point(latitude, longitude)
 
+    @classmethod
+    def ip_database(cls):
+        """
+        Open the MaxMind GeoIP database, or return the copy that's already open.
+
+        The database is memory-mapped and never written to, so if it's opened
+        before a server forks, the child processes share a single copy of it.
+        """
+        return geolite2.reader()
+
     @classmethod
     def point_from_string(cls, s):
         """
@@ -7,6 +7,7 @@ from lxml import etree
 from functools import wraps
 from flask import make_response
 from flask_babel import lazy_gettext as _
+from werkzeug.http import is_resource_modified
 from util.flask_util import problem
 from util.problem_detail import ProblemDetail
 import traceback
@@ -18,28 +19,57 @@ from sqlalchemy.orm.exc import (
     NoResultFound,
 )
 
-def catalog_response(catalog, cache_for=OPDSCatalog.CACHE_TIME):
+def catalog_response(catalog, cache_for=OPDSCatalog.CACHE_TIME, etag=None,
+                     last_modified=None):
     content_type = OPDSCatalog.OPDS_TYPE
-    return _make_response(catalog, content_type, cache_for)
-
-def _make_response(content, content_type, cache_for):
-    if isinstance(content, etree._Element):
-        content = etree.tostring(content)
-    elif not isinstance(content, str):
-        content = str(content)
-
+    response = _make_response(catalog, content_type, cache_for)
+    return _add_validators(response, etag, last_modified)
+
+def not_modified_response(etag=None, last_modified=None,
+                          cache_for=OPDSCatalog.CACHE_TIME):
+    """Find out whether the client already has the current version of
+    a document.
+
+    This is cheap enough to call before doing the work of building the
+    document.
+
+    :return: A 304 response if the client's copy is current;
+        otherwise None.
+    """
+    if is_resource_modified(
+        flask.request.environ, etag=etag, last_modified=last_modified
+    ):
+        return None
+    response = make_response(
+        "", 304, {"Cache-Control": _cache_control(cache_for)}
+    )
+    return _add_validators(response, etag, last_modified)
+
+def _add_validators(response, etag, last_modified):
+    if etag:
+        response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    return response
+
+def _cache_control(cache_for):
     if isinstance(cache_for, int):
         # A CDN should hold on to the cached representation only half
         # as long as the end-user.
         client_cache = cache_for
         cdn_cache = cache_for / 2
-        cache_control = "public, no-transform, max-age: %d, s-maxage: %d" % (
+        return "public, no-transform, max-age: %d, s-maxage: %d" % (
             client_cache, cdn_cache)
-    else:
-        cache_control = "private, no-cache"
+    return "private, no-cache"
+
+def _make_response(content, content_type, cache_for):
+    if isinstance(content, etree._Element):
+        content = etree.tostring(content)
+    elif not isinstance(content, str):
+        content = str(content)
 
     return make_response(content, 200, {"Content-Type": content_type,
-                                        "Cache-Control": cache_control})
+                                        "Cache-Control": _cache_control(cache_for)})
 
 def returns_problem_detail(f):
     @wraps(f)
@@ -0,0 +1,114 @@
+"""Keep track of whether a remote service is healthy enough to use."""
+from collections import deque
+import logging
+import threading
+import time
+
+
+class CircuitBreaker(object):
+    """Stop calling a remote service that keeps failing.
+
+    The breaker keeps a rolling window of recent outcomes. Once enough
+    of them are failures, the circuit 'opens' and callers are told not
+    to bother the service. After a while the circuit goes 'half-open':
+    the next caller runs the probe function (if there is one), and
+    depending on the result the circuit either closes again or stays
+    open for another while.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, name, window=20, minimum_calls=5, failure_rate=0.5,
+                 reset_after=30, probe=None, clock=time.monotonic):
+        """Constructor.
+
+        :param window: Decide based on this many recent outcomes.
+        :param minimum_calls: Never open the circuit until at least this
+            many outcomes have been recorded.
+        :param failure_rate: Open the circuit once this proportion of
+            recent outcomes are failures.
+        :param reset_after: Leave the circuit open for this many seconds
+            before checking whether the service has recovered.
+        :param probe: A function that returns a true value if the
+            service is healthy.
+        """
+        self.name = name
+        self.minimum_calls = minimum_calls
+        self.failure_rate = failure_rate
+        self.reset_after = reset_after
+        self.probe = probe
+        self.clock = clock
+        self.log = logging.getLogger("Circuit breaker")
+
+        self._outcomes = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return self.CLOSED
+        if self._probing or (
+            self.clock() >= self._opened_at + self.reset_after
+        ):
+            return self.HALF_OPEN
+        return self.OPEN
+
+    @property
+    def current_failure_rate(self):
+        with self._lock:
+            if not self._outcomes:
+                return 0.0
+            return self._outcomes.count(False) / float(len(self._outcomes))
+
+    def allow(self):
+        """Is it okay to call the service right now?"""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._probing:
+                # Someone else is finding out whether the service
+                # has recovered.
+                return False
+            if self.clock() < self._opened_at + self.reset_after:
+                return False
+            self._probing = True
+
+        healthy = True
+        if self.probe:
+            try:
+                healthy = bool(self.probe())
+            except Exception as e:
+                healthy = False
+
+        with self._lock:
+            self._probing = False
+            if healthy:
+                self.log.info("%s has recovered.", self.name)
+                self._opened_at = None
+                self._outcomes.clear()
+            else:
+                self._opened_at = self.clock()
+        return healthy
+
+    def record_success(self):
+        with self._lock:
+            self._outcomes.append(True)
+
+    def record_failure(self):
+        with self._lock:
+            self._outcomes.append(False)
+            if self._opened_at is not None:
+                return
+            calls = len(self._outcomes)
+            failures = self._outcomes.count(False)
+            if (calls >= self.minimum_calls
+                and failures >= calls * self.failure_rate):
+                self.log.warning(
+                    "%s failed %d of the last %d calls; not calling it for %ds.",
+                    self.name, failures, calls, self.reset_after
+                )
+                self._opened_at = self.clock()
@@ -0,0 +1,142 @@
+"""Compress HTTP response bodies in whichever way the client prefers."""
+import zlib
+
+# These libraries are optional. Without them, the corresponding
+# encodings are never offered to clients.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class Encoding(object):
+    """A way of compressing a response body, named as it would be in
+    a Content-Encoding header.
+    """
+
+    name = None
+    default_level = None
+    available = True
+
+    def __init__(self, level=None):
+        if level is None:
+            level = self.default_level
+        self.level = level
+
+    def compressor(self):
+        """Create an object with compress(bytes) and flush() methods,
+        like the objects returned by zlib.compressobj().
+        """
+        raise NotImplementedError()
+
+    def compress(self, data):
+        """Compress a complete response body."""
+        return b"".join(self.stream([data]))
+
+    def stream(self, chunks):
+        """Compress a response body one chunk at a time, as it's
+        being generated.
+        """
+        compressor = self.compressor()
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf8")
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+
+
+class GzipEncoding(Encoding):
+
+    name = "gzip"
+    default_level = 6
+
+    def compressor(self):
+        # Adding 16 to the window size makes zlib write a gzip header
+        # and trailer.
+        return zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+class BrotliEncoding(Encoding):
+
+    name = "br"
+    default_level = 5
+    available = brotli is not None
+
+    class Compressor(object):
+        def __init__(self, level):
+            self._compressor = brotli.Compressor(quality=level)
+
+        def compress(self, data):
+            return self._compressor.process(data)
+
+        def flush(self):
+            return self._compressor.finish()
+
+    def compressor(self):
+        return self.Compressor(self.level)
+
+
+class ZstdEncoding(Encoding):
+
+    name = "zstd"
+    default_level = 3
+    available = zstandard is not None
+
+    def compressor(self):
+        return zstandard.ZstdCompressor(level=self.level).compressobj()
+
+
+# Every encoding we know about, in the order we'd prefer to use them.
+ENCODINGS = [BrotliEncoding, ZstdEncoding, GzipEncoding]
+
+
+def encodings(levels=None):
+    """Create an Encoding for each available encoding, in order of
+    preference.
+
+    :param levels: A dictionary mapping encoding names to the
+        compression level to use.
+    """
+    levels = levels or {}
+    return [
+        cls(levels.get(cls.name)) for cls in ENCODINGS if cls.available
+    ]
+
+
+def negotiate(accept_encoding, available):
+    """Choose an encoding based on an Accept-Encoding header.
+
+    :param accept_encoding: The value of the Accept-Encoding header.
+    :param available: A list of Encodings, in order of preference.
+    :return: The Encoding the client likes best, or None if the
+        response should be sent uncompressed.
+    """
+    qualities = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, parameters = part.partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        parameter, _, value = parameters.partition("=")
+        if parameter.strip().lower() == "q":
+            try:
+                quality = float(value)
+            except ValueError:
+                quality = 0
+        qualities[name] = quality
+
+    best = None
+    best_quality = 0
+    for encoding in available:
+        quality = qualities.get(encoding.name, qualities.get("*", 0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
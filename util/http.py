@@ -1,3 +1,6 @@
+import asyncio
+import concurrent.futures
+import functools
 import logging
 import requests
 import urllib.parse
@@ -400,3 +403,98 @@ class HTTP(object):
                 response.content,
             )
         )
+
+
+class AsyncHTTP(object):
+    """Make many HTTP requests concurrently from a single thread of control.
+
+    Every request is made through an ordinary `do_get` function (by
+    default HTTP.debuggable_get), run on a thread pool driven by an
+    asyncio event loop. This means the return values and exceptions
+    are exactly the ones `do_get` would have produced if it had been
+    called directly, but a slow server only holds up its own request.
+    """
+
+    DEFAULT_CONCURRENCY = 20
+
+    def __init__(self, do_get=None, concurrency=DEFAULT_CONCURRENCY):
+        """Constructor.
+
+        :param do_get: A function with the same signature as
+            HTTP.debuggable_get.
+        :param concurrency: Make at most this many requests at once.
+        """
+        self.do_get = do_get or HTTP.debuggable_get
+        self.concurrency = max(1, concurrency)
+
+    async def get(self, url, executor=None, **kwargs):
+        """Make a single GET request without blocking the event loop.
+
+        :return: Whatever `do_get` returns.
+        :raise: Whatever `do_get` raises.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            executor, functools.partial(self.do_get, url, **kwargs)
+        )
+
+    async def _get_many(self, urls, **kwargs):
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.concurrency
+        ) as executor:
+            tasks = [self.get(url, executor=executor, **kwargs) for url in urls]
+            outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+        return dict(list(zip(urls, outcomes)))
+
+    def get_many(self, urls, **kwargs):
+        """Make a GET request to each of `urls`.
+
+        :param kwargs: Keyword arguments passed into every `do_get` call.
+        :return: A dictionary mapping each URL to either the return value
+            of `do_get`, or the exception it raised.
+        """
+        urls = list(dict.fromkeys(url for url in urls if url))
+        if not urls:
+            return {}
+        return asyncio.run(self._get_many(urls, **kwargs))
+
+
+class PrefetchedGet(object):
+    """A `do_get` function that replays the outcomes of requests made
+    ahead of time, e.g. by AsyncHTTP.get_many.
+
+    Any request that wasn't made ahead of time, or was made with
+    different `allowed_response_codes`, is passed through to the
+    real `do_get` function.
+    """
+
+    def __init__(self, do_get=None):
+        self.do_get = do_get or HTTP.debuggable_get
+        self.outcomes = {}
+
+    @classmethod
+    def key(cls, url, allowed_response_codes=None):
+        codes = tuple(sorted(map(str, allowed_response_codes or [])))
+        return (url, codes)
+
+    def add(self, outcomes, allowed_response_codes=None):
+        """Store the outcomes of some requests.
+
+        :param outcomes: A dictionary mapping URLs to responses or
+            exceptions, as returned by AsyncHTTP.get_many.
+        :param allowed_response_codes: The `allowed_response_codes` used
+            when making those requests.
+        """
+        for url, outcome in list(outcomes.items()):
+            self.outcomes[self.key(url, allowed_response_codes)] = outcome
+
+    def __call__(self, url, allowed_response_codes=None, **kwargs):
+        key = self.key(url, allowed_response_codes)
+        if key not in self.outcomes:
+            return self.do_get(
+                url, allowed_response_codes=allowed_response_codes, **kwargs
+            )
+        outcome = self.outcomes[key]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
@@ -0,0 +1,84 @@
+"""A small, thread-safe, bounded in-memory cache."""
+from collections import OrderedDict
+import threading
+
+
+class LRUCache(object):
+    """A dictionary-like cache that holds at most `capacity` items.
+
+    When the cache is full, adding a new item evicts whichever item
+    was used least recently.
+    """
+
+    def __init__(self, capacity, sizeof=None):
+        """Constructor.
+
+        :param sizeof: A function that measures a value, e.g. in
+            bytes. If this is provided, the cache holds values whose
+            sizes add up to at most `capacity`, rather than at most
+            `capacity` items.
+        """
+        if capacity < 1:
+            raise ValueError("Cache capacity must be positive.")
+        self.capacity = capacity
+        self.sizeof = sizeof
+        self.size = 0
+        self._items = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Look up an item, marking it as recently used."""
+        with self._lock:
+            try:
+                value = self._items[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Add or replace an item, evicting the least recently used
+        item if necessary.
+        """
+        size = self.sizeof(value) if self.sizeof else 1
+        with self._lock:
+            self._remove(key)
+            if size > self.capacity:
+                # This item would push everything else out of the
+                # cache, so don't keep it at all.
+                return
+            self._items[key] = value
+            self._sizes[key] = size
+            self.size += size
+            while self.size > self.capacity:
+                evicted, ignore = self._items.popitem(last=False)
+                self.size -= self._sizes.pop(evicted)
+
+    def pop(self, key, default=None):
+        """Remove an item from the cache."""
+        with self._lock:
+            return self._remove(key, default)
+
+    def _remove(self, key, default=None):
+        if key not in self._items:
+            return default
+        self.size -= self._sizes.pop(key)
+        return self._items.pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._sizes.clear()
+            self.size = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        return len(self._items)
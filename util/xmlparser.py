@@ -1,5 +1,5 @@
 from lxml import etree
-from io import StringIO
+import threading
 
 class XMLParser(object):
 
@@ -7,6 +7,18 @@ class XMLParser(object):
 
     NAMESPACES = {}
 
+    # lxml parsers are expensive to create but can't be used by two
+    # threads at once, so each thread gets one to reuse.
+    _parsers = threading.local()
+
+    @classmethod
+    def shared_parser(cls):
+        parser = getattr(cls._parsers, 'parser', None)
+        if parser is None:
+            parser = etree.XMLParser(resolve_entities=False, no_network=True)
+            cls._parsers.parser = parser
+        return parser
+
     @classmethod
     def _xpath(cls, tag, expression, namespaces=None):
         if not namespaces:
@@ -46,15 +58,27 @@ class XMLParser(object):
         return int(v)
 
     def process_all(self, xml, xpath, namespaces=None, handler=None, parser=None):
+        """Find the tags matching `xpath` in a document, and process
+        each one with `handler`.
+
+        :param xml: A document as a string or bytes, or an
+            already-parsed lxml tag.
+        :param xpath: An XPath expression, either a string or a
+            precompiled etree.XPath.
+        """
         if not parser:
-            parser = etree.XMLParser()
+            parser = self.shared_parser()
         if not handler:
             handler = self.process_one
-        if isinstance(xml, str):
-            root = etree.parse(StringIO(xml), parser)
+        if isinstance(xml, (str, bytes)):
+            root = etree.fromstring(xml, parser)
         else:
             root = xml
-        for i in root.xpath(xpath, namespaces=namespaces):
+        if isinstance(xpath, etree.XPath):
+            matches = xpath(root)
+        else:
+            matches = root.xpath(xpath, namespaces=namespaces)
+        for i in matches:
             data = handler(i, namespaces)
             if data:
                 yield data